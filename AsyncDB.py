@@ -0,0 +1,237 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+
+
+class _Call(Future):
+    """Future of a call, claimed by whoever sets its result first"""
+
+    def __init__(self):
+        super().__init__()
+        self.claimed = False
+
+
+class AsyncDB:
+    """Runs the methods of a DB in a dedicated thread pool
+
+    Handlers submit a query and get a future instead of blocking the
+    dispatcher until the database answered. Every call has a deadline; if no
+    result is available in time, the future fails with a TimeoutError and a
+    result arriving later is discarded.
+    Without workers the methods are executed directly in the calling thread.
+    In the pool they run in a copy of the caller's context, so context
+    variables (like the trace of the current update) are available.
+    """
+
+    def __init__(self, db, workers=0, timeout=None):
+        self.db = db
+        self.workers = workers
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._stats = {'workers': workers,
+                       'submitted': 0,
+                       'queued': 0,
+                       'max_queued': 0,
+                       'running': 0,
+                       'completed': 0,
+                       'failed': 0,
+                       'timeouts': 0}
+        self._executor = None
+        if workers:
+            self._executor = ThreadPoolExecutor(workers,
+                                                thread_name_prefix='DB')
+
+        # Fristen der laufenden Aufrufe als Heap (Frist, Nummer, Future)
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._watchdog_wakeup = threading.Condition(self._lock)
+        self._stopped = False
+        self._watchdog = None
+        if workers and timeout:
+            self._watchdog = threading.Thread(target=self._watch_deadlines,
+                                              name='DB-Watchdog', daemon=True)
+            self._watchdog.start()
+
+    @property
+    def inline(self):
+        """Whether the methods are executed in the calling thread"""
+        return self._executor is None
+
+    def submit(self, method, *args, timeout=None, **kwargs):
+        """Runs a method of the DB
+
+        If the method itself returns a future (like the write methods), the
+        returned future is done once that future is done.
+
+        :param method: Name of the DB method
+        :param timeout: Deadline in seconds (0 for none), defaults to the
+        timeout of the facade
+        :param args: Positional arguments for the method
+        :param kwargs: Keyword arguments for the method
+        :return: Future with the result of the method
+        """
+        function = getattr(self.db, method)
+        future = _Call()
+        with self._lock:
+            self._stats['submitted'] += 1
+
+        if self.inline:
+            self._run(future, function, args, kwargs)
+            return future
+
+        with self._lock:
+            self._stats['queued'] += 1
+            self._stats['max_queued'] = max(self._stats['max_queued'],
+                                            self._stats['queued'])
+            timeout = timeout if timeout is not None else self.timeout
+            if timeout:
+                heapq.heappush(self._deadlines,
+                               (time.monotonic() + timeout,
+                                next(self._sequence), future))
+                self._watchdog_wakeup.notify()
+        context = contextvars.copy_context()
+        self._executor.submit(context.run, self._start, future, function,
+                              args, kwargs)
+        return future
+
+    def call(self, method, *args, timeout=None, **kwargs):
+        """Runs a method of the DB and waits for its result
+
+        :param method: Name of the DB method
+        :param timeout: Deadline in seconds (0 for none), defaults to the
+        timeout of the facade
+        :return: Result of the method
+        """
+        return self.submit(method, *args, timeout=timeout, **kwargs).result()
+
+    def stats(self):
+        """Returns the counters of the facade
+
+        :return: dict with the number of workers, submitted, queued (also the
+        maximum), running, completed and failed calls and timeouts
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def shutdown(self):
+        """Waits for all submitted calls and stops the threads"""
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        with self._lock:
+            self._stopped = True
+            self._watchdog_wakeup.notify()
+        if self._watchdog:
+            self._watchdog.join()
+
+    def _start(self, future, function, args, kwargs):
+        """Starts a queued call unless its deadline already passed
+
+        :param future: Future of the call
+        :param function: DB method to be called
+        :param args: Positional arguments for the method
+        :param kwargs: Keyword arguments for the method
+        """
+        with self._lock:
+            self._stats['queued'] -= 1
+        if future.claimed:
+            return
+        self._run(future, function, args, kwargs)
+
+    def _run(self, future, function, args, kwargs):
+        """Executes a call and sets its result
+
+        :param future: Future of the call
+        :param function: DB method to be called
+        :param args: Positional arguments for the method
+        :param kwargs: Keyword arguments for the method
+        """
+        with self._lock:
+            self._stats['running'] += 1
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            self._settle(future, error=e)
+        else:
+            if isinstance(result, Future):
+                # Auf das Ende des Schreibzugriffs warten, ohne zu blockieren
+                result.add_done_callback(
+                    lambda write: self._settle_from(future, write))
+            else:
+                self._settle(future, result=result)
+        finally:
+            with self._lock:
+                self._stats['running'] -= 1
+
+    def _settle(self, future, result=None, error=None):
+        """Sets the result of a call, if it didn't time out yet
+
+        :param future: Future of the call
+        :param result: Result of the method
+        :param error: Exception raised by the method
+        """
+        if not self._claim(future):
+            return
+        with self._lock:
+            if error:
+                self._stats['failed'] += 1
+            else:
+                self._stats['completed'] += 1
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _claim(self, future):
+        """Reserves setting the result of a call for the caller
+
+        Only the first caller gets the call, so a late result and a timeout
+        never both try to set it.
+
+        :param future: Future of the call
+        :return: True if the caller has to set the result
+        """
+        with self._lock:
+            if future.claimed:
+                return False
+            future.claimed = True
+            return True
+
+    def _settle_from(self, future, write):
+        """Sets the result of a call from the future of a write
+
+        :param future: Future of the call
+        :param write: Done future returned by the DB method
+        """
+        if write.exception():
+            self._settle(future, error=write.exception())
+        else:
+            self._settle(future, result=write.result())
+
+    def _watch_deadlines(self):
+        """Fails all calls whose deadline passed"""
+        while True:
+            expired = []
+            with self._lock:
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    expired.append(heapq.heappop(self._deadlines)[2])
+                if not expired:
+                    if self._deadlines:
+                        self._watchdog_wakeup.wait(
+                            self._deadlines[0][0] - now)
+                    else:
+                        self._watchdog_wakeup.wait()
+                    continue
+
+            # Die Callbacks der Futures außerhalb der Sperre ausführen
+            for future in expired:
+                if self._claim(future):
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    future.set_exception(
+                        TimeoutError('Database call timed out'))
@@ -0,0 +1,354 @@
+import codecs
+import csv
+import datetime
+import itertools
+import re
+
+# Mögliche Spaltennamen (klein geschrieben) in Tabellen und Kontoauszügen
+COLUMNS = {'date': ('datum', 'date', 'buchungstag', 'buchungsdatum',
+                    'valuta', 'wertstellung'),
+           'value': ('betrag', 'value', 'amount', 'umsatz', 'betrag (eur)',
+                     'betrag (€)'),
+           'tag': ('kategorie', 'tag', 'category'),
+           'comment': ('kommentar', 'comment', 'verwendungszweck',
+                       'beschreibung', 'buchungstext', 'description', 'notiz')}
+
+# Anzahl Zeilen, in denen die Kopfzeile gesucht wird
+HEADER_SEARCH_LINES = 30
+
+# Erkannte Datumsformate: 2021-12-31, 2021/12/31, 31.12.2021, 31.12.21 und
+# 31/12/2021 (strptime wäre bei großen Dateien deutlich langsamer)
+ISO_DATE = re.compile(r'^(\d{4})[-/](\d{1,2})[-/](\d{1,2})$')
+GERMAN_DATE = re.compile(r'^(\d{1,2})[./](\d{1,2})[./](\d{4}|\d{2})$')
+
+# Betrag ohne Tausendertrennzeichen, z.B. -12,50 € (häufigster Fall)
+SIMPLE_VALUE = re.compile(r'^([+-]?\d+)(?:[.,](\d{1,2}))?\s*(?:€|EUR)?$')
+
+# Betrag nach Entfernen von Vorzeichen, Währung und Tausendertrennzeichen
+AMOUNT = re.compile(r'^\d+(\.\d{1,2})?$')
+
+# Anzahl unterschiedlicher Datumsangaben, die pro Import zwischengespeichert
+# werden
+DATE_CACHE_SIZE = 10000
+
+
+class InvalidFileError(ValueError):
+    """Raised if a file can't be imported at all"""
+
+
+class ImportReport:
+    """Result of an import
+
+    Only the first max_errors bad rows are kept with their reason, all
+    others are just counted.
+    """
+
+    def __init__(self, max_errors=20):
+        self.imported = 0
+        self.bad = 0
+        self.errors = []
+        self.max_errors = max_errors
+
+    def add_error(self, line, reason):
+        """Counts a bad row
+
+        :param line: Line number in the file
+        :param reason: Why the row was skipped
+        """
+        self.bad += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((line, reason))
+
+    def summary(self):
+        """Returns a message for the user
+
+        :return: String with the numbers and the first bad rows
+        """
+        answer = '{} Einträge importiert, {} fehlerhafte Zeilen'.format(
+            self.imported, self.bad)
+        if self.errors:
+            answer += ':\n' + '\n'.join('Zeile {}: {}'.format(line, reason)
+                                        for line, reason in self.errors)
+            if self.bad > len(self.errors):
+                answer += '\n...'
+        return answer
+
+
+def parse_value(text):
+    """Converts a value like '1.234,56 €' or '-12.50' to a float
+
+    The last separator is the decimal separator, unless it is followed by
+    exactly three digits or used several times (thousands separator).
+
+    :param text: Value as written in the file
+    :return: float or None if the value is invalid
+    """
+    match = SIMPLE_VALUE.match(text.strip())
+    if match:
+        integer, cents = match.groups()
+        return float(integer + '.' + (cents or '0'))
+
+    text = re.sub(r"\s|€|EUR|'", '', text)
+    sign = -1 if text.startswith('-') else 1
+    text = text.lstrip('+-')
+    separators = [char for char in text if char in '.,']
+    if separators:
+        last = separators[-1]
+        decimals = len(text) - text.rindex(last) - 1
+        if separators.count(last) == len(separators) \
+                and (len(separators) > 1 or decimals == 3):
+            text = text.replace(last, '')
+        else:
+            thousands = ',' if last == '.' else '.'
+            text = text.replace(thousands, '').replace(last, '.')
+    if not AMOUNT.match(text):
+        return None
+    return sign * float(text)
+
+
+def parse_date(text):
+    """Converts a date like 31.12.2021 or 2021-12-31 to the database format
+
+    Dates in the future are invalid, like in the manual entry.
+
+    :param text: Date as written in the file
+    :return: Date string YYYY-MM-DD or None if the date is invalid
+    """
+    text = text.strip()
+    match = ISO_DATE.match(text)
+    if match:
+        y, m, d = match.groups()
+    else:
+        match = GERMAN_DATE.match(text)
+        if not match:
+            return None
+        d, m, y = match.groups()
+        if len(y) == 2:
+            y = '20' + y
+    try:
+        date = datetime.date(int(y), int(m), int(d))
+    except ValueError:
+        return None
+    if date > datetime.date.today():
+        return None
+    return date.isoformat()
+
+
+def find_columns(header):
+    """Finds the columns of the values in the header row
+
+    :param header: List of column names
+    :return: dict with the keys of COLUMNS and the column indexes
+    """
+    names = [name.strip().lower() for name in header]
+    columns = {}
+    for key, candidates in COLUMNS.items():
+        for candidate in candidates:
+            if candidate in names:
+                columns[key] = names.index(candidate)
+                break
+    return columns
+
+
+def read_rows(lines, report, tag='Import', invert=False, delimiter=None):
+    """Parses CSV lines lazily to rows for DB.add_entries
+
+    The header has to name at least the date and value columns (see
+    COLUMNS). Bank statements often start with some lines about the account,
+    so the header is searched in the first HEADER_SEARCH_LINES lines.
+    Without a tag column all entries get the given tag. Invalid rows are
+    added to the report and skipped.
+
+    :param lines: Iterable of text lines, e.g. an open file
+    :param report: ImportReport for counting imported and bad rows
+    :param tag: Tag for rows without a tag
+    :param invert: Whether to invert the sign of the values (bank
+    statements list spendings as negative values)
+    :param delimiter: Column delimiter, detected from the header by default
+    :return: Generator of tuples (tag, value, date, comment)
+    """
+    lines = iter(lines)
+    for number, line in enumerate(
+            itertools.islice(lines, HEADER_SEARCH_LINES), 1):
+        # Das häufigste Trennzeichen der Zeile verwenden
+        line_delimiter = delimiter or max(';,\t|', key=line.count)
+        header = next(csv.reader([line], delimiter=line_delimiter), [])
+        columns = find_columns(header)
+        if 'date' in columns and 'value' in columns:
+            return _rows(lines, number, columns, report, tag, invert,
+                         line_delimiter)
+    raise InvalidFileError('Spalten für Datum und Betrag nicht gefunden')
+
+
+def _rows(lines, header_line, columns, report, tag, invert, delimiter):
+    """Generator of read_rows, runs after the header has been found"""
+    width = max(columns.values()) + 1
+    # Kontoauszüge enthalten viele Einträge pro Tag
+    dates = {}
+    reader = csv.reader(lines, delimiter=delimiter)
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            # z.B. Nullbytes oder zu lange Felder, nur die Zeile überspringen
+            report.add_error(header_line + reader.line_num,
+                             'Ungültige Zeile ({})'.format(e))
+            continue
+        number = header_line + reader.line_num
+        if not ''.join(row).strip():
+            continue
+        if len(row) < width:
+            report.add_error(number, 'Zu wenige Spalten')
+            continue
+        date = dates.get(row[columns['date']])
+        if date is None:
+            date = parse_date(row[columns['date']])
+            if len(dates) >= DATE_CACHE_SIZE:
+                dates.clear()
+            dates[row[columns['date']]] = date
+        if date is None:
+            report.add_error(number, 'Ungültiges Datum "{}"'.format(
+                row[columns['date']]))
+            continue
+        value = parse_value(row[columns['value']])
+        if value is None:
+            report.add_error(number, 'Ungültiger Betrag "{}"'.format(
+                row[columns['value']]))
+            continue
+        if invert:
+            value = -value
+        row_tag = tag
+        if 'tag' in columns:
+            row_tag = row[columns['tag']].strip() or tag
+        # Der Tag 'Alle' ist ungültig, wie bei der manuellen Eingabe
+        if row_tag == 'Alle':
+            report.add_error(number, 'Kategorie "Alle" ist nicht erlaubt')
+            continue
+        comment = None
+        if 'comment' in columns:
+            comment = row[columns['comment']].strip() or None
+        report.imported += 1
+        yield row_tag, value, date, comment
+
+
+class DecodedLines:
+    """Lines of a binary file, each decoded on its own
+
+    Lines that can't be decoded with the encoding of the file are decoded as
+    cp1252, so a file only detected as UTF-8 by its beginning can still be
+    read completely. Lines that can't be decoded at all are added to the
+    report and read as empty lines, which read_rows skips.
+    """
+
+    def __init__(self, path, encoding, report=None):
+        """
+        :param path: Path of the file
+        :param encoding: Encoding of the file
+        :param report: ImportReport for lines that can't be decoded
+        """
+        self.encoding = encoding
+        self.report = report
+        self._file = open(path, 'rb')
+
+    def __iter__(self):
+        for number, line in enumerate(self._file, 1):
+            try:
+                yield line.decode(self.encoding)
+            except UnicodeDecodeError:
+                try:
+                    yield line.decode('cp1252')
+                except UnicodeDecodeError:
+                    if self.report:
+                        self.report.add_error(number, 'Ungültige Zeichen')
+                    yield '\n'
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_csv(path, encoding=None, report=None):
+    """Opens a CSV file with the encoding used by the bank or spreadsheet
+
+    UTF-8 (with or without BOM) is tried first, otherwise the file is read
+    as cp1252, which many German banks use. Single lines in another
+    encoding don't abort the import (see DecodedLines).
+
+    :param path: Path of the file
+    :param encoding: Encoding of the file, detected by default
+    :param report: ImportReport for lines that can't be decoded
+    :return: DecodedLines of the file
+    """
+    if encoding is None:
+        encoding = 'utf-8-sig'
+        with open(path, 'rb') as file:
+            try:
+                # Nur den Anfang prüfen, die Datei wird später gestreamt
+                codecs.getincrementaldecoder('utf-8')().decode(
+                    file.read(1 << 16), final=False)
+            except UnicodeDecodeError:
+                encoding = 'cp1252'
+    return DecodedLines(path, encoding, report)
+
+
+def import_file(db, chat_id, path, tag='Import', invert=False,
+                delimiter=None, encoding=None):
+    """Imports all entries of a CSV file
+
+    :param db: DB the entries are added to
+    :param chat_id: Telegram chat_id of the user
+    :param path: Path of the CSV file
+    :param tag: Tag for rows without a tag
+    :param invert: Whether to invert the sign of the values
+    :param delimiter: Column delimiter, detected by default
+    :param encoding: Encoding of the file, detected by default
+    :return: ImportReport of the import
+    """
+    report = ImportReport()
+    with open_csv(path, encoding, report) as file:
+        rows = read_rows(file, report, tag, invert, delimiter)
+        db.add_entries(chat_id, rows).result()
+    return report
+
+
+def main():
+    import argparse
+    import time
+    from DB import DB
+
+    parser = argparse.ArgumentParser(
+        description='Einträge aus einer CSV-Datei importieren')
+    parser.add_argument('db', help='Datenbankdatei, z.B. SpendingCalcData.db')
+    parser.add_argument('chat_id', type=int, help='Chat-ID des Nutzers')
+    parser.add_argument('file', help='CSV-Datei mit Kopfzeile')
+    parser.add_argument('--tag', default='Import',
+                        help='Kategorie für Zeilen ohne Kategorie')
+    parser.add_argument('--invert', action='store_true',
+                        help='Vorzeichen umkehren (Ausgaben im Kontoauszug '
+                             'sind negativ)')
+    parser.add_argument('--delimiter', help='Trennzeichen der Spalten')
+    parser.add_argument('--encoding', help='Zeichenkodierung der Datei')
+    args = parser.parse_args()
+
+    db = DB(args.db)
+    start = time.perf_counter()
+    try:
+        report = import_file(db, args.chat_id, args.file, args.tag,
+                             args.invert, args.delimiter, args.encoding)
+    except InvalidFileError as e:
+        parser.exit(1, 'Import fehlgeschlagen: {}\n'.format(e))
+    finally:
+        db.close()
+    print(report.summary())
+    print('Dauer: {:.2f}s'.format(time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
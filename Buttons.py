@@ -0,0 +1,183 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import Handler
+import re
+
+# Telegram erlaubt höchstens 64 Bytes Callback-Daten pro Inline-Button
+CALLBACK_DATA_LIMIT = 64
+
+
+def callback_data(action, *fields):
+    """Encodes the callback data of an inline button
+
+    The data holds everything needed to handle the button, e.g.
+    'l|30day|2|2021-03-01|17|Essen', so no state has to be looked up when it
+    is pressed.
+
+    :param action: Single character selecting the callback (see
+    CallbackHandler)
+    :param fields: Further values, converted with str
+    :return: The callback data or None if it is longer than
+    CALLBACK_DATA_LIMIT bytes or a field contains the separator '|'
+    """
+    fields = [str(field) for field in fields]
+    if any('|' in field for field in fields):
+        return None
+    data = '|'.join([action] + fields)
+    if len(data.encode()) > CALLBACK_DATA_LIMIT:
+        return None
+    return data
+
+
+def inline_keyboard(rows):
+    """Creates an inline keyboard
+
+    Buttons without callback data (see callback_data) and empty rows are
+    left out.
+
+    :param rows: List of rows, each a list of tuples (label, callback data)
+    :return: InlineKeyboardMarkup
+    """
+    keyboard = []
+    for row in rows:
+        row = [InlineKeyboardButton(label, callback_data=data)
+               for label, data in row if data]
+        if row:
+            keyboard.append(row)
+    return InlineKeyboardMarkup(keyboard)
+
+
+class ButtonHandler(Handler):
+    """Handler choosing the callback of a text message of one state
+
+    Most messages are labels of the keyboard buttons, they are resolved with
+    a single dict lookup. Only other texts are matched against the patterns
+    in order, e.g. for entered amounts and dates, and if none matches the
+    fallback is used.
+    """
+
+    def __init__(self, buttons=None, patterns=(), fallback=None,
+                 run_async=False):
+        """
+        :param buttons: dict with the labels of the buttons and their
+        callbacks
+        :param patterns: List of tuples (pattern, callback), the patterns
+        have to match the whole text
+        :param fallback: Callback for all other texts, None ignores them
+        :param run_async: Whether the callbacks run in the worker pool of the
+        dispatcher
+        """
+        super().__init__(None, run_async=run_async)
+        self.buttons = dict(buttons or {})
+        self.patterns = [(re.compile(pattern), callback)
+                         for pattern, callback in patterns]
+        self.fallback = fallback
+
+    def check_update(self, update):
+        """Returns the callback for the text of a message
+
+        :param update: Update to be handled
+        :return: Callback or None if the update isn't handled
+        """
+        if not isinstance(update, Update) or not update.message:
+            return None
+        text = update.message.text
+        if text is None:
+            return None
+        callback = self.buttons.get(text)
+        if callback is not None:
+            return callback
+        for pattern, callback in self.patterns:
+            if pattern.match(text):
+                return callback
+        return self.fallback
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        """Calls the callback returned by check_update
+
+        :return: Return value of the callback, the new state
+        """
+        if self.run_async:
+            return dispatcher.run_async(check_result, update, context,
+                                        update=update)
+        return check_result(update, context)
+
+    def replace_callbacks(self, function):
+        """Replaces every callback, e.g. to measure them
+
+        :param function: Function getting a callback and returning its
+        replacement, called once per distinct callback
+        """
+        replaced = {}
+
+        def replace(callback):
+            if callback not in replaced:
+                replaced[callback] = function(callback)
+            return replaced[callback]
+
+        self.buttons = {label: replace(callback)
+                        for label, callback in self.buttons.items()}
+        self.patterns = [(pattern, replace(callback))
+                         for pattern, callback in self.patterns]
+        if self.fallback is not None:
+            self.fallback = replace(self.fallback)
+
+
+class CallbackHandler(Handler):
+    """Handler choosing the callback of a pressed inline button
+
+    The action, the first field of the callback data (see callback_data),
+    is resolved with a single dict lookup. The remaining fields are passed
+    in context.args. Every callback query is answered before the callback
+    runs, so the client stops showing the progress right away.
+    """
+
+    def __init__(self, actions, run_async=False):
+        """
+        :param actions: dict with the actions and their callbacks
+        :param run_async: Whether the callbacks run in the worker pool of the
+        dispatcher
+        """
+        super().__init__(None, run_async=run_async)
+        self.actions = dict(actions)
+
+    def check_update(self, update):
+        """Returns the callback and the fields of the pressed button
+
+        :param update: Update to be handled
+        :return: Tuple (callback, fields) or None if the update isn't handled
+        """
+        if not isinstance(update, Update) or not update.callback_query:
+            return None
+        data = update.callback_query.data
+        if not data:
+            return None
+        action, *fields = data.split('|')
+        callback = self.actions.get(action)
+        if callback is None:
+            return None
+        return callback, fields
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        """Answers the callback query and calls the callback
+
+        :return: Return value of the callback
+        """
+        callback, fields = check_result
+        update.callback_query.answer()
+        context.args = fields
+        if self.run_async:
+            return dispatcher.run_async(callback, update, context,
+                                        update=update)
+        return callback(update, context)
+
+    def replace_callbacks(self, function):
+        """Replaces every callback, e.g. to measure them
+
+        :param function: Function getting a callback and returning its
+        replacement, called once per distinct callback
+        """
+        replaced = {}
+        for action, callback in self.actions.items():
+            if callback not in replaced:
+                replaced[callback] = function(callback)
+            self.actions[action] = replaced[callback]
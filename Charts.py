@@ -0,0 +1,321 @@
+from telegram.error import BadRequest
+from collections import defaultdict
+from DB import LRUCache
+from Outbound import wait_sent
+import hashlib
+import io
+import json
+import os
+import threading
+
+# Wird mit in den Schlüssel gerechnet, damit sich Änderungen am Aussehen auch
+# auf bereits gespeicherte Diagramme auswirken
+CHART_VERSION = 1
+
+# Höchstzahl Kategorien im Kreisdiagramm, die übrigen werden zusammengefasst
+PIE_TAGS = 8
+
+# Höchstzahl beschrifteter Monate, bei mehr Monaten wird nur jeder n-te
+# beschriftet
+MONTH_LABELS = 12
+
+# Matplotlib ist nur eingeschränkt threadsicher
+_render_lock = threading.Lock()
+
+
+def chart_key(title, rows, show_tags):
+    """Returns the key of a chart derived from its content
+
+    Equal data always results in the same key, so a chart is only rendered
+    again when the data of the chat changed.
+
+    :param title: Title of the chart
+    :param rows: List of tuples (month, tag, sum) like returned by
+    DB.get_monthly_sums
+    :param show_tags: Whether a pie chart of the tags is included
+    :return: Hex digest of the content
+    """
+    content = json.dumps([CHART_VERSION, title, show_tags, rows])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def render(title, rows, show_tags):
+    """Renders a bar chart of the monthly sums as PNG
+
+    :param title: Title of the chart
+    :param rows: List of tuples (month, tag, sum) like returned by
+    DB.get_monthly_sums
+    :param show_tags: Whether to add a pie chart of the sums per tag
+    :return: bytes of the PNG image
+    """
+    months = defaultdict(float)
+    tags = defaultdict(float)
+    for month, tag, total in rows:
+        months[month] += total
+        tags[tag] += total
+    # Monate ohne Einträge als leere Balken anzeigen
+    labels = []
+    if months:
+        first, last = min(months), max(months)
+        year, month = int(first[:4]), int(first[5:])
+        while not labels or labels[-1] < last:
+            labels.append('{:04d}-{:02d}'.format(year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    totals = [months.get(month, 0) for month in labels]
+
+    # Matplotlib erst bei Bedarf laden, das beschleunigt den Start
+    from matplotlib.figure import Figure
+
+    with _render_lock:
+        figure = Figure(figsize=(10, 5) if show_tags else (6, 5), dpi=100)
+        if show_tags:
+            pie_axes, bar_axes = figure.subplots(1, 2)
+            # Einnahmen (negative Summen) lassen sich nicht darstellen
+            spendings = sorted(((total, tag) for tag, total in tags.items()
+                                if total > 0), reverse=True)
+            if len(spendings) > PIE_TAGS:
+                rest = sum(total for total, _ in spendings[PIE_TAGS - 1:])
+                spendings = spendings[:PIE_TAGS - 1] + [(rest, 'Sonstige')]
+            if spendings:
+                pie_axes.pie([total for total, _ in spendings],
+                             labels=[tag for _, tag in spendings],
+                             autopct='%1.0f%%', startangle=90,
+                             counterclock=False)
+            pie_axes.set_title('Kategorien')
+            pie_axes.axis('equal')
+        else:
+            bar_axes = figure.subplots()
+
+        positions = range(len(labels))
+        bar_axes.bar(positions, totals)
+        step = -(-len(labels) // MONTH_LABELS)
+        bar_axes.set_xticks(positions[::step])
+        bar_axes.set_xticklabels(['{}.{}'.format(month[5:], month[:4])
+                                  for month in labels[::step]],
+                                 rotation=45, ha='right')
+        bar_axes.set_ylabel('€')
+        bar_axes.set_title('Monate')
+        figure.suptitle(title)
+        figure.tight_layout()
+
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+class ChartCache:
+    """Bounded cache of rendered charts and their Telegram file_ids
+
+    The images are kept in memory and optionally in a directory, named by
+    their key. Once a chart has been sent, the file_id of the uploaded photo
+    is stored as well, so sending it again needs neither rendering nor
+    uploading the image.
+    The key is derived from the content, so it can only be computed after
+    the query. A view (e.g. chat, tag, period bounds and data version of the
+    chat) can be mapped to the key of its chart, then send_view sends the
+    chart again without the query. Views only live in memory, as the data
+    versions are only valid within the process.
+    """
+
+    def __init__(self, max_images=64, directory=None, max_files=1000):
+        self.directory = directory
+        self.max_files = max_files
+        self.renders = 0
+        self.uploads = 0
+        self.reuses = 0
+        self.view_hits = 0
+        # file_ids sind klein, von ihnen werden mehr behalten
+        self._images = LRUCache(max_images)
+        self._file_ids = LRUCache(max_images * 16)
+        self._views = LRUCache(max_images * 16)
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def get_file_id(self, key):
+        """Returns the file_id of a chart that has already been sent
+
+        :param key: Key of the chart
+        :return: file_id or None
+        """
+        file_id = self._file_ids.get(key)
+        if file_id is None and self.directory:
+            try:
+                with open(self._path(key, '.id')) as file:
+                    file_id = file.read().strip() or None
+            except OSError:
+                return None
+            # Vergessene file_ids (leere Dateien) nicht zwischenspeichern
+            if file_id:
+                self._file_ids.put(key, file_id)
+        return file_id
+
+    def put_file_id(self, key, file_id):
+        """Stores the file_id of a sent chart
+
+        :param key: Key of the chart
+        :param file_id: file_id of the uploaded photo or None to forget it
+        """
+        if file_id is None:
+            self._file_ids.invalidate(key)
+        else:
+            self._file_ids.put(key, file_id)
+        if self.directory:
+            self._write(self._path(key, '.id'), (file_id or '').encode())
+
+    def get_image(self, key):
+        """Returns the PNG of a rendered chart
+
+        :param key: Key of the chart
+        :return: bytes of the image or None
+        """
+        image = self._images.get(key)
+        if image is None and self.directory:
+            try:
+                with open(self._path(key, '.png'), 'rb') as file:
+                    image = file.read()
+                # Zuletzt genutzte Diagramme werden zuletzt entfernt
+                os.utime(self._path(key, '.png'))
+            except OSError:
+                return None
+            self._images.put(key, image)
+        return image
+
+    def put_image(self, key, image):
+        """Stores the PNG of a rendered chart
+
+        :param key: Key of the chart
+        :param image: bytes of the image
+        """
+        self._images.put(key, image)
+        if self.directory:
+            self._write(self._path(key, '.png'), image)
+            self._prune()
+
+    def _write(self, path, content):
+        """Replaces a file atomically
+
+        :param path: Path of the file
+        :param content: bytes to be written
+        """
+        # Mehrere Worker-Prozesse können dasselbe Verzeichnis nutzen
+        temporary = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                          threading.get_ident())
+        with open(temporary, 'wb') as file:
+            file.write(content)
+        os.replace(temporary, path)
+
+    def _prune(self):
+        """Removes the oldest images (and file_ids) above max_files"""
+        with self._lock:
+            images = [entry for entry in os.scandir(self.directory)
+                      if entry.name.endswith('.png')]
+            if len(images) <= self.max_files:
+                return
+            images.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in images[:len(images) - self.max_files]:
+                key = entry.name[:-len('.png')]
+                for extension in ('.png', '.id'):
+                    try:
+                        os.remove(self._path(key, extension))
+                    except OSError:
+                        pass
+
+    def send(self, message, title, rows, show_tags, view=None, **kwargs):
+        """Sends a chart as reply to a message
+
+        A chart that has been sent before is sent by its file_id. Otherwise
+        it is rendered, if it isn't cached either, and uploaded.
+
+        :param message: Message the chart replies to
+        :param title: Title of the chart
+        :param rows: List of tuples (month, tag, sum) like returned by
+        DB.get_monthly_sums
+        :param show_tags: Whether to add a pie chart of the sums per tag
+        :param view: Hashable view the rows were queried for (see send_view)
+        :param kwargs: Further arguments for reply_photo, e.g. reply_markup
+        """
+        key = chart_key(title, rows, show_tags)
+        if view is not None:
+            self._views.put(view, key)
+        if self._send_cached(message, key, **kwargs):
+            return
+
+        image = render(title, rows, show_tags)
+        self._count('renders')
+        self.put_image(key, image)
+        self._upload(message, key, image, **kwargs)
+
+    def send_view(self, message, view, **kwargs):
+        """Sends the chart of a view without querying its rows
+
+        :param message: Message the chart replies to
+        :param view: View passed to send before
+        :param kwargs: Further arguments for reply_photo, e.g. reply_markup
+        :return: False if the chart isn't cached, then it has to be sent
+        with send
+        """
+        key = self._views.get(view)
+        if key is None or not self._send_cached(message, key, **kwargs):
+            return False
+        self._count('view_hits')
+        return True
+
+    def _send_cached(self, message, key, **kwargs):
+        """Sends a chart by its file_id or its cached image
+
+        :param message: Message the chart replies to
+        :param key: Key of the chart
+        :param kwargs: Further arguments for reply_photo
+        :return: False if the chart is cached neither way
+        """
+        file_id = self.get_file_id(key)
+        if file_id:
+            try:
+                wait_sent(message.reply_photo(file_id, **kwargs))
+                self._count('reuses')
+                return True
+            except BadRequest:
+                # z.B. nach einem Wechsel des Bot-Tokens, neu hochladen
+                self.put_file_id(key, None)
+
+        image = self.get_image(key)
+        if image is None:
+            return False
+        self._upload(message, key, image, **kwargs)
+        return True
+
+    def _upload(self, message, key, image, **kwargs):
+        """Uploads the image of a chart and keeps its file_id
+
+        :param message: Message the chart replies to
+        :param key: Key of the chart
+        :param image: bytes of the PNG image
+        :param kwargs: Further arguments for reply_photo
+        """
+        sent = wait_sent(message.reply_photo(io.BytesIO(image), **kwargs))
+        self._count('uploads')
+        # Die größte Variante des Fotos wiederverwenden
+        self.put_file_id(key, sent.photo[-1].file_id)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        """Returns the counters of the cache
+
+        :return: dict with renders, uploads, reused file_ids, charts sent
+        without query and the hits of the image cache
+        """
+        images = self._images.stats()
+        return {'renders': self.renders,
+                'uploads': self.uploads,
+                'reuses': self.reuses,
+                'view_hits': self.view_hits,
+                'image_hits': images['hits'],
+                'image_misses': images['misses'],
+                'images': images['size']}
@@ -1,18 +1,353 @@
 import sqlite3
+import datetime
+import itertools
+import re
+import threading
+import time
+import queue
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+# Zeitraum im Format JJJJ-MM-TT..JJJJ-MM-TT (beide Seiten optional)
+DATE_RANGE = re.compile(r'^(\d{4}-\d{2}-\d{2})?\.\.(\d{4}-\d{2}-\d{2})?$')
+
+
+def _add_months(date, months):
+    """Returns the first day of the month the given number of months away
+
+    :param date: Date in the starting month
+    :param months: Number of months to move (may be negative)
+    :return: First day of the resulting month
+    """
+    month = date.year * 12 + date.month - 1 + months
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+
+def resolve_period(time_period, today=None):
+    """Resolves a time period to concrete date bounds
+
+    The bounds form the half-open interval [start, end) as ISO date strings,
+    so they can be compared directly to the Date column. A missing bound is
+    returned as None.
+
+    The possible time periods:  Bounds:
+    7day, 30day                 The last 7 or 30 days including today
+    month, year                 This month or this year
+    quarter                     This quarter
+    last_month, last_quarter,   The previous month, quarter or year
+    last_year
+    all (or None)               No bounds
+    2025-03-01..2025-06-30      Custom range, both days included, either
+                                side may be left out
+
+    :param time_period: Time period to be resolved
+    :param today: Date the relative periods refer to, defaults to today
+    :return: Tuple (start, end) with ISO date strings or None
+    """
+    if not time_period or time_period == 'all':
+        return None, None
+    if today is None:
+        today = datetime.date.today()
+    period = time_period.strip().lower().replace(' ', '_')
+    tomorrow = today + datetime.timedelta(days=1)
+    quarter = _add_months(today, -((today.month - 1) % 3))
+
+    if period == '7day':
+        start, end = today - datetime.timedelta(days=7), tomorrow
+    elif period == '30day':
+        start, end = today - datetime.timedelta(days=30), tomorrow
+    elif period == 'month':
+        start, end = _add_months(today, 0), _add_months(today, 1)
+    elif period == 'quarter':
+        start, end = quarter, _add_months(quarter, 3)
+    elif period == 'year':
+        start, end = datetime.date(today.year, 1, 1), \
+            datetime.date(today.year + 1, 1, 1)
+    elif period == 'last_month':
+        start, end = _add_months(today, -1), _add_months(today, 0)
+    elif period == 'last_quarter':
+        start, end = _add_months(quarter, -3), quarter
+    elif period == 'last_year':
+        start, end = datetime.date(today.year - 1, 1, 1), \
+            datetime.date(today.year, 1, 1)
+    else:
+        match = DATE_RANGE.match(period)
+        if not match:
+            raise ValueError('Unknown time period: {}'.format(time_period))
+        first, last = match.groups()
+        start = datetime.date.fromisoformat(first) if first else None
+        end = datetime.date.fromisoformat(last) + datetime.timedelta(days=1) \
+            if last else None
+
+    return (start.isoformat() if start else None,
+            end.isoformat() if end else None)
+
+
+# Analyseabfragen, {where} wird durch die Filter ersetzt. Pro Abfrage:
+# Tabelle und Datumsspalte der Filter und der SQL-Text
+QUERY_TEMPLATES = {
+    'sum': ('DailySum', 'Day', '''
+        SELECT Tags.Tag, SUM(Total)
+        FROM DailySum
+        JOIN Tags
+        ON DailySum.TagID = T_ID
+        {where}
+        GROUP BY DailySum.TagID
+        '''),
+    'entries': ('Entry', 'Date', '''
+        SELECT E_ID, Value, Tags.Tag, Date, Comment
+        FROM Entry
+        JOIN Tags
+        ON Entry.Tag = T_ID
+        {where}
+        ORDER BY Entry.Date DESC, E_ID DESC
+        '''),
+    'page': ('Entry', 'Date', '''
+        SELECT E_ID, Value, Tags.Tag, Date, Comment
+        FROM Entry
+        JOIN Tags
+        ON Entry.Tag = T_ID
+        {where}
+        ORDER BY Entry.Date DESC, E_ID DESC
+        LIMIT ?
+        '''),
+    # Zuerst auf das Datum begrenzen, damit der Index genutzt wird
+    'page_after': ('Entry', 'Date', '''
+        SELECT E_ID, Value, Tags.Tag, Date, Comment
+        FROM Entry
+        JOIN Tags
+        ON Entry.Tag = T_ID
+        {where}
+        AND Entry.Date <= ? AND (Entry.Date < ? OR E_ID < ?)
+        ORDER BY Entry.Date DESC, E_ID DESC
+        LIMIT ?
+        '''),
+    'chunk': ('Entry', 'Date', '''
+        SELECT E_ID, Value, Tags.Tag, Date, Comment
+        FROM Entry
+        JOIN Tags
+        ON Entry.Tag = T_ID
+        {where}
+        ORDER BY Entry.Date, E_ID
+        LIMIT ?
+        '''),
+    'chunk_after': ('Entry', 'Date', '''
+        SELECT E_ID, Value, Tags.Tag, Date, Comment
+        FROM Entry
+        JOIN Tags
+        ON Entry.Tag = T_ID
+        {where}
+        AND Entry.Date >= ? AND (Entry.Date > ? OR E_ID > ?)
+        ORDER BY Entry.Date, E_ID
+        LIMIT ?
+        '''),
+    'monthly': ('DailySum', 'Day', '''
+        SELECT substr(Day, 1, 7) AS Month, Tags.Tag, SUM(Total)
+        FROM DailySum
+        JOIN Tags
+        ON DailySum.TagID = T_ID
+        {where}
+        GROUP BY Month, DailySum.TagID
+        ORDER BY Month
+        '''),
+    # Nur die für Statistiken nötigen Spalten, ohne Sortierung
+    'columns': ('Entry', 'Date', '''
+        SELECT Date, Tags.Tag, Value
+        FROM Entry
+        JOIN Tags
+        ON Entry.Tag = T_ID
+        {where}
+        '''),
+}
+
+
+def build_queries(templates=QUERY_TEMPLATES):
+    """Builds the SQL of every query for every combination of filters
+
+    The filters are the tag and the start and end of the time period, so
+    each template results in eight statements. Since the text of a
+    statement only depends on which filters are used, it is built once and
+    the connections can keep all of them prepared.
+
+    :param templates: dict with the name and (table, date column, SQL) of
+    the queries
+    :return: dict with keys (name, tag, start, end) and the SQL, the filters
+    are given as booleans
+    """
+    queries = {}
+    for name, (table, column, command) in templates.items():
+        for tag, start, end in itertools.product((False, True), repeat=3):
+            where = 'WHERE {}.ChatID = ?'.format(table)
+            if tag:
+                where += ' AND Tags.Tag = ?'
+            if start:
+                where += ' AND {}.{} >= ?'.format(table, column)
+            if end:
+                where += ' AND {}.{} < ?'.format(table, column)
+            queries[(name, tag, start, end)] = command.format(where=where)
+    return queries
+
+
+QUERIES = build_queries()
+
+# Größe des Statement-Caches pro Verbindung: alle Analyseabfragen und
+# Reserve für die übrigen Abfragen und Schreibzugriffe
+STATEMENT_CACHE_SIZE = len(QUERIES) + 64
+
+
+class LRUCache:
+    """Thread-safe cache with a bounded size and least recently used eviction
+
+    Every change of a key through update or invalidate advances a generation
+    counter. A value loaded from the database is only stored by put, if no
+    change happened since the generation was read before loading, so a
+    concurrent write can never be overwritten by stale data.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value and marks it as recently used
+
+        :param key: Key of the value
+        :return: Cached value or None if the key isn't cached
+        """
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, generation=None):
+        """Stores a value and evicts the least recently used ones if needed
+
+        :param key: Key of the value
+        :param value: Value to be cached
+        :param generation: Generation read before loading the value, the value
+        is discarded if the cache was changed since then
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, key, function):
+        """Applies a change to a cached value (write-through)
+
+        :param key: Key of the value
+        :param function: Function returning the new value for the old one
+        """
+        with self._lock:
+            self.generation += 1
+            if key in self._items:
+                self._items[key] = function(self._items[key])
+
+    def invalidate(self, key):
+        """Removes a value from the cache
+
+        :param key: Key of the value
+        """
+        with self._lock:
+            self.generation += 1
+            self._items.pop(key, None)
+
+    def stats(self):
+        """Returns the counters of the cache
+
+        :return: dict with hits, misses, evictions and the current size
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self._items)}
 
 
 class DB:
-    def __init__(self, db_name):
+    # Schema-Migrationen in Reihenfolge, die Position entspricht der Version
+    MIGRATIONS = ('_migration_chat_indexes', '_migration_daily_sum')
+    # Anzahl Einträge, die pro Transaktion nachgetragen werden
+    BACKFILL_BATCH_SIZE = 5000
+    # Anzahl Einträge, die beim Import pro Transaktion eingefügt werden
+    IMPORT_BATCH_SIZE = 50000
+    # Anzahl Einträge, die beim Export pro Abfrage gelesen werden
+    EXPORT_CHUNK_SIZE = 5000
+    # Größere Ergebnisse werden nicht zwischengespeichert
+    RESULT_CACHE_MAX_ROWS = 10000
+
+    def __init__(self, db_name, tag_cache_size=1024, write_behind=False,
+                 group_size=64, group_delay=0.01, readers=0,
+                 result_cache_size=256):
         # Verbindung zur Datenbank herstellen
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.conn = sqlite3.connect(db_name, check_same_thread=False,
+                                    cached_statements=STATEMENT_CACHE_SIZE)
+        # Zwischenspeicher für die Tags der zuletzt aktiven Nutzer
+        self.tag_cache = LRUCache(tag_cache_size)
+        # Zwischenspeicher für Ergebnisse der Analyse, gültig solange sich
+        # die Datenversion des Nutzers nicht ändert
+        self.result_cache = LRUCache(result_cache_size)
+        self._versions = {}
+        self._min_version = 0
+        self._version_counter = itertools.count(1)
+        self._version_lock = threading.Lock()
         self.check_new_db()
+        if write_behind or readers:
+            # Lesen parallel zum Schreiben ist nur im WAL-Modus möglich
+            self.conn.execute('PRAGMA journal_mode=WAL')
+
+        # Schreibzugriffe entweder direkt oder gesammelt im Hintergrund
+        self.group_size = group_size
+        self.group_delay = group_delay
+        self._write_lock = threading.Lock()
+        self._write_queue = None
+        self._writer = None
+        self._closed = False
+        self._queue_lock = threading.Lock()
+        if write_behind:
+            self._write_queue = queue.Queue()
+            self._writer = threading.Thread(target=self._writer_loop,
+                                            args=(db_name,),
+                                            name='DB-Writer', daemon=True)
+            self._writer.start()
+
+        # Pool mit Verbindungen, die nur lesen
+        self._readers = None
+        self._pool_lock = threading.Lock()
+        self._pool_stats = {'readers': readers,
+                            'checkouts': 0,
+                            'waits': 0,
+                            'wait_time': 0.0,
+                            'max_wait': 0.0}
+        if readers:
+            uri = 'file:{}?mode=ro'.format(pathname2url(db_name))
+            self._readers = queue.Queue()
+            for _ in range(readers):
+                self._readers.put(sqlite3.connect(
+                    uri, uri=True, check_same_thread=False,
+                    cached_statements=STATEMENT_CACHE_SIZE))
 
     def check_new_db(self):
         """Initializes the database if a new database has been created
 
         When trying to connect to the database it will be created if it didn't
         already exist. If there are no tables yet, we want to initialize the
-        missing tables.
+        missing tables. Afterwards all outstanding schema migrations are
+        applied.
         """
         try:
             cursor = self.conn.cursor()
@@ -47,74 +382,562 @@ class DB:
                     '''
                 cursor.execute(command)
                 print('New Database created!')
+            self.migrate()
         except BaseException as e:
             raise e
 
-    def get_tags(self, chat_id):
-        """Return all the tags of a user
+    def migrate(self):
+        """Applies all schema migrations the database is still missing
 
-        :param chat_id: Telegram chat_id of the user
-        :return: List of tags of the user
+        The schema version is stored in PRAGMA user_version. Each migration in
+        MIGRATIONS raises the version by one and is committed on its own, so
+        an interrupted upgrade continues where it stopped.
         """
         try:
             cursor = self.conn.cursor()
-            command = '''
-                SELECT Tag
-                FROM Tags
-                WHERE ChatID = ?
-                '''
-            cursor.execute(command, (chat_id,))
-            fetch = cursor.fetchall()
-            tags = []
-            for tag in fetch:
-                tags.append(tag[0])
-            return tags
+            cursor.execute('PRAGMA user_version')
+            version = cursor.fetchone()[0]
+            for number, migration in enumerate(self.MIGRATIONS, start=1):
+                if number <= version:
+                    continue
+                getattr(self, migration)(cursor)
+                cursor.execute('PRAGMA user_version = {:d}'.format(number))
+                self.conn.commit()
+                print('Database migrated to version {}!'.format(number))
         except BaseException as e:
+            self.conn.rollback()
             raise e
 
-    def add_tag(self, chat_id, tag):
-        """Adds a tag to a user
+    def close(self):
+        """Closes all database connections
+
+        With write-behind enabled all queued writes are committed before the
+        writer thread stops. Writes started afterwards raise a RuntimeError.
+        """
+        # Nach dem Ende-Signal wird nichts mehr eingereiht (siehe _write)
+        with self._queue_lock:
+            self._closed = True
+            if self._writer:
+                self._write_queue.put(None)
+        if self._writer:
+            self._writer.join()
+        if self._readers:
+            for _ in range(self._pool_stats['readers']):
+                self._readers.get().close()
+        # Laufende direkte Schreibzugriffe noch abschließen
+        with self._write_lock:
+            self.conn.close()
+
+    @contextmanager
+    def _reader(self):
+        """Provides a cursor for read queries
+
+        If a pool of read-only connections exists, a connection is checked out
+        for the duration of the block and returned afterwards. Otherwise the
+        shared connection is used.
+
+        :return: Cursor for the queries
+        """
+        if self._readers is None:
+            with self._write_lock:
+                yield self.conn.cursor()
+            return
+
+        waited = 0.0
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            # Alle Verbindungen belegt, auf eine freie warten
+            start = time.monotonic()
+            conn = self._readers.get()
+            waited = time.monotonic() - start
+        with self._pool_lock:
+            self._pool_stats['checkouts'] += 1
+            if waited:
+                self._pool_stats['waits'] += 1
+                self._pool_stats['wait_time'] += waited
+                self._pool_stats['max_wait'] = max(
+                    self._pool_stats['max_wait'], waited)
+        try:
+            yield conn.cursor()
+        finally:
+            self._readers.put(conn)
+
+    def pool_stats(self):
+        """Returns the counters of the connection pool
+
+        :return: dict with the pool size, the number of idle connections,
+        checkouts, checkouts that had to wait and the total and maximum wait
+        time in seconds
+        """
+        with self._pool_lock:
+            stats = dict(self._pool_stats)
+        stats['idle'] = self._readers.qsize() if self._readers else 0
+        return stats
+
+    def data_version(self, chat_id):
+        """Returns the version of the data of a user
+
+        The version increases after every committed change of the entries of
+        the user, so results read at the same version are still valid.
 
         :param chat_id: Telegram chat_id of the user
-        :param tag: Tag that should be added
+        :return: Version number
         """
+        with self._version_lock:
+            return max(self._versions.get(chat_id, 0), self._min_version)
+
+    def _bump_version(self, chat_id=None):
+        """Increases the data version of a user after a commit
+
+        Has to be called after the commit, otherwise a result read before the
+        commit could be cached for the new version.
+
+        :param chat_id: Telegram chat_id of the user, None for all users
+        """
+        with self._version_lock:
+            version = next(self._version_counter)
+            if chat_id is None:
+                self._min_version = version
+            else:
+                self._versions[chat_id] = version
+
+    def _write(self, mutation, *args):
+        """Executes a mutation in a transaction
+
+        The mutation gets a cursor and the given arguments and may return a
+        function, that is called once the changes are committed.
+        Without write-behind the mutation is committed directly and errors are
+        raised. Otherwise it is queued for the writer thread and errors are
+        set on the returned future.
+
+        :param mutation: Function executing the statements of the mutation
+        :param args: Arguments for the mutation
+        :return: Future which is done when the mutation is committed
+        """
+        future = Future()
+        if self._write_queue is not None:
+            # Prüfen und Einreihen gemeinsam, sonst könnte ein Schreibzugriff
+            # hinter dem Ende-Signal landen und nie abgeschlossen werden
+            with self._queue_lock:
+                if self._closed:
+                    raise RuntimeError('Database is already closed')
+                self._write_queue.put((mutation, args, future))
+            return future
+
+        with self._write_lock:
+            if self._closed:
+                raise RuntimeError('Database is already closed')
+            try:
+                on_commit = mutation(self.conn.cursor(), *args)
+                self.conn.commit()
+            except BaseException as e:
+                self.conn.rollback()
+                raise e
+        if on_commit:
+            on_commit()
+        future.set_result(None)
+        return future
+
+    def _writer_loop(self, db_name):
+        """Commits the queued mutations in groups until the queue is closed
+
+        A group is committed once group_size mutations are collected or
+        group_delay seconds have passed since its first mutation.
+
+        :param db_name: Name of the database file
+        """
+        conn = sqlite3.connect(db_name, isolation_level=None)
+        stop = False
+        while not stop:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            group = [item]
+            deadline = time.monotonic() + self.group_delay
+            while len(group) < self.group_size:
+                try:
+                    item = self._write_queue.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                group.append(item)
+            self._commit_group(conn, group)
+        conn.close()
+
+    def _commit_group(self, conn, group):
+        """Executes a group of mutations in one transaction
+
+        Each mutation runs in its own savepoint, so a failing mutation is
+        rolled back without affecting the others of the group.
+
+        :param conn: Connection of the writer thread
+        :param group: List of tuples (mutation, args, future)
+        """
+        cursor = conn.cursor()
+        results = []
         try:
-            cursor = self.conn.cursor()
+            cursor.execute('BEGIN')
+            for mutation, args, future in group:
+                cursor.execute('SAVEPOINT mutation')
+                try:
+                    results.append((future, mutation(cursor, *args), None))
+                    cursor.execute('RELEASE mutation')
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO mutation')
+                    cursor.execute('RELEASE mutation')
+                    results.append((future, None, e))
+            cursor.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            for mutation, args, future in group:
+                future.set_exception(e)
+            return
+
+        # Erst nach dem Commit Bescheid geben
+        for future, on_commit, error in results:
+            if error:
+                future.set_exception(error)
+                continue
+            if on_commit:
+                on_commit()
+            future.set_result(None)
+
+    def _migration_chat_indexes(self, cursor):
+        """Migration 1: Indexes for the analysis queries and Entry.ChatID
+
+        Adds the denormalized column ChatID to Entry, so the entries of a user
+        can be found without joining Tags, and fills it for existing entries
+        in batches. Every batch is committed separately to keep the write lock
+        short on big databases.
+
+        :param cursor: Cursor of the connection to be migrated
+        """
+        cursor.execute('PRAGMA table_info(Entry)')
+        if 'ChatID' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE Entry ADD COLUMN ChatID INTEGER')
+        command = '''
+            CREATE INDEX IF NOT EXISTS Tags_ChatID_Tag
+            ON Tags (ChatID, Tag)
+            '''
+        cursor.execute(command)
+        command = '''
+            CREATE INDEX IF NOT EXISTS Entry_Tag_Date
+            ON Entry (Tag, Date)
+            '''
+        cursor.execute(command)
+        command = '''
+            CREATE INDEX IF NOT EXISTS Entry_ChatID_Date
+            ON Entry (ChatID, Date)
+            '''
+        cursor.execute(command)
+        self.conn.commit()
+
+        # ChatID für bestehende Einträge blockweise nachtragen
+        last_id = 0
+        while True:
+            command = '''
+                SELECT MAX(E_ID)
+                FROM (SELECT E_ID
+                      FROM Entry
+                      WHERE E_ID > ?
+                      ORDER BY E_ID
+                      LIMIT ?)
+                '''
+            cursor.execute(command, (last_id, self.BACKFILL_BATCH_SIZE))
+            upper_id = cursor.fetchone()[0]
+            if upper_id is None:
+                break
             command = '''
-                INSERT INTO Tags (ChatID, Tag)
-                VALUES (?, ?)
+                UPDATE Entry
+                SET ChatID = (SELECT ChatID FROM Tags WHERE T_ID = Entry.Tag)
+                WHERE E_ID > ? AND E_ID <= ? AND ChatID IS NULL
                 '''
-            cursor.execute(command, (chat_id, tag,))
+            cursor.execute(command, (last_id, upper_id))
             self.conn.commit()
+            last_id = upper_id
+
+    def _migration_daily_sum(self, cursor):
+        """Migration 2: Table DailySum with the sum of each tag per day
+
+        get_entry_sum reads these sums instead of aggregating all entries of
+        the period. The sums of existing entries are computed once.
+
+        :param cursor: Cursor of the connection to be migrated
+        """
+        command = '''
+            CREATE TABLE IF NOT EXISTS "DailySum" (
+                "ChatID" INTEGER NOT NULL,
+                "TagID" INTEGER NOT NULL,
+                "Day" TEXT NOT NULL,
+                "Total" REAL NOT NULL DEFAULT 0,
+                "Count" INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY("ChatID", "TagID", "Day")
+            ) WITHOUT ROWID
+            '''
+        cursor.execute(command)
+        command = '''
+            CREATE INDEX IF NOT EXISTS DailySum_ChatID_Day
+            ON DailySum (ChatID, Day)
+            '''
+        cursor.execute(command)
+        self.rebuild_daily_sum()
+
+    def get_tags(self, chat_id):
+        """Return all the tags of a user
+
+        The tags are cached per user and kept up to date by add_tag.
+
+        :param chat_id: Telegram chat_id of the user
+        :return: List of tags of the user
+        """
+        tags = self.tag_cache.get(chat_id)
+        if tags is not None:
+            return list(tags)
+        generation = self.tag_cache.generation
+        try:
+            with self._reader() as cursor:
+                command = '''
+                    SELECT Tag
+                    FROM Tags
+                    WHERE ChatID = ?
+                    '''
+                cursor.execute(command, (chat_id,))
+                fetch = cursor.fetchall()
+                tags = []
+                for tag in fetch:
+                    tags.append(tag[0])
+                self.tag_cache.put(chat_id, tuple(tags), generation)
+                return tags
         except BaseException as e:
             raise e
 
+    def add_tag(self, chat_id, tag):
+        """Adds a tag to a user
+
+        :param chat_id: Telegram chat_id of the user
+        :param tag: Tag that should be added
+        :return: Future which is done when the tag is saved
+        """
+        return self._write(self._add_tag, chat_id, tag)
+
+    def _add_tag(self, cursor, chat_id, tag):
+        """Mutation of add_tag (see _write)"""
+        command = '''
+            INSERT INTO Tags (ChatID, Tag)
+            VALUES (?, ?)
+            '''
+        cursor.execute(command, (chat_id, tag,))
+        return lambda: self.tag_cache.update(chat_id,
+                                             lambda tags: tags + (tag,))
+
     def add_entry(self, chat_id, tag, value, date, comment):
         """Adds a new entry
 
+        The daily sums are updated in the same transaction.
+
         :param chat_id: Telegram chat_id of the user
         :param value: Value for the entry
         :param tag: Tag for the entry
         :param date: Date for the entry
         :param comment: Comment for the entry
+        :return: Future which is done when the entry is saved
         """
-        try:
-            cursor = self.conn.cursor()
-            command = '''
-                SELECT T_ID
-                FROM Tags
-                WHERE ChatID = ? AND Tag = ?
-                '''
-            cursor.execute(command, (chat_id, tag,))
-            tag_id = cursor.fetchone()[0]
+        return self._write(self._add_entry, chat_id, tag, value, date, comment)
+
+    def _add_entry(self, cursor, chat_id, tag, value, date, comment):
+        """Mutation of add_entry (see _write)"""
+        command = '''
+            SELECT T_ID
+            FROM Tags
+            WHERE ChatID = ? AND Tag = ?
+            '''
+        cursor.execute(command, (chat_id, tag,))
+        tag_id = cursor.fetchone()[0]
+        command = '''
+            INSERT INTO Entry (ChatID, Tag, Value, Date, Comment)
+            VALUES (?, ?, ?, ?, ?)
+            '''
+        cursor.execute(command, (chat_id, tag_id, value, date, comment))
+        self._update_daily_sum(cursor, chat_id, tag_id, date, value, 1)
+        return lambda: self._bump_version(chat_id)
+
+    def _update_daily_sum(self, cursor, chat_id, tag_id, day, value, count):
+        """Adds a value to the daily sum of a tag
+
+        Rows whose count drops to zero are removed, so DailySum only contains
+        days with entries.
+
+        :param cursor: Cursor of the running transaction
+        :param chat_id: Telegram chat_id of the user
+        :param tag_id: T_ID of the tag
+        :param day: Date of the entry
+        :param value: Value to be added (negative for removed entries)
+        :param count: Number of entries to be added (negative for removed)
+        """
+        command = '''
+            INSERT INTO DailySum (ChatID, TagID, Day, Total, Count)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (ChatID, TagID, Day) DO UPDATE
+            SET Total = Total + excluded.Total,
+                Count = Count + excluded.Count
+            '''
+        cursor.execute(command, (chat_id, tag_id, day, value, count))
+        if count < 0:
             command = '''
-                INSERT INTO Entry (Tag, Value, Date, Comment)
-                VALUES (?, ?, ?, ?)
+                DELETE FROM DailySum
+                WHERE ChatID = ? AND TagID = ? AND Day = ? AND Count <= 0
                 '''
-            cursor.execute(command, (tag_id, value, date, comment))
-            self.conn.commit()
+            cursor.execute(command, (chat_id, tag_id, day))
+
+    def add_entries(self, chat_id, rows):
+        """Adds many entries in transactions of IMPORT_BATCH_SIZE entries
+
+        The rows are read lazily, one batch at a time outside of the
+        transactions, so other writes and reads can run between the batches
+        and the memory use doesn't depend on the number of rows. If a batch
+        fails, the batches before it stay saved. The daily sums are added up
+        per batch before they are written.
+
+        :param chat_id: Telegram chat_id of the user
+        :param rows: Iterable of tuples (tag, value, date, comment)
+        :return: Future which is done when all entries are saved
+        """
+        rows = iter(rows)
+        future = None
+        while True:
+            batch = list(itertools.islice(rows, self.IMPORT_BATCH_SIZE))
+            # Mit Write-Behind wird der nächste Block gelesen, während der
+            # vorige gespeichert wird, mehr Blöcke nicht im Speicher halten
+            if future is not None:
+                future.result()
+            if not batch:
+                break
+            future = self._write(self._add_entries, chat_id, batch)
+        if future is None:
+            future = Future()
+            future.set_result(None)
+        return future
+
+    def _add_entries(self, cursor, chat_id, batch):
+        """Mutation of add_entries (see _write)"""
+        command = '''
+            SELECT Tag, T_ID
+            FROM Tags
+            WHERE ChatID = ?
+            '''
+        cursor.execute(command, (chat_id,))
+        tag_ids = dict(cursor.fetchall())
+        new_tags = False
+
+        entries = []
+        sums = {}
+        for tag, value, date, comment in batch:
+            tag_id = tag_ids.get(tag)
+            if tag_id is None:
+                cursor.execute('INSERT INTO Tags (ChatID, Tag) '
+                               'VALUES (?, ?)', (chat_id, tag))
+                tag_id = tag_ids[tag] = cursor.lastrowid
+                new_tags = True
+            entries.append((chat_id, tag_id, value, date, comment))
+            total = sums.setdefault((tag_id, date), [0, 0])
+            total[0] += value
+            total[1] += 1
+
+        # Nach Datum sortiert landen die Einträge in benachbarten Seiten der
+        # Indizes, unsortiert dauert das Einfügen fast doppelt so lang
+        entries.sort(key=lambda entry: entry[3])
+        command = '''
+            INSERT INTO Entry (ChatID, Tag, Value, Date, Comment)
+            VALUES (?, ?, ?, ?, ?)
+            '''
+        cursor.executemany(command, entries)
+        command = '''
+            INSERT INTO DailySum (ChatID, TagID, Day, Total, Count)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (ChatID, TagID, Day) DO UPDATE
+            SET Total = Total + excluded.Total,
+                Count = Count + excluded.Count
+            '''
+        cursor.executemany(command, (
+            (chat_id, tag_id, day, total, count)
+            for (tag_id, day), (total, count) in sums.items()))
+
+        def on_commit():
+            self._bump_version(chat_id)
+            if new_tags:
+                self.tag_cache.invalidate(chat_id)
+        return on_commit
+
+    def _get_entry_row(self, cursor, e_id):
+        """Returns the values of an entry needed for the daily sums
+
+        :param cursor: Cursor of the running transaction
+        :param e_id: The id of the entry
+        :return: Tuple (chat_id, tag_id, value, date) or None
+        """
+        command = '''
+            SELECT ChatID, Tag, Value, Date
+            FROM Entry
+            WHERE E_ID = ?
+            '''
+        cursor.execute(command, (e_id,))
+        return cursor.fetchone()
+
+    def _query(self, name, chat_id, tag=None, time_period=None,
+               bounds=None):
+        """Returns a prebuilt analysis query and its parameters
+
+        The time period is resolved to concrete bounds beforehand, so the
+        query only compares the raw date column and can use its index.
+
+        :param name: Name of the query in QUERY_TEMPLATES
+        :param chat_id: Telegram chat_id of the user
+        :param tag: Tag for the results
+        :param time_period: Time period for the results (see resolve_period)
+        :param bounds: Already resolved bounds (start, end) of the time period
+        :return: SQL of the query and tuple of the filter parameters
+        """
+        start, end = bounds or resolve_period(time_period)
+        param = (chat_id,) + tuple(value for value in (tag, start, end)
+                                   if value)
+        return QUERIES[(name, bool(tag), bool(start), bool(end))], param
+
+    def _cached_query(self, name, chat_id, tag=None, time_period=None):
+        """Runs an analysis query or returns its cached result
+
+        The result is cached for the data version of the user and the
+        resolved bounds of the time period, so it is neither served after a
+        change of the entries nor after the day of a relative period like
+        'month' changed.
+
+        :param name: Name of the query in QUERY_TEMPLATES
+        :param chat_id: Telegram chat_id of the user
+        :param tag: Tag for the results
+        :param time_period: Time period for the results (see resolve_period)
+        :return: List of the result rows
+        """
+        bounds = resolve_period(time_period)
+        # Version vor der Abfrage lesen, damit ein gleichzeitiger Commit das
+        # Ergebnis höchstens unter der alten Version ablegt
+        key = (name, chat_id, tag, bounds, self.data_version(chat_id))
+        res = self.result_cache.get(key)
+        if res is not None:
+            return list(res)
+        command, param = self._query(name, chat_id, tag, bounds=bounds)
+        try:
+            with self._reader() as cursor:
+                cursor.execute(command, param)
+                res = cursor.fetchall()
         except BaseException as e:
             raise e
+        if len(res) <= self.RESULT_CACHE_MAX_ROWS:
+            self.result_cache.put(key, tuple(res))
+        return res
 
     def get_entry_sum(self, chat_id, tag=None, time_period=None):
         """Returns the sum of the selected values
@@ -124,46 +947,27 @@ class DB:
         If the time period is specified only those results will be considered.
         If the tag is specified only these entries will be considered. If not
         the result of all tags will be computed.
+        The sums are read from the daily sums instead of the single entries
+        and cached until the entries of the user change.
 
         :param chat_id: Telegram chat_id of the user
         :param tag: Tag for the results
-        :param time_period: Time period for the results
-        """
-        where = 'WHERE Tags.ChatID = ?'
-        param = (chat_id,)
-        if tag:
-            where += ' AND Tags.Tag = ?'
-            param = param + (tag,)
-        if time_period:
-            if time_period != 'all':
-                # Entsprechende SQlite Modifikatioren einfügen
-                # https://sqlite.org/lang_datefunc.html
-                if time_period == '7day':
-                    modifier = '-7 day'
-                elif time_period == '30day':
-                    modifier = '-30 day'
-                elif time_period == 'month':
-                    modifier = 'start of month'
-                elif time_period == 'year':
-                    modifier = 'start of year'
-
-                where += ' AND date(Date) >= date("now", ?)'
-                param = param + (modifier,)
-        try:
-            cursor = self.conn.cursor()
-            command = '''
-                SELECT Tags.Tag, SUM(Value)
-                FROM Entry
-                JOIN Tags
-                ON Entry.Tag = T_ID
-                {}
-                GROUP BY Entry.Tag
-                '''.format(where)
-            cursor.execute(command, param)
-            res = cursor.fetchall()
-            return res
-        except BaseException as e:
-            raise e
+        :param time_period: Time period for the results (see resolve_period)
+        """
+        return self._cached_query('sum', chat_id, tag, time_period)
+
+    def get_monthly_sums(self, chat_id, tag=None, time_period=None):
+        """Returns the sum of the selected values per month and tag
+
+        Like get_entry_sum the sums are read from the daily sums and cached.
+
+        :param chat_id: Telegram chat_id of the user
+        :param tag: Tag for the results
+        :param time_period: Time period for the results (see resolve_period)
+        :return: List of tuples (month, tag, sum) ordered by month, the month
+        in the form YYYY-MM
+        """
+        return self._cached_query('monthly', chat_id, tag, time_period)
 
     def get_entries(self, chat_id, tag=None, time_period=None):
         """Returns the selected values
@@ -172,80 +976,334 @@ class DB:
         specified.
         If the time period is specified only those results will be returned.
         If the tag is specified only these entries will be returned.
+        Results up to RESULT_CACHE_MAX_ROWS entries are cached until the
+        entries of the user change.
+
+        :param chat_id: Telegram chat_id of the user
+        :param tag: Tag for the results
+        :param time_period: Time period for the results (see resolve_period)
+        """
+        return self._cached_query('entries', chat_id, tag, time_period)
+
+    def get_columns(self, chat_id, tag=None, time_period=None):
+        """Returns date, tag and value of the selected entries
+
+        Reads only the columns needed for statistics and leaves the order
+        undefined, so no sorting is necessary.
 
         :param chat_id: Telegram chat_id of the user
         :param tag: Tag for the results
-        :param time_period: Time period for the results
-        """
-        where = 'WHERE Tags.ChatID = ?'
-        param = (chat_id,)
-        if tag:
-            where += ' AND Tags.Tag = ?'
-            param = param + (tag,)
-        if time_period:
-            if time_period != 'all':
-                # Entsprechende SQlite Modifikatioren einfügen
-                # https://sqlite.org/lang_datefunc.html
-                if time_period == '7day':
-                    modifier = '-7 day'
-                elif time_period == '30day':
-                    modifier = '-30 day'
-                elif time_period == 'month':
-                    modifier = 'start of month'
-                elif time_period == 'year':
-                    modifier = 'start of year'
-
-                where += ' AND date(Date) >= date("now", ?)'
-                param = param + (modifier,)
+        :param time_period: Time period for the results (see resolve_period)
+        :return: List of tuples (date, tag, value)
+        """
+        command, param = self._query('columns', chat_id, tag, time_period)
         try:
-            cursor = self.conn.cursor()
-            command = '''
-                SELECT E_ID, Value, Tags.Tag, Date, Comment
-                FROM Entry
-                JOIN Tags
-                ON Entry.Tag = T_ID
-                {}
-                ORDER BY date(Date) DESC, E_ID DESC
-                '''.format(where)
-            cursor.execute(command, param)
-            res = cursor.fetchall()
-            return res
+            with self._reader() as cursor:
+                cursor.execute(command, param)
+                res = cursor.fetchall()
+                return res
         except BaseException as e:
             raise e
 
+    def get_entries_page(self, chat_id, tag=None, time_period=None,
+                         after=None, limit=20, before=None):
+        """Returns one page of the selected values
+
+        The entries are ordered like in get_entries. Instead of an offset the
+        position of the last entry of the previous page is given, so every
+        page is read directly from the index. To go back, the position of
+        the first entry of the following page can be given instead.
+
+        :param chat_id: Telegram chat_id of the user
+        :param tag: Tag for the results
+        :param time_period: Time period for the results (see resolve_period)
+        :param after: Tuple (date, e_id) of the last entry of the previous
+        page or None for the first page
+        :param limit: Maximum number of entries on the page
+        :param before: Tuple (date, e_id) of the first entry of the following
+        page, replaces after
+        :return: List of entries as tuples (e_id, value, tag, date, comment)
+        """
+        if before:
+            # Die Einträge davor in chronologischer Reihenfolge lesen und
+            # anschließend umdrehen
+            date, e_id = before
+            command, param = self._query('chunk_after', chat_id, tag,
+                                         time_period)
+            param = param + (date, date, e_id)
+        elif after:
+            date, e_id = after
+            command, param = self._query('page_after', chat_id, tag,
+                                         time_period)
+            param = param + (date, date, e_id)
+        else:
+            command, param = self._query('page', chat_id, tag, time_period)
+        try:
+            with self._reader() as cursor:
+                cursor.execute(command, param + (limit,))
+                res = cursor.fetchall()
+                if before:
+                    res.reverse()
+                return res
+        except BaseException as e:
+            raise e
+
+    def iter_entries(self, chat_id, tag=None, time_period=None,
+                     chunk_size=None):
+        """Yields the selected values in chronological order
+
+        The entries are read in chunks of chunk_size, each continuing after
+        the last entry of the previous chunk, so only one chunk is held in
+        memory. The connection is only used while a chunk is read and not
+        while the caller processes the entries.
+
+        :param chat_id: Telegram chat_id of the user
+        :param tag: Tag for the results
+        :param time_period: Time period for the results (see resolve_period)
+        :param chunk_size: Number of entries per chunk, defaults to
+        EXPORT_CHUNK_SIZE
+        :return: Generator of entries as tuples (e_id, value, tag, date,
+        comment)
+        """
+        chunk_size = chunk_size or self.EXPORT_CHUNK_SIZE
+        command, param = self._query('chunk', chat_id, tag, time_period)
+        # Die Filter sind dieselben, nur ihre Position kommt hinzu
+        after_command, _ = self._query('chunk_after', chat_id, tag,
+                                       time_period)
+        chunk_command, chunk_param = command, param
+        while True:
+            try:
+                with self._reader() as cursor:
+                    cursor.execute(chunk_command, chunk_param + (chunk_size,))
+                    chunk = cursor.fetchall()
+            except BaseException as e:
+                raise e
+            yield from chunk
+            if len(chunk) < chunk_size:
+                return
+            date, e_id = chunk[-1][3], chunk[-1][0]
+            chunk_command = after_command
+            chunk_param = param + (date, date, e_id)
+
     def update_entry(self, entry):
         """Update the given entry
 
         The entry has to be a tuple in this form:
         (e_id, value, tag, date, comment)
+        The old value is moved out of the daily sums and the new one added
+        in the same transaction, also if the date of the entry changed.
 
         :param entry: The values of the entry to be updated
+        :return: Future which is done when the entry is saved
         """
+        return self._write(self._update_entry, entry)
+
+    def _update_entry(self, cursor, entry):
+        """Mutation of update_entry (see _write)"""
         e_id, value, tag, date, comment = entry
+        old = self._get_entry_row(cursor, e_id)
+        command = '''
+            UPDATE Entry
+            SET Value = ?, Date = ?, Comment = ?
+            WHERE E_ID = ?
+            '''
+        cursor.execute(command, (value, date, comment, e_id))
+        if old:
+            chat_id, tag_id, old_value, old_date = old
+            self._update_daily_sum(cursor, chat_id, tag_id, old_date,
+                                   -old_value, -1)
+            self._update_daily_sum(cursor, chat_id, tag_id, date, value, 1)
+            return lambda: self._bump_version(chat_id)
+
+    def remove_entry(self, e_id):
+        """Delete the given entry
+
+        :param e_id: The id of the entry to be deleted
+        :return: Future which is done when the entry is deleted
+        """
+        return self._write(self._remove_entry, e_id)
+
+    def _remove_entry(self, cursor, e_id):
+        """Mutation of remove_entry (see _write)"""
+        old = self._get_entry_row(cursor, e_id)
+        command = '''
+            DELETE FROM Entry
+            WHERE E_ID = ?
+            '''
+        cursor.execute(command, (e_id,))
+        if old:
+            chat_id, tag_id, old_value, old_date = old
+            self._update_daily_sum(cursor, chat_id, tag_id, old_date,
+                                   -old_value, -1)
+            return lambda: self._bump_version(chat_id)
+
+    def rebuild_daily_sum(self):
+        """Recomputes all daily sums from the entries
+
+        :return: Number of rows in DailySum afterwards
+        """
         try:
             cursor = self.conn.cursor()
+            cursor.execute('DELETE FROM DailySum')
             command = '''
-                UPDATE Entry
-                SET Value = ?, Date = ?, Comment = ?
-                WHERE E_ID = ?
+                INSERT INTO DailySum (ChatID, TagID, Day, Total, Count)
+                SELECT ChatID, Tag, Date, SUM(Value), COUNT(*)
+                FROM Entry
+                WHERE ChatID IS NOT NULL
+                GROUP BY ChatID, Tag, Date
                 '''
-            cursor.execute(command, (value, date, comment, e_id))
+            cursor.execute(command)
             self.conn.commit()
+            self._bump_version()
+            cursor.execute('SELECT COUNT(*) FROM DailySum')
+            return cursor.fetchone()[0]
         except BaseException as e:
+            self.conn.rollback()
             raise e
 
-    def remove_entry(self, e_id):
-        """Delete the given entry
+    def verify_daily_sum(self):
+        """Compares the daily sums with the entries
 
-        :param e_id: The id of the entry to be deleted
+        :return: List of differing days as tuples (chat_id, tag_id, day,
+        total, count, stored total, stored count), values not present on
+        one side are None
         """
         try:
             cursor = self.conn.cursor()
             command = '''
-                DELETE FROM Entry
-                WHERE E_ID = ?
+                SELECT e.ChatID, e.Tag, e.Date, e.Total, e.Count,
+                       d.Total, d.Count
+                FROM (SELECT ChatID, Tag, Date,
+                             SUM(Value) AS Total, COUNT(*) AS Count
+                      FROM Entry
+                      WHERE ChatID IS NOT NULL
+                      GROUP BY ChatID, Tag, Date) AS e
+                LEFT JOIN DailySum AS d
+                ON d.ChatID = e.ChatID AND d.TagID = e.Tag AND d.Day = e.Date
+                WHERE d.Count IS NULL OR d.Count != e.Count
+                      OR ABS(d.Total - e.Total) > 0.000001
+                UNION ALL
+                SELECT d.ChatID, d.TagID, d.Day, NULL, NULL, d.Total, d.Count
+                FROM DailySum AS d
+                WHERE NOT EXISTS (SELECT 1
+                                  FROM Entry
+                                  WHERE ChatID = d.ChatID AND Tag = d.TagID
+                                        AND Date = d.Day)
                 '''
-            cursor.execute(command, (e_id,))
-            self.conn.commit()
+            cursor.execute(command)
+            return cursor.fetchall()
         except BaseException as e:
             raise e
+
+    def recent_chats(self, limit):
+        """Returns the users who added entries most recently
+
+        :param limit: Maximum number of users
+        :return: List of chat_ids, the most recently active first
+        """
+        try:
+            with self._reader() as cursor:
+                # Die Ids der Einträge steigen mit der Zeit des Eintragens
+                command = '''
+                    SELECT ChatID
+                    FROM Entry
+                    WHERE ChatID IS NOT NULL
+                    GROUP BY ChatID
+                    ORDER BY MAX(E_ID) DESC
+                    LIMIT ?
+                    '''
+                cursor.execute(command, (limit,))
+                return [row[0] for row in cursor.fetchall()]
+        except BaseException as e:
+            raise e
+
+    def admin_query(self, command, param=()):
+        """Runs a read query
+
+        Meant for maintenance and statistics over all users. The query is
+        executed on a read connection, so it doesn't block the writes with
+        DB_Readers enabled.
+
+        :param command: SQL of the query
+        :param param: Parameters of the query
+        :return: List of the result rows
+        """
+        try:
+            with self._reader() as cursor:
+                cursor.execute(command, param)
+                return cursor.fetchall()
+        except BaseException as e:
+            raise e
+
+    def warm_up(self, chats):
+        """Loads the tags of the most recently active users into the cache
+
+        :param chats: Number of users
+        :return: Number of users whose tags were loaded
+        """
+        chat_ids = self.recent_chats(chats)
+        for chat_id in chat_ids:
+            self.get_tags(chat_id)
+        return len(chat_ids)
+
+
+def main():
+    """Maintenance commands for an existing database"""
+    import argparse
+    from ShardedDB import ShardedDB, reshard, shard_names
+
+    parser = argparse.ArgumentParser(
+        description='Wartung der SpendingCalc Datenbank')
+    parser.add_argument('database', help='Pfad zur Datenbank')
+    parser.add_argument('command',
+                        choices=['migrate', 'verify-sums', 'rebuild-sums',
+                                 'reshard', 'query'],
+                        help='migrate: Migrationen ausführen, '
+                             'verify-sums: Tagessummen überprüfen, '
+                             'rebuild-sums: Tagessummen neu berechnen, '
+                             'reshard: Nutzer auf --shards Dateien '
+                             'aufteilen, '
+                             'query: SQL-Abfrage auf allen Shards ausführen')
+    parser.add_argument('sql', nargs='?', help='Abfrage für query')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Anzahl der Shards (wie DB_Shards)')
+    parser.add_argument('--from-shards', type=int, default=1,
+                        help='Bisherige Anzahl der Shards für reshard')
+    args = parser.parse_args()
+
+    if args.command == 'reshard':
+        sources = [args.database]
+        if args.from_shards > 1:
+            sources = shard_names(args.database, args.from_shards)
+        counts = reshard(sources, args.database, args.shards)
+        print('{users} Nutzer mit {tags} Kategorien und {entries} Einträgen '
+              'aufgeteilt, {skipped} Einträge ohne Nutzer übersprungen.'
+              .format(**counts))
+        print('Neue Dateien: ' + ', '.join(shard_names(args.database,
+                                                       args.shards)))
+        return
+
+    # Migrationen werden beim Verbinden automatisch ausgeführt
+    if args.shards > 1:
+        db = ShardedDB(args.database, args.shards)
+    else:
+        db = DB(args.database)
+    if args.command == 'verify-sums':
+        differences = db.verify_daily_sum()
+        for difference in differences:
+            print('ChatID {} Tag {} {}: erwartet {} ({}), gespeichert {} ({})'
+                  .format(*difference))
+        print('{} Abweichungen gefunden.'.format(len(differences)))
+    elif args.command == 'rebuild-sums':
+        print('{} Tagessummen neu berechnet.'.format(db.rebuild_daily_sum()))
+    elif args.command == 'query':
+        if not args.sql:
+            parser.error('query benötigt eine SQL-Abfrage')
+        rows = db.admin_query(args.sql)
+        for row in rows:
+            print('\t'.join(str(value) for value in row))
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
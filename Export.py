@@ -0,0 +1,117 @@
+import csv
+import gzip
+import json
+
+# Unterstützte Formate und ihre Dateiendungen
+FORMATS = {'csv': '.csv', 'ndjson': '.ndjson'}
+
+# Spalten der CSV-Datei, wie sie auch beim Import erkannt werden
+CSV_HEADER = ['Datum', 'Betrag', 'Kategorie', 'Kommentar']
+
+
+def write_csv(entries, file):
+    """Writes entries as CSV like used by German spreadsheets
+
+    :param entries: Iterable of tuples (e_id, value, tag, date, comment)
+    :param file: Text file the rows are written to
+    :return: Number of written entries
+    """
+    writer = csv.writer(file, delimiter=';')
+    writer.writerow(CSV_HEADER)
+    count = 0
+    for e_id, value, tag, date, comment in entries:
+        writer.writerow([date, '{:.2f}'.format(value).replace('.', ','), tag,
+                         comment or ''])
+        count += 1
+    return count
+
+
+def write_ndjson(entries, file):
+    """Writes entries as one JSON object per line
+
+    :param entries: Iterable of tuples (e_id, value, tag, date, comment)
+    :param file: Text file the lines are written to
+    :return: Number of written entries
+    """
+    count = 0
+    for e_id, value, tag, date, comment in entries:
+        file.write(json.dumps({'id': e_id, 'date': date, 'value': value,
+                               'tag': tag, 'comment': comment},
+                              ensure_ascii=False) + '\n')
+        count += 1
+    return count
+
+
+def export_entries(db, chat_id, path, export_format='csv', compress=False,
+                   tag=None, time_period=None):
+    """Writes the entries of a user to a file
+
+    The entries are streamed from the database and written one by one, so
+    the memory use doesn't depend on the number of entries.
+
+    :param db: DB the entries are read from
+    :param chat_id: Telegram chat_id of the user
+    :param path: Path of the file
+    :param export_format: One of FORMATS
+    :param compress: Whether the file is compressed with gzip
+    :param tag: Only export entries of this tag
+    :param time_period: Only export entries of this time period (see
+    resolve_period)
+    :return: Number of exported entries
+    """
+    if export_format not in FORMATS:
+        raise ValueError('Unknown export format ' + export_format)
+    if compress:
+        # Stufe 6 ist dreimal so schnell wie 9 und kaum größer
+        file = gzip.open(path, 'wt', compresslevel=6, encoding='utf-8',
+                         newline='')
+    else:
+        file = open(path, 'w', encoding='utf-8', newline='')
+    entries = db.iter_entries(chat_id, tag=tag, time_period=time_period)
+    with file:
+        if export_format == 'csv':
+            return write_csv(entries, file)
+        return write_ndjson(entries, file)
+
+
+def file_name(export_format, compress, date):
+    """Returns the name of an export file
+
+    :param export_format: One of FORMATS
+    :param compress: Whether the file is compressed with gzip
+    :param date: Date of the export
+    :return: File name like SpendingCalc_2021-01-31.csv.gz
+    """
+    name = 'SpendingCalc_{}{}'.format(date.isoformat(), FORMATS[export_format])
+    return name + '.gz' if compress else name
+
+
+def main():
+    import argparse
+    from DB import DB
+
+    parser = argparse.ArgumentParser(
+        description='Einträge eines Nutzers exportieren')
+    parser.add_argument('db', help='Datenbankdatei, z.B. SpendingCalcData.db')
+    parser.add_argument('chat_id', type=int, help='Chat-ID des Nutzers')
+    parser.add_argument('file', help='Zieldatei')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Datei mit gzip komprimieren')
+    parser.add_argument('--tag', help='Nur Einträge dieser Kategorie')
+    parser.add_argument('--period', help='Nur Einträge dieses Zeitraums, '
+                                         'z.B. year oder '
+                                         '2021-01-01..2021-03-31')
+    args = parser.parse_args()
+
+    db = DB(args.db)
+    try:
+        count = export_entries(db, args.chat_id, args.file, args.format,
+                               args.gzip, args.tag, args.period)
+    finally:
+        db.close()
+    print('{} Einträge exportiert.'.format(count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram.ext import ConversationHandler
+from Buttons import ButtonHandler, CallbackHandler
+from collections import defaultdict
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+# Obergrenzen der Histogramm-Buckets in Sekunden
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+# Abfragen und Schreibzugriffe, die instrument_db misst. Verwaltung wie
+# pool_stats oder close würde sonst z.B. beim Abfragen der Collectors
+# mitgezählt
+DB_METHODS = ('get_tags', 'add_tag', 'add_entry', 'add_entries',
+              'get_entry_sum', 'get_monthly_sums', 'get_entries',
+              'get_columns', 'get_entries_page', 'update_entry',
+              'remove_entry')
+
+# Ablauf des aktuell bearbeiteten Updates, wird an den DB-Pool weitergegeben
+_trace = contextvars.ContextVar('trace', default=None)
+
+
+class Histogram:
+    """Cumulative histogram of durations like used by Prometheus"""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Adds a duration to the histogram
+
+        :param value: Duration in seconds
+        """
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q):
+        """Estimates a quantile from the buckets
+
+        :param q: Quantile between 0 and 1
+        :return: Upper bound of the bucket containing the quantile or None
+        """
+        if not self.count:
+            return None
+        for bound, count in zip(BUCKETS, self.counts):
+            if count >= q * self.count:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """Registry of counters and histograms
+
+    Conversation callbacks and DB methods can be wrapped to record their
+    calls, errors and durations. Further values are read from collectors when
+    the metrics are exposed. All values are exposed in the Prometheus text
+    format.
+    Updates taking longer than slow_threshold seconds (including their
+    queries) are written as JSON lines to slow_log.
+    """
+
+    def __init__(self, prefix='spendingcalc', slow_threshold=None,
+                 slow_log=None):
+        self.prefix = prefix
+        self.slow_threshold = slow_threshold
+        self.slow_log = slow_log
+        self._counters = defaultdict(float)
+        self._histograms = defaultdict(Histogram)
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._writer_stop = None
+
+    def inc(self, name, labels=(), value=1):
+        """Increases a counter
+
+        :param name: Name of the counter without prefix
+        :param labels: Tuple of (label, value) pairs
+        :param value: Amount to add
+        """
+        with self._lock:
+            self._counters[(name, labels)] += value
+
+    def observe(self, name, value, labels=()):
+        """Adds a duration to a histogram
+
+        :param name: Name of the histogram without prefix
+        :param value: Duration in seconds
+        :param labels: Tuple of (label, value) pairs
+        """
+        with self._lock:
+            self._histograms[(name, labels)].observe(value)
+
+    def add_collector(self, name, function):
+        """Adds values that are read when the metrics are exposed
+
+        :param name: Name prefix of the values
+        :param function: Function returning a dict with numeric values
+        """
+        self._collectors.append((name, function))
+
+    def instrument_handlers(self, dispatcher, state_names):
+        """Wraps all callbacks of the ConversationHandlers
+
+        The handlers of the inline mode, which aren't part of a
+        ConversationHandler, are measured with the state INLINE.
+
+        :param dispatcher: Dispatcher with the registered handlers
+        :param state_names: dict with the states and their names
+        """
+        for group in dispatcher.handlers.values():
+            for conversation in group:
+                if isinstance(conversation, (ButtonHandler, CallbackHandler)):
+                    conversation.replace_callbacks(functools.partial(
+                        self._wrap_handler, state='INLINE'))
+                    continue
+                if not isinstance(conversation, ConversationHandler):
+                    continue
+                for handler in conversation.entry_points:
+                    handler.callback = self._wrap_handler(handler.callback,
+                                                          'START')
+                for state, handlers in conversation.states.items():
+                    name = state_names.get(state, str(state))
+                    for handler in handlers:
+                        if isinstance(handler, ButtonHandler):
+                            handler.replace_callbacks(functools.partial(
+                                self._wrap_handler, state=name))
+                        else:
+                            handler.callback = self._wrap_handler(
+                                handler.callback, name)
+
+    def instrument_db(self, db, methods=None):
+        """Wraps the query and write methods of a DB object
+
+        :param db: DB object, its methods are replaced on the instance
+        :param methods: Names of the methods, defaults to DB_METHODS
+        """
+        if methods is None:
+            methods = DB_METHODS
+        for name in methods:
+            setattr(db, name, self._wrap_query(getattr(db, name), name))
+
+    def _wrap_handler(self, callback, state):
+        """Wraps a conversation callback
+
+        :param callback: Callback of the handler
+        :param state: Name of the state the handler belongs to
+        :return: Wrapped callback
+        """
+        labels = (('handler', callback.__name__), ('state', state))
+
+        @functools.wraps(callback)
+        def measured(update, context):
+            chat = update.effective_chat
+            trace = {'chat_id': chat.id if chat else None,
+                     'state': state,
+                     'handler': callback.__name__,
+                     'start': time.perf_counter(),
+                     'queries': [],
+                     'logged': False}
+            token = _trace.set(trace)
+            try:
+                return callback(update, context)
+            except Exception:
+                self.inc('handler_errors_total', labels)
+                raise
+            finally:
+                _trace.reset(token)
+                self.inc('handler_calls_total', labels)
+                self.observe('handler_seconds',
+                             time.perf_counter() - trace['start'], labels)
+                self._check_slow(trace)
+        return measured
+
+    def _wrap_query(self, method, name):
+        """Wraps a DB method
+
+        :param method: Bound method of the DB object
+        :param name: Name of the method
+        :return: Wrapped method
+        """
+        labels = (('method', name),)
+
+        @functools.wraps(method)
+        def measured(*args, **kwargs):
+            start = time.perf_counter()
+            rows = None
+            try:
+                result = method(*args, **kwargs)
+                if isinstance(result, list):
+                    rows = len(result)
+                return result
+            except Exception:
+                self.inc('db_errors_total', labels)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                self.inc('db_calls_total', labels)
+                self.observe('db_seconds', elapsed, labels)
+                if rows is not None:
+                    self.inc('db_rows_total', labels, rows)
+                trace = _trace.get()
+                if trace is not None:
+                    trace['queries'].append({'method': name,
+                                             'seconds': round(elapsed, 6),
+                                             'rows': rows})
+                    self._check_slow(trace)
+        return measured
+
+    def _check_slow(self, trace):
+        """Logs an update once it took longer than the threshold
+
+        :param trace: Trace of the update
+        """
+        if not self.slow_threshold or trace['logged']:
+            return
+        elapsed = time.perf_counter() - trace['start']
+        if elapsed < self.slow_threshold:
+            return
+        trace['logged'] = True
+        self.inc('slow_updates_total')
+        if not self.slow_log:
+            return
+        line = json.dumps({'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                           'chat_id': trace['chat_id'],
+                           'state': trace['state'],
+                           'handler': trace['handler'],
+                           'seconds': round(elapsed, 6),
+                           'queries': list(trace['queries'])})
+        with self._lock:
+            with open(self.slow_log, 'a') as file:
+                file.write(line + '\n')
+
+    def expose(self):
+        """Returns all metrics in the Prometheus text format
+
+        :return: String with one line per value
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.count, h.sum))
+                                for key, h in self._histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            name = '{}_{}'.format(self.prefix, name)
+            if name not in typed:
+                lines.append('# TYPE {} counter'.format(name))
+                typed.add(name)
+            lines.append('{}{} {}'.format(name, _labels(labels),
+                                          _number(value)))
+
+        for (name, labels), (counts, count, total) in histograms:
+            name = '{}_{}'.format(self.prefix, name)
+            if name not in typed:
+                lines.append('# TYPE {} histogram'.format(name))
+                typed.add(name)
+            for bound, bucket in zip(BUCKETS, counts):
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels + (('le', str(bound)),)), bucket))
+            lines.append('{}_bucket{} {}'.format(
+                name, _labels(labels + (('le', '+Inf'),)), count))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+
+        for collector, function in self._collectors:
+            for key, value in sorted(function().items()):
+                name = '{}_{}_{}'.format(self.prefix, collector, key)
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, limit=10):
+        """Returns a short overview for the /stats command
+
+        :param limit: Maximum number of handlers and queries listed
+        :return: String with the slowest handlers and queries and all
+        collected values
+        """
+        with self._lock:
+            histograms = [(key, h.count, h.sum, h.quantile(0.95))
+                          for key, h in self._histograms.items()]
+            slow = self._counters.get(('slow_updates_total', ()), 0)
+
+        lines = []
+        for name, title in (('handler_seconds', 'Handler'),
+                            ('db_seconds', 'Abfragen'),
+                            ('outbound_seconds', 'Gesendet')):
+            rows = sorted((h for h in histograms if h[0][0] == name),
+                          key=lambda h: h[2], reverse=True)[:limit]
+            if rows:
+                lines.append(title + ' (Anzahl, Mittel, p95):')
+            for (_, labels), count, total, p95 in rows:
+                lines.append('{} {} {:.1f}ms ≤{}ms'.format(
+                    '/'.join(value for _, value in labels), count,
+                    total / count * 1000, _number(p95 * 1000)))
+        lines.append('Langsame Updates: {}'.format(_number(slow)))
+        for collector, function in self._collectors:
+            values = ', '.join('{}={}'.format(key, _number(value))
+                               for key, value in sorted(function().items()))
+            lines.append('{}: {}'.format(collector, values))
+        return '\n'.join(lines)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves the metrics over HTTP in a background thread
+
+        :param port: Port of the HTTP server
+        :param host: Address the server listens on
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.expose().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever,
+                         name='Metrics-Server', daemon=True).start()
+
+    def write_periodically(self, path, interval=15.0):
+        """Writes the metrics to a file in a background thread
+
+        The file is replaced atomically, so it can be read by the textfile
+        collector of the node exporter.
+
+        :param path: Path of the file
+        :param interval: Seconds between two writes
+        """
+        self._writer_stop = threading.Event()
+
+        def write():
+            while not self._writer_stop.wait(interval):
+                self.write_file(path)
+
+        threading.Thread(target=write, name='Metrics-Writer',
+                         daemon=True).start()
+
+    def write_file(self, path):
+        """Writes the metrics to a file
+
+        :param path: Path of the file
+        """
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as file:
+            file.write(self.expose())
+        os.replace(temporary, path)
+
+    def stop(self):
+        """Stops the HTTP server and the file writer"""
+        if self._server:
+            self._server.shutdown()
+        if self._writer_stop:
+            self._writer_stop.set()
+
+
+def _labels(labels):
+    """Formats labels for the text format
+
+    :param labels: Tuple of (label, value) pairs
+    :return: String like {a="1",b="2"} or empty string
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for key, value in labels) + '}'
+
+
+def _number(value):
+    """Formats a number without unnecessary decimals
+
+    :param value: Number to be formatted
+    :return: String of the number
+    """
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
@@ -0,0 +1,484 @@
+from telegram.error import BadRequest, RetryAfter
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+import contextlib
+import contextvars
+import functools
+import inspect
+import threading
+import time
+
+# Spuren der Warteschlange, interaktive Antworten werden immer zuerst gesendet
+INTERACTIVE = 0
+BULK = 1
+LANE_NAMES = ('interactive', 'bulk')
+
+# Methoden des Bots, deren Aufrufe über die Warteschlange laufen
+METHODS = ('send_message', 'edit_message_text', 'edit_message_reply_markup',
+           'send_photo', 'send_document')
+
+# Telegram begrenzt Texte auf 4096 Zeichen, zusammengefasste Nachrichten
+# werden durch eine Leerzeile getrennt
+MESSAGE_LIMIT = 4096
+SEPARATOR = '\n\n'
+
+# Wiederholungen nach "429 Too Many Requests", die Wartezeit verdoppelt sich
+# mit jedem Versuch, mindestens aber die von Telegram genannte Zeit
+MAX_RETRIES = 5
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+# Spur des aktuellen Threads (siehe Outbound.bulk)
+_lane = contextvars.ContextVar('lane', default=INTERACTIVE)
+
+
+def wait_sent(sent):
+    """Returns the sent message, waiting for it if sending is queued
+
+    Needed where the message is used or the sent file must stay open until
+    it is uploaded.
+
+    :param sent: Message or future of the message (see Outbound)
+    :return: Message
+    """
+    if isinstance(sent, Future):
+        return sent.result()
+    return sent
+
+
+class TokenBucket:
+    """Token bucket limiting how many messages are sent per second
+
+    Up to capacity messages can be sent at once, afterwards one per 1/rate
+    seconds. A rate of 0 doesn't limit at all. The bucket isn't thread-safe,
+    Outbound only uses it while holding its lock.
+    """
+
+    def __init__(self, rate, capacity, now=None):
+        """
+        :param rate: Tokens added per second
+        :param capacity: Maximum number of tokens
+        :param now: Current time.monotonic()
+        """
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """Returns how long to wait until a token is available
+
+        :param now: Current time.monotonic()
+        :return: Seconds, 0 if a message can be sent right away
+        """
+        if not self.rate:
+            return 0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Takes a token, delay has to be checked before
+
+        :param now: Current time.monotonic()
+        """
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+    def full(self, now):
+        """Whether the bucket is full again, i.e. sending was idle long enough
+
+        :param now: Current time.monotonic()
+        """
+        if not self.rate:
+            return True
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    """Queued call of a method of the bot"""
+
+    __slots__ = ('function', 'method', 'arguments', 'chat_id', 'lane',
+                 'futures', 'queued', 'attempts')
+
+    def __init__(self, function, method, arguments, chat_id, lane):
+        self.function = function
+        self.method = method
+        self.arguments = arguments
+        self.chat_id = chat_id
+        self.lane = lane
+        self.futures = [Future()]
+        self.queued = time.monotonic()
+        self.attempts = 0
+
+
+class _Chat:
+    """Rate limit and sending state of one chat"""
+
+    __slots__ = ('bucket', 'busy', 'not_before', 'pending')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.busy = False
+        self.not_before = 0.0
+        self.pending = 0
+
+
+class Outbound:
+    """Central queue for all messages sent by the bot
+
+    The sending methods of the bot (see METHODS) are replaced by install, so
+    the handlers keep calling reply_text etc. but only queue the message and
+    get a future of the sent message. Sender threads work off the queue
+    within the flood limits of Telegram: a global token bucket and one per
+    chat, group chats (negative ids) with their own, lower rate. A chat
+    never has two messages in flight, so its messages arrive in order.
+
+    Messages sent inside bulk() (e.g. by jobs writing to many chats) go to a
+    second lane, which is only served if no interactive message can be sent.
+    Chats of a lane are served round robin.
+
+    After "429 Too Many Requests" the message is queued again at the front
+    of its chat, which is paused for the given time or the exponentially
+    growing backoff, whichever is longer. Other errors fail the future.
+
+    Consecutive messages to the same chat still waiting in the queue are
+    coalesced: a text message without keyboard takes up the text of the
+    following message, and a queued edit of a message is replaced by a
+    newer edit of it. The futures of coalesced messages get the same result.
+    """
+
+    def __init__(self, rate=30, chat_rate=1, chat_burst=3,
+                 group_rate=20 / 60, workers=4):
+        """
+        :param rate: Messages per second to all chats
+        :param chat_rate: Messages per second to one private chat
+        :param chat_burst: Messages a chat can get at once before chat_rate
+        applies
+        :param group_rate: Messages per second to one group chat
+        :param workers: Number of sender threads
+        """
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.workers = workers
+        self.on_sent = None
+        self._bucket = TokenBucket(rate, rate)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # Pro Spur die Chats mit wartenden Nachrichten in Reihenfolge der
+        # Bedienung, jeweils mit ihren Nachrichten
+        self._lanes = [OrderedDict() for _ in LANE_NAMES]
+        self._chats = {}
+        self._swept = time.monotonic()
+        self._threads = []
+        self._stopped = False
+        self._stats = {'queued': 0,
+                       'max_queued': 0,
+                       'sending': 0,
+                       'sent': 0,
+                       'failed': 0,
+                       'retries': 0,
+                       'coalesced': 0}
+
+    def install(self, bot):
+        """Replaces the sending methods of a bot with queued ones
+
+        :param bot: Bot, its methods are replaced on the instance
+        """
+        for method in METHODS:
+            setattr(bot, method, self._wrap(getattr(bot, method), method))
+
+    def _wrap(self, function, method):
+        """Wraps a sending method of the bot
+
+        :param function: The original method
+        :param method: Name of the method
+        :return: Function queueing the calls and returning futures
+        """
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def queued(*args, **kwargs):
+            return self.submit(function, method, signature, *args, **kwargs)
+
+        return queued
+
+    def start(self):
+        """Starts the sender threads"""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='Outbound-{}'.format(i),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Sends the remaining messages and stops the sender threads
+
+        :param timeout: Maximum seconds to wait for each thread
+        """
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    @contextlib.contextmanager
+    def bulk(self):
+        """Context in which sent messages use the lane for bulk messages"""
+        token = _lane.set(BULK)
+        try:
+            yield
+        finally:
+            _lane.reset(token)
+
+    def submit(self, function, method, signature, *args, **kwargs):
+        """Queues a call of a sending method of the bot
+
+        :param function: The original method
+        :param method: Name of the method
+        :param signature: Signature of the method, to find the chat_id
+        :param args: Positional arguments for the method
+        :param kwargs: Keyword arguments for the method
+        :return: Future with the result of the method
+        """
+        arguments = signature.bind(*args, **kwargs).arguments
+        chat_id = arguments.get('chat_id')
+        if chat_id is None:
+            # z.B. Bearbeitungen über inline_message_id, nicht zuzuordnen
+            chat_id = arguments.get('inline_message_id')
+        job = _Job(function, method, arguments, chat_id, _lane.get())
+        with self._lock:
+            future = self._coalesce(job)
+            if future:
+                return future
+            self._enqueue(job)
+            return job.futures[0]
+
+    def stats(self):
+        """Returns the counters of the queue
+
+        :return: dict with the queued (also the maximum and per lane),
+        currently sending, sent, failed, retried and coalesced messages and
+        the number of tracked chats
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            for lane, name in enumerate(LANE_NAMES):
+                stats['queued_' + name] = sum(
+                    len(jobs) for jobs in self._lanes[lane].values())
+            stats['chats'] = len(self._chats)
+            return stats
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            group = isinstance(chat_id, int) and chat_id < 0
+            chat = _Chat(TokenBucket(
+                self.group_rate if group else self.chat_rate,
+                self.chat_burst))
+            self._chats[chat_id] = chat
+        return chat
+
+    def _coalesce(self, job):
+        """Merges a message into the last queued message of its chat
+
+        :param job: The new message
+        :return: Future of the new message or None if it has to be queued
+        """
+        jobs = self._lanes[job.lane].get(job.chat_id)
+        if not jobs:
+            return None
+        last = jobs[-1]
+        if last.method != job.method:
+            return None
+        if job.method == 'send_message':
+            if last.arguments.get('reply_markup') is not None:
+                return None
+            # Abgesehen von Text und Tastatur müssen die Aufrufe gleich sein
+            others = {key: value for key, value in job.arguments.items()
+                      if key not in ('text', 'reply_markup')}
+            if others != {key: value for key, value in last.arguments.items()
+                          if key not in ('text', 'reply_markup')}:
+                return None
+            text = last.arguments['text'] + SEPARATOR + job.arguments['text']
+            if len(text) > MESSAGE_LIMIT:
+                return None
+            last.arguments['text'] = text
+            last.arguments['reply_markup'] = job.arguments.get('reply_markup')
+        elif job.method == 'edit_message_text':
+            if (last.arguments.get('message_id') is None
+                    or last.arguments.get('message_id')
+                    != job.arguments.get('message_id')):
+                return None
+            # Nur der neueste Stand der Nachricht muss gesendet werden
+            last.arguments = job.arguments
+        else:
+            return None
+        last.futures.append(job.futures[0])
+        self._stats['coalesced'] += 1
+        return job.futures[0]
+
+    def _enqueue(self, job, front=False):
+        """Adds a message to the queue of its chat and lane
+
+        :param job: The message
+        :param front: Whether it is sent before the other queued messages
+        of the chat (for retries)
+        """
+        jobs = self._lanes[job.lane].setdefault(job.chat_id, deque())
+        if front:
+            jobs.appendleft(job)
+        else:
+            jobs.append(job)
+        self._chat(job.chat_id).pending += 1
+        self._stats['queued'] += 1
+        self._stats['max_queued'] = max(self._stats['max_queued'],
+                                        self._stats['queued'])
+        self._wakeup.notify()
+
+    def _next(self, now):
+        """Takes the next message that can be sent within the limits
+
+        :param now: Current time.monotonic()
+        :return: Tuple of the message (or None) and the seconds until one
+        might be sendable (None if the queue is empty)
+        """
+        wait = None
+        for lane in self._lanes:
+            for chat_id, jobs in lane.items():
+                chat = self._chats[chat_id]
+                if chat.busy:
+                    continue
+                delay = max(chat.not_before - now, chat.bucket.delay(now))
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                delay = self._bucket.delay(now)
+                if delay > 0:
+                    return None, delay
+                self._bucket.take(now)
+                chat.bucket.take(now)
+                chat.busy = True
+                chat.pending -= 1
+                job = jobs.popleft()
+                if jobs:
+                    # Die übrigen Chats der Spur kommen zuerst dran
+                    lane.move_to_end(chat_id)
+                else:
+                    del lane[chat_id]
+                self._stats['queued'] -= 1
+                self._stats['sending'] += 1
+                return job, None
+        return None, wait
+
+    def _work(self):
+        """Sends queued messages until stopped and the queue is empty"""
+        while True:
+            with self._lock:
+                while True:
+                    job, wait = self._next(time.monotonic())
+                    if job:
+                        break
+                    if self._stopped and not self._stats['queued']:
+                        return
+                    self._wakeup.wait(wait)
+            self._send(job)
+
+    def _send(self, job):
+        """Calls the method of a message and sets its futures
+
+        :param job: The message
+        """
+        try:
+            result = job.function(**job.arguments)
+        except RetryAfter as e:
+            if self._retry(job, e.retry_after):
+                return
+            self._finish(job, error=e)
+        except BadRequest as e:
+            self._finish(job, error=e,
+                         # Erneut gedrückter Button, die Nachricht ist
+                         # bereits aktuell
+                         log='not modified' not in e.message)
+        except Exception as e:
+            self._finish(job, error=e)
+        else:
+            self._finish(job, result=result)
+
+    def _retry(self, job, retry_after):
+        """Queues a message again after "429 Too Many Requests"
+
+        :param job: The message
+        :param retry_after: Seconds to wait according to Telegram
+        :return: False if the message has been tried too often
+        """
+        with self._lock:
+            job.attempts += 1
+            if job.attempts > MAX_RETRIES:
+                return False
+            backoff = RETRY_DELAY * 2 ** (job.attempts - 1)
+            delay = min(MAX_RETRY_DELAY, max(retry_after, backoff))
+            chat = self._chat(job.chat_id)
+            chat.not_before = time.monotonic() + delay
+            chat.busy = False
+            self._stats['sending'] -= 1
+            self._stats['retries'] += 1
+            self._enqueue(job, front=True)
+            self._wakeup.notify_all()
+            return True
+
+    def _finish(self, job, result=None, error=None, log=True):
+        """Releases the chat of a sent message and sets its futures
+
+        :param job: The message
+        :param result: Result of the method
+        :param error: Exception raised by the method
+        :param log: Whether the error is printed
+        """
+        now = time.monotonic()
+        with self._lock:
+            chat = self._chats.get(job.chat_id)
+            if chat:
+                chat.busy = False
+            self._stats['sending'] -= 1
+            self._stats['failed' if error else 'sent'] += 1
+            if now - self._swept > 1:
+                self._sweep(now)
+            self._wakeup.notify_all()
+
+        if error:
+            if log:
+                print('Outbound: {} an {} fehlgeschlagen: {!r}'.format(
+                    job.method, job.chat_id, error))
+            for future in job.futures:
+                future.set_exception(error)
+            return
+        if self.on_sent:
+            self.on_sent(now - job.queued, LANE_NAMES[job.lane])
+        for future in job.futures:
+            future.set_result(result)
+
+    def _sweep(self, now):
+        """Forgets chats without messages whose limits are reset anyway
+
+        :param now: Current time.monotonic()
+        """
+        self._swept = now
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if not chat.busy and not chat.pending
+                        and chat.not_before <= now
+                        and chat.bucket.full(now)]:
+            del self._chats[chat_id]
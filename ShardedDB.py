@@ -0,0 +1,317 @@
+from DB import DB, LRUCache
+import os
+import zlib
+
+
+def shard_names(db_name, shards):
+    """Returns the file names of the shards of a database
+
+    The names contain the number of shards, so shards of different counts
+    can exist side by side while resharding.
+
+    :param db_name: Name of the database, e.g. SpendingCalcData.db
+    :param shards: Number of shards
+    :return: List of names like SpendingCalcData.0of4.db
+    """
+    root, extension = os.path.splitext(db_name)
+    return ['{}.{}of{}{}'.format(root, shard, shards, extension)
+            for shard in range(shards)]
+
+
+def shard_of(chat_id, shards):
+    """Returns the shard a user belongs to
+
+    CRC32 is stable across processes and Python versions, unlike hash().
+
+    :param chat_id: Telegram chat_id of the user
+    :param shards: Number of shards
+    :return: Index of the shard
+    """
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+class ShardedDB:
+    """Database split into several files by chat_id
+
+    Every user is stored completely in one shard, so all methods of DB are
+    answered by a single shard and keep their signatures. Each shard has its
+    own write lock (and writer thread with write-behind), so writes of
+    different shards don't wait for each other.
+    The ids of entries are made unique over all shards by encoding the shard
+    into them: id = local id * number of shards + shard.
+    """
+
+    def __init__(self, db_name, shards, tag_cache_size=1024,
+                 result_cache_size=256, **kwargs):
+        """
+        :param db_name: Name of the database, the shards are named like
+        shard_names
+        :param shards: Number of shards
+        :param tag_cache_size: Size of the tag cache of all shards
+        :param result_cache_size: Size of the result cache of all shards
+        :param kwargs: Further arguments for DB, e.g. write_behind
+        """
+        self.names = shard_names(db_name, shards)
+        # Nicht versehentlich mit leeren Shards neben den bisherigen Daten
+        # starten
+        existing = [os.path.exists(name) for name in self.names]
+        if any(existing) and not all(existing):
+            raise FileNotFoundError('Shards are incomplete: ' + ', '.join(
+                name for name, found in zip(self.names, existing)
+                if not found))
+        if not any(existing) and os.path.exists(db_name):
+            raise FileExistsError(
+                '{0} has to be split first: python -m DB {0} reshard '
+                '--shards {1}'.format(db_name, shards))
+        self.shards = [DB(name, **kwargs) for name in self.names]
+        # Alle Shards teilen sich die Zwischenspeicher, damit deren Größe
+        # insgesamt gilt (die Schlüssel enthalten die chat_id)
+        self.tag_cache = LRUCache(tag_cache_size)
+        self.result_cache = LRUCache(result_cache_size)
+        for shard in self.shards:
+            shard.tag_cache = self.tag_cache
+            shard.result_cache = self.result_cache
+
+    def _shard(self, chat_id):
+        return self.shards[shard_of(chat_id, len(self.shards))]
+
+    def _entry_id(self, e_id):
+        """Splits a global id into the shard and the id within the shard
+
+        :param e_id: Id of an entry like returned by this class
+        :return: Tuple of the shard and the local id
+        """
+        return self.shards[e_id % len(self.shards)], e_id // len(self.shards)
+
+    def _global_entries(self, chat_id, entries):
+        """Converts the ids of entries read from a shard to global ids
+
+        :param chat_id: Telegram chat_id of the user the entries belong to
+        :param entries: Iterable of tuples (e_id, value, tag, date, comment)
+        :return: Generator of the entries with global ids
+        """
+        count = len(self.shards)
+        shard = shard_of(chat_id, count)
+        for entry in entries:
+            yield (entry[0] * count + shard,) + entry[1:]
+
+    def close(self):
+        """Closes all shards"""
+        for shard in self.shards:
+            shard.close()
+
+    def migrate(self):
+        """Applies the outstanding migrations to all shards"""
+        for shard in self.shards:
+            shard.migrate()
+
+    def pool_stats(self):
+        """Returns the counters of the connection pools of all shards
+
+        :return: dict like DB.pool_stats, summed up (max_wait is the maximum)
+        """
+        stats = {}
+        for shard in self.shards:
+            for key, value in shard.pool_stats().items():
+                if key == 'max_wait':
+                    stats[key] = max(stats.get(key, 0.0), value)
+                else:
+                    stats[key] = stats.get(key, 0) + value
+        return stats
+
+    def data_version(self, chat_id):
+        """See DB.data_version"""
+        return self._shard(chat_id).data_version(chat_id)
+
+    def get_tags(self, chat_id):
+        """See DB.get_tags"""
+        return self._shard(chat_id).get_tags(chat_id)
+
+    def add_tag(self, chat_id, tag):
+        """See DB.add_tag"""
+        return self._shard(chat_id).add_tag(chat_id, tag)
+
+    def add_entry(self, chat_id, tag, value, date, comment):
+        """See DB.add_entry"""
+        return self._shard(chat_id).add_entry(chat_id, tag, value, date,
+                                              comment)
+
+    def add_entries(self, chat_id, rows):
+        """See DB.add_entries"""
+        return self._shard(chat_id).add_entries(chat_id, rows)
+
+    def get_entry_sum(self, chat_id, tag=None, time_period=None):
+        """See DB.get_entry_sum"""
+        return self._shard(chat_id).get_entry_sum(chat_id, tag, time_period)
+
+    def get_monthly_sums(self, chat_id, tag=None, time_period=None):
+        """See DB.get_monthly_sums"""
+        return self._shard(chat_id).get_monthly_sums(chat_id, tag,
+                                                     time_period)
+
+    def get_columns(self, chat_id, tag=None, time_period=None):
+        """See DB.get_columns"""
+        return self._shard(chat_id).get_columns(chat_id, tag, time_period)
+
+    def get_entries(self, chat_id, tag=None, time_period=None):
+        """See DB.get_entries"""
+        entries = self._shard(chat_id).get_entries(chat_id, tag, time_period)
+        return list(self._global_entries(chat_id, entries))
+
+    def get_entries_page(self, chat_id, tag=None, time_period=None,
+                         after=None, limit=20, before=None):
+        """See DB.get_entries_page"""
+        # Die lokalen Ids haben innerhalb eines Shards dieselbe Reihenfolge
+        # wie die globalen
+        if after:
+            date, e_id = after
+            after = (date, self._entry_id(e_id)[1])
+        if before:
+            date, e_id = before
+            before = (date, self._entry_id(e_id)[1])
+        entries = self._shard(chat_id).get_entries_page(
+            chat_id, tag, time_period, after, limit, before)
+        return list(self._global_entries(chat_id, entries))
+
+    def iter_entries(self, chat_id, tag=None, time_period=None,
+                     chunk_size=None):
+        """See DB.iter_entries"""
+        entries = self._shard(chat_id).iter_entries(chat_id, tag, time_period,
+                                                    chunk_size)
+        return self._global_entries(chat_id, entries)
+
+    def update_entry(self, entry):
+        """See DB.update_entry"""
+        shard, e_id = self._entry_id(entry[0])
+        return shard.update_entry((e_id,) + tuple(entry[1:]))
+
+    def remove_entry(self, e_id):
+        """See DB.remove_entry"""
+        shard, e_id = self._entry_id(e_id)
+        return shard.remove_entry(e_id)
+
+    def rebuild_daily_sum(self):
+        """Recomputes the daily sums of all shards
+
+        :return: Number of rows in DailySum of all shards afterwards
+        """
+        return sum(shard.rebuild_daily_sum() for shard in self.shards)
+
+    def verify_daily_sum(self):
+        """Compares the daily sums with the entries in all shards
+
+        :return: List of differing days like DB.verify_daily_sum, the tag ids
+        refer to the shard of the user
+        """
+        differences = []
+        for shard in self.shards:
+            differences += shard.verify_daily_sum()
+        return differences
+
+    def warm_up(self, chats):
+        """Loads the tags of the most recently active users of all shards
+
+        :param chats: Number of users, split evenly between the shards
+        :return: Number of users whose tags were loaded
+        """
+        per_shard = -(-chats // len(self.shards))
+        return sum(shard.warm_up(per_shard) for shard in self.shards)
+
+    def admin_query(self, command, param=()):
+        """Runs a read query on every shard
+
+        Meant for maintenance and statistics over all users. The query is
+        executed on the read connections of the shards, one after another.
+
+        :param command: SQL of the query
+        :param param: Parameters of the query
+        :return: List of the result rows of all shards, each prefixed with
+        the index of its shard
+        """
+        rows = []
+        for index, shard in enumerate(self.shards):
+            rows += [(index,) + row
+                     for row in shard.admin_query(command, param)]
+        return rows
+
+
+def reshard(sources, db_name, shards, batch_size=50000):
+    """Distributes the users of existing databases to new shards
+
+    Meant to be run while the bot is stopped. Tags and entries are copied
+    user by user, the daily sums are recomputed afterwards. The ids of the
+    entries change, so running conversations should be reset (State_DB).
+
+    :param sources: Names of the existing database files, e.g. a single
+    SpendingCalcData.db or the shards of another number of shards
+    :param db_name: Name of the new database (see shard_names)
+    :param shards: Number of new shards
+    :param batch_size: Number of entries copied per executemany
+    :return: dict with the number of copied users, tags and entries and the
+    skipped entries without user
+    """
+    names = shard_names(db_name, shards)
+    existing = [name for name in names if os.path.exists(name)]
+    if existing:
+        raise FileExistsError('Shards already exist: ' + ', '.join(existing))
+    counts = {'users': 0, 'tags': 0, 'entries': 0, 'skipped': 0}
+
+    targets = [DB(name) for name in names]
+    try:
+        for source_name in sources:
+            source = DB(source_name)
+            try:
+                _copy_users(source, targets, batch_size, counts)
+            finally:
+                source.close()
+        for target in targets:
+            target.rebuild_daily_sum()
+    finally:
+        for target in targets:
+            target.close()
+    return counts
+
+
+def _copy_users(source, targets, batch_size, counts):
+    """Copies all users of a database to the new shards
+
+    :param source: DB to copy from
+    :param targets: List of the DBs of the new shards
+    :param batch_size: Number of entries copied per executemany
+    :param counts: dict with the counters of reshard
+    """
+    cursor = source.conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM Entry WHERE ChatID IS NULL')
+    counts['skipped'] += cursor.fetchone()[0]
+    cursor.execute('SELECT DISTINCT ChatID FROM Tags ORDER BY ChatID')
+    for (chat_id,) in cursor.fetchall():
+        target = targets[shard_of(chat_id, len(targets))]
+        target_cursor = target.conn.cursor()
+
+        # Tags mit neuen Ids anlegen
+        tag_ids = {}
+        reader = source.conn.cursor()
+        reader.execute('SELECT T_ID, Tag, Position FROM Tags '
+                       'WHERE ChatID = ? ORDER BY T_ID', (chat_id,))
+        for tag_id, tag, position in reader.fetchall():
+            target_cursor.execute('INSERT INTO Tags (ChatID, Tag, Position) '
+                                  'VALUES (?, ?, ?)',
+                                  (chat_id, tag, position))
+            tag_ids[tag_id] = target_cursor.lastrowid
+
+        # Einträge blockweise in der ursprünglichen Reihenfolge kopieren
+        reader.execute('SELECT Tag, Value, Date, Comment FROM Entry '
+                       'WHERE ChatID = ? ORDER BY E_ID', (chat_id,))
+        while True:
+            batch = reader.fetchmany(batch_size)
+            if not batch:
+                break
+            target_cursor.executemany(
+                'INSERT INTO Entry (ChatID, Tag, Value, Date, Comment) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(chat_id, tag_ids[tag], value, date, comment)
+                 for tag, value, date, comment in batch])
+            counts['entries'] += len(batch)
+        target.conn.commit()
+        counts['users'] += 1
+        counts['tags'] += len(tag_ids)
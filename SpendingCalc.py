@@ -1,8 +1,29 @@
+# Zuerst importieren, damit die Dauer der übrigen Imports gemessen wird
+from Startup import Deferred, StartupReport
 from telegram.ext import Updater, Filters
 from telegram.ext import ConversationHandler, CommandHandler, MessageHandler
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove
-from DB import DB
+from telegram.error import BadRequest
+from DB import DB, resolve_period
+from ShardedDB import ShardedDB
+from AsyncDB import AsyncDB
+from StateStore import StateStore, create_state_store
+from Metrics import Metrics
+from BulkImport import ImportReport, InvalidFileError, open_csv, read_rows
+from Charts import ChartCache
+from Outbound import Outbound, wait_sent
+from Buttons import ButtonHandler, CallbackHandler, callback_data
+from Buttons import inline_keyboard
+import Export
+import Workers
 import datetime
+import functools
+import hashlib
+import importlib
+import os
+import re
+import tempfile
+import threading
 
 # Konstanten für Zustände festlegen
 MAIN = 0
@@ -11,6 +32,7 @@ ENTER_VALUE = 11
 ENTER_TAG = 12
 ENTER_DATE = 13
 ENTER_COMMENT = 14
+ENTER_BATCH = 15
 ANALYSIS = 20
 ANALYSIS_TIME = 21
 ANALYSIS_TAG = 22
@@ -23,11 +45,98 @@ EDIT_COMMENT = 253
 EDIT_SAVE = 254
 EDIT_REMOVE = 255
 
-# Verbindung zur Datenbank
+# Anzahl der Einträge pro Seite und maximale Länge einer Nachricht
+PAGE_SIZE = 20
+MESSAGE_LIMIT = 4096
+
+# Im Inline-Modus wird eine Seite als eine Nachricht bearbeitet, daher werden
+# die Kommentare der Einträge darauf gekürzt
+INLINE_COMMENT_LENGTH = 80
+# Längere Kategorien werden in den Callback-Daten durch einen Hash ersetzt,
+# damit die Buttons unter CALLBACK_DATA_LIMIT bleiben
+INLINE_TAG_BYTES = 20
+INLINE_EXPIRED = 'Die Auswahl ist abgelaufen, bitte nochmal auswählen!'
+SESSION_EXPIRED = 'Die Eingabe ist abgelaufen, bitte nochmal beginnen!'
+
+# Muster für eingegebene Beträge und Daten
+AMOUNT_PATTERN = re.compile(r'^-?\d+((\.|,)\d{1,2})?€?$')
+DATE_PATTERN = re.compile(
+    r'^\d{1,2}(\.|-| )\d{1,2}((\.|-| )?|((\.|-| )(\d{2}|\d{4})))?$')
+
+# Schreibzugriffe laufen ohne Frist: eine abgelaufene Frist hält einen
+# begonnenen Schreibzugriff nicht auf, ein erneuter Versuch des Nutzers würde
+# den Eintrag doppelt speichern
+WRITE_METHODS = frozenset(('add_tag', 'add_entry', 'add_entries',
+                           'update_entry', 'remove_entry'))
+
+# Bezeichnungen der Zeiträume des Analyse-Menüs
+PERIOD_NAMES = {'7day': '7 Tage',
+                '30day': '30 Tage',
+                'month': 'Diesen Monat',
+                'year': 'Dieses Jahr',
+                'all': 'Alle'}
+
+# Standardwerte für nicht gesetzte Einstellungen der Config-Datei
+DEFAULT_CONFIG = {'Telegram_Bot_Token': None,
+                  'Write_Behind': '0',
+                  'DB_Readers': '0',
+                  'DB_Shards': '1',
+                  'DB_Workers': '4',
+                  'DB_Timeout': '10',
+                  'Worker_Processes': '1',
+                  'Lazy_Start': '0',
+                  'Warm_Up_Chats': '100',
+                  'Inline_UI': '0',
+                  'Result_Cache_Size': '256',
+                  'State_Store': 'memory',
+                  'State_TTL': '3600',
+                  'State_Max_Chats': '10000',
+                  'State_DB': 'SpendingCalcState.db',
+                  'Mode': 'polling',
+                  'Webhook_Listen': '127.0.0.1',
+                  'Webhook_Port': '8443',
+                  'Webhook_Path': 'telegram',
+                  'Webhook_Secret': '',
+                  'Webhook_URL': '',
+                  'Webhook_Max_Connections': '40',
+                  'Metrics': '0',
+                  'Metrics_Listen': '127.0.0.1',
+                  'Metrics_Port': '',
+                  'Metrics_File': '',
+                  'Metrics_Interval': '15',
+                  'Admin_IDs': '',
+                  'Slow_Update_Threshold': '1',
+                  'Slow_Update_Log': 'SlowUpdates.log',
+                  'Chart_Cache_Size': '64',
+                  'Chart_Cache_Dir': '',
+                  'Chart_Cache_Files': '1000',
+                  'Outbound': '0',
+                  'Outbound_Rate': '30',
+                  'Outbound_Chat_Rate': '1',
+                  'Outbound_Chat_Burst': '3',
+                  'Outbound_Group_Rate': '0.33',
+                  'Outbound_Workers': '4'}
+
+# Verbindung zur Datenbank und Thread-Pool für deren Abfragen
 db = None
+db_async = None
 
-# Zwischenspeicher für Daten
-data = {}
+# Zwischenspeicher für Daten der laufenden Unterhaltungen
+data = StateStore()
+
+# Gerenderte Diagramme und die file_ids der gesendeten Diagramme
+charts = ChartCache()
+
+# Messwerte (nur wenn aktiviert) und Nutzer, die /stats verwenden dürfen
+metrics = None
+admin_ids = set()
+
+# Warteschlange für alle gesendeten Nachrichten (nur wenn aktiviert)
+outbound = None
+
+# Bedienung über Inline-Buttons, die ihre Nachricht bearbeiten, statt über
+# Antwort-Tastaturen
+inline_ui = False
 
 
 def load_config():
@@ -35,7 +144,7 @@ def load_config():
 
     :return: dict with keys and values in the config file
     """
-    config = {'Telegram_Bot_Token': None}
+    config = dict(DEFAULT_CONFIG)
     with open('config.txt') as file:
         for line in file:
             key, value = line.strip().split('=', 1)
@@ -43,66 +152,131 @@ def load_config():
     return config
 
 
+def state_names():
+    """Returns the names of the conversation states
+
+    :return: dict with the state constants and their names
+    """
+    return {value: name for name, value in globals().items()
+            if name.isupper() and isinstance(value, int)
+            and name not in ('PAGE_SIZE', 'MESSAGE_LIMIT',
+                             'INLINE_COMMENT_LENGTH', 'INLINE_TAG_BYTES')}
+
+
+def handle_expired(callback):
+    """Wraps a handler to return to the main menu if the data of the chat
+    is missing
+
+    The data of a chat can expire or be evicted (see StateStore) while its
+    conversation is still running, then reading it raises a KeyError of the
+    chat_id.
+
+    :param callback: Callback of the handler
+    :return: Wrapped callback
+    """
+    @functools.wraps(callback)
+    def wrapped(update, context):
+        try:
+            return callback(update, context)
+        except KeyError as e:
+            # Nur fehlende Daten des Chats abfangen, nicht andere Schlüssel
+            if e.args != (update.effective_chat.id,):
+                raise
+        if inline_ui:
+            return inline_menu(update, context, INLINE_EXPIRED)
+        update.message.reply_text(SESSION_EXPIRED)
+        return main_menu(update, context)
+
+    return wrapped
+
+
 def register_handlers(dispatcher):
     """Register all handlers for messages send to the bot
 
+    With inline_ui the conversation is handled by register_inline_handlers
+    instead of the ConversationHandler.
+
     :param dispatcher: The bots dispatcher
     """
-    # ConversationHandler hinzufügen
+    # Vor dem ConversationHandler, damit /stats, Statistiken, Importe und
+    # Exporte in jedem Zustand funktionieren
+    dispatcher.add_handler(CommandHandler('stats', stats))
+    dispatcher.add_handler(CommandHandler('statistik', statistics,
+                                          run_async=True))
+    dispatcher.add_handler(CommandHandler('export', export, run_async=True))
+    dispatcher.add_handler(MessageHandler(Filters.document, import_document,
+                                          run_async=True))
+
+    if inline_ui:
+        register_inline_handlers(dispatcher)
+        return
+
+    # ConversationHandler hinzufügen; Buttons werden über ihre Beschriftung
+    # nachgeschlagen, nur andere Eingaben werden mit Mustern geprüft
     main_menu_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
-            MAIN: [MessageHandler(Filters.regex('^(Eintragen)$'), enter_menu),
-                   MessageHandler(Filters.regex('^(Analyse)$'), analysis_menu)],
-            ENTER: [MessageHandler(Filters.regex(r'^-?\d+((\.|,)\d{1,2})?€?$'),
-                                   enter_value),
-                    MessageHandler(Filters.text, invalid)],
-            ENTER_VALUE: [MessageHandler(Filters.text, enter_tag)],
-            ENTER_TAG: [MessageHandler(Filters.text, enter_date)],
-            ENTER_DATE: [MessageHandler(Filters.regex('^(Nein & Speichern)$'),
-                                        enter_save),
-                         MessageHandler(Filters.regex('^(Ja)$'), enter_comment),
-                         MessageHandler(Filters.text, invalid)],
-            ENTER_COMMENT: [MessageHandler(Filters.text, enter_save)],
-            ANALYSIS: [MessageHandler(Filters.regex('^(Zurück)$'), back),
-                       MessageHandler(Filters.regex(
-                           '^(7 Tage|30 Tage|Diesen Monat|Dieses Jahr|Alle)$'),
-                           analysis_time),
-                       MessageHandler(Filters.text, invalid)],
-            ANALYSIS_TIME: [MessageHandler(Filters.text, analysis_tag)],
-            ANALYSIS_TAG: [MessageHandler(Filters.regex('^(Zurück)$'), back),
-                           MessageHandler(Filters.regex(
-                               '^(Einträge anzeigen)$'), analysis_show),
-                           MessageHandler(Filters.text, invalid)],
-            ANALYSIS_SHOW: [MessageHandler(Filters.regex('^(Nein)$'), back),
-                            MessageHandler(Filters.regex('^(Ja)$'),
-                                           analysis_select)],
-            ANALYSIS_SELECT: [MessageHandler(Filters.text, analysis_edit)],
-            ANALYSIS_EDIT: [MessageHandler(Filters.regex('^(Zurück)$'), back),
-                            MessageHandler(Filters.regex(
-                                '^(Betrag bearbeiten|Datum bearbeiten|'
-                                'Kommentar bearbeiten|Eintrag löschen)$'),
-                                analysis_edit_select),
-                            MessageHandler(Filters.text, invalid)],
-            EDIT_VALUE: [MessageHandler(Filters.regex(
-                         r'^-?\d+((\.|,)\d{1,2})?€?$'),
-                         analysis_edit_value),
-                         MessageHandler(Filters.text, invalid)],
-            EDIT_DATE: [MessageHandler(Filters.regex(
-               r'^\d{1,2}(\.|-| )\d{1,2}((\.|-| )?|((\.|-| )(\d{2}|\d{4})))?$'),
-                        analysis_edit_date),
-                        MessageHandler(Filters.text, invalid)],
-            EDIT_COMMENT: [MessageHandler(Filters.text, analysis_edit_comment)],
-            EDIT_SAVE: [MessageHandler(Filters.regex('^(Nein)$'), back),
-                        MessageHandler(Filters.regex('^(Ja)$'),
-                                       analysis_save)],
-            EDIT_REMOVE: [MessageHandler(Filters.regex('^(Nein)$'), back),
-                          MessageHandler(Filters.regex('^(Ja)$'),
-                                         analysis_remove_entry),
-                          MessageHandler(Filters.text, invalid)]
+            MAIN: [ButtonHandler({'Eintragen': enter_menu,
+                                  'Analyse': analysis_menu,
+                                  'Zurück': back})],
+            ENTER: [ButtonHandler(patterns=[(AMOUNT_PATTERN, enter_value)],
+                                  fallback=enter_batch)],
+            ENTER_VALUE: [ButtonHandler(fallback=enter_tag)],
+            ENTER_TAG: [ButtonHandler({'Zurück': back},
+                                      fallback=enter_date)],
+            ENTER_DATE: [ButtonHandler({'Nein & Speichern': enter_save,
+                                        'Ja': enter_comment},
+                                       fallback=invalid)],
+            ENTER_COMMENT: [ButtonHandler(fallback=enter_save)],
+            ENTER_BATCH: [ButtonHandler({'Nein': back,
+                                         'Ja': enter_batch_save},
+                                        fallback=invalid)],
+            ANALYSIS: [ButtonHandler(
+                {'Zurück': back,
+                 **dict.fromkeys(PERIOD_NAMES.values(), analysis_time)},
+                fallback=invalid)],
+            ANALYSIS_TIME: [ButtonHandler(fallback=analysis_tag)],
+            # Diagramme werden gerendert und hochgeladen, das soll andere
+            # Updates nicht aufhalten
+            ANALYSIS_TAG: [ButtonHandler({'Diagramm anzeigen': analysis_chart},
+                                         run_async=True),
+                           ButtonHandler({'Zurück': back,
+                                          'Einträge anzeigen': analysis_show},
+                                         fallback=invalid)],
+            ANALYSIS_SHOW: [ButtonHandler(
+                {'Nein': back,
+                 'Zurück': back,
+                 'Ja': analysis_select,
+                 'Weiter »': analysis_next_page,
+                 '« Zurück': analysis_previous_page})],
+            ANALYSIS_SELECT: [ButtonHandler(fallback=analysis_edit)],
+            ANALYSIS_EDIT: [ButtonHandler(
+                {'Zurück': back,
+                 **dict.fromkeys(['Betrag bearbeiten', 'Datum bearbeiten',
+                                  'Kommentar bearbeiten', 'Eintrag löschen'],
+                                 analysis_edit_select)},
+                fallback=invalid)],
+            EDIT_VALUE: [ButtonHandler(
+                patterns=[(AMOUNT_PATTERN, analysis_edit_value)],
+                fallback=invalid)],
+            EDIT_DATE: [ButtonHandler(
+                patterns=[(DATE_PATTERN, analysis_edit_date)],
+                fallback=invalid)],
+            EDIT_COMMENT: [ButtonHandler(fallback=analysis_edit_comment)],
+            EDIT_SAVE: [ButtonHandler({'Nein': back, 'Ja': analysis_save})],
+            EDIT_REMOVE: [ButtonHandler({'Nein': back,
+                                         'Ja': analysis_remove_entry},
+                                        fallback=invalid)]
         },
         fallbacks=[],
+        # Unterhaltungen enden zusammen mit ihren zwischengespeicherten Daten
+        conversation_timeout=data.ttl,
+        name='main_menu',
+        persistent=dispatcher.persistence is not None
     )
+    for handlers in main_menu_handler.states.values():
+        for handler in handlers:
+            handler.replace_callbacks(handle_expired)
 
     dispatcher.add_handler(main_menu_handler)
 
@@ -119,6 +293,131 @@ def start(update, context):
     return main_menu(update, context)
 
 
+def stats(update, context):
+    """Sends the collected metrics to admins after using /stats
+
+    Other users get no answer, so the command stays hidden.
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    """
+    if metrics is None or update.effective_user.id not in admin_ids:
+        return
+    update.message.reply_text(metrics.summary()[:MESSAGE_LIMIT])
+
+
+def statistics(update, context):
+    """Sends statistics of the entries after using /statistik
+
+    A time period can be given like in resolve_period, e.g. '/statistik
+    year' or '/statistik 2021-01-01..2021-06-30'. Runs asynchronously, the
+    conversation is not affected.
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    """
+    chat_id = update.effective_chat.id
+    time_period = ' '.join(context.args or []) or None
+
+    try:
+        resolve_period(time_period)
+    except ValueError:
+        update.message.reply_text(
+            'Unbekannter Zeitraum! Möglich sind z.B. 30day, month, year, '
+            'last_month oder 2021-01-01..2021-06-30.')
+        return
+
+    try:
+        rows = db_async.call('get_columns', chat_id, time_period=time_period)
+    except TimeoutError:
+        update.message.reply_text(
+            'Die Anfrage hat zu lange gedauert, bitte nochmal versuchen!')
+        return
+    # NumPy erst bei Bedarf laden, das beschleunigt den Start
+    from Statistics import Statistics
+
+    # Bei vielen Kategorien auf mehrere Nachrichten verteilen
+    lines = Statistics(rows).summary().splitlines(keepends=True)
+    for message in split_message(lines):
+        update.message.reply_text(message)
+
+
+def import_document(update, context):
+    """Imports the entries of a CSV file sent to the bot
+
+    Runs asynchronously, as downloading and importing large files takes a
+    while. The conversation is not affected. With the caption 'Umkehren' the
+    sign of the values is inverted (for bank statements). The entries are
+    saved in batches (see DB.add_entries), if the import fails the batches
+    saved before are kept.
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    """
+    chat_id = update.effective_chat.id
+    document = update.message.document
+
+    if not (document.file_name or '').lower().endswith(('.csv', '.txt')):
+        update.message.reply_text(
+            'Zum Importieren bitte eine CSV-Datei mit den Spalten Datum und '
+            'Betrag (optional Kategorie und Kommentar) senden!')
+        return
+
+    # Kontoauszüge führen Ausgaben als negative Beträge
+    invert = (update.message.caption or '').strip().lower() == 'umkehren'
+
+    update.message.reply_text('Import läuft...')
+    report = ImportReport()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'import.csv')
+        context.bot.get_file(document.file_id).download(custom_path=path)
+        try:
+            with open_csv(path, report=report) as file:
+                rows = read_rows(file, report, invert=invert)
+                # Große Dateien brauchen länger als DB_Timeout
+                db_async.call('add_entries', chat_id, rows, timeout=0)
+        except InvalidFileError as e:
+            update.message.reply_text('Import fehlgeschlagen: {}'.format(e))
+            return
+        except BaseException as e:
+            # Die Einträge werden blockweise gespeichert
+            update.message.reply_text(
+                'Import abgebrochen, bereits gespeicherte Einträge bleiben '
+                'erhalten.')
+            raise e
+    update.message.reply_text(report.summary()[:MESSAGE_LIMIT])
+
+
+def export(update, context):
+    """Sends all entries as a file after using /export
+
+    '/export json' sends NDJSON instead of CSV, adding 'gz' compresses the
+    file. Runs asynchronously, the conversation is not affected.
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    """
+    chat_id = update.effective_chat.id
+    options = [arg.lower() for arg in context.args or []]
+    export_format = 'ndjson' if 'json' in options else 'csv'
+    compress = 'gz' in options
+
+    with tempfile.TemporaryDirectory() as directory:
+        name = Export.file_name(export_format, compress,
+                                datetime.date.today())
+        path = os.path.join(directory, name)
+        count = Export.export_entries(db, chat_id, path, export_format,
+                                      compress)
+        if not count:
+            update.message.reply_text('Keine Einträge vorhanden.')
+            return
+        # Die Datei erst nach dem Hochladen schließen und löschen
+        with open(path, 'rb') as file:
+            wait_sent(update.message.reply_document(
+                file, filename=name,
+                caption='{} Einträge exportiert.'.format(count)))
+
+
 def main_menu(update, context):
     """Handling the main menu
 
@@ -144,7 +443,9 @@ def enter_menu(update, context):
     :return: Status for enter menu
     """
     update.message.reply_text(
-        'Welchen Betrag möchtest du eintragen?',
+        'Welchen Betrag möchtest du eintragen?\n\nMehrere Einträge auf '
+        'einmal: eine Zeile pro Eintrag mit Betrag, Kategorie, optional '
+        'Datum und Kommentar, z.B. "12,50 Essen 3.4. Pizza"',
         reply_markup=ReplyKeyboardRemove()
     )
     return ENTER
@@ -165,11 +466,13 @@ def enter_value(update, context):
 
     # Eingegebenen Wert zu Zahl konvertieren
     value = float(message.strip().replace(',', '.').replace('€', ''))
+    tags = load_tags(update, chat_id)
+    if tags is None:
+        return None
     data[chat_id] = {'value': value,
                      'comment': None}
 
-    # Tags laden und als Keyboard anzeigen
-    tags = db.get_tags(chat_id)
+    # Tags als Keyboard anzeigen
     data[chat_id]['tags'] = tags
     keyboard = []
     for tag in tags:
@@ -202,22 +505,28 @@ def enter_tag(update, context):
 
     tag = message.strip()
     data[chat_id]['tag'] = tag
+    value = data[chat_id]['value']
+
+    def answer_date(result=None):
+        keyboard = [['Heute'], ['Gestern']]
+
+        update.message.reply_text(
+            ('Betrag: {:.2f}€\nTag: {}\n\nFür welches Datum? '
+             '(Bitte eingeben oder auswählen)')
+            .format(value, tag),
+            reply_markup=ReplyKeyboardMarkup(keyboard)
+        )
 
     # Überprüfen, ob Tag erst angelegt werden muss
     if tag not in data[chat_id]['tags']:
         # Der Tag 'Alle' ist ungültig (und macht auch keinen Sinn)
         if tag == 'Alle':
             return invalid(update, context)
-        db.add_tag(chat_id, tag)
-
-    keyboard = [['Heute'], ['Gestern']]
-
-    update.message.reply_text(
-        ('Betrag: {:.2f}€\nTag: {}\n\nFür welches Datum? '
-         '(Bitte eingeben oder auswählen)')
-        .format(data[chat_id]['value'], tag),
-        reply_markup=ReplyKeyboardMarkup(keyboard)
-    )
+        # Erst nach dem Speichern nach dem Datum fragen, schlägt es fehl,
+        # führt 'Zurück' ins Hauptmenü
+        query(update, context, answer_date, 'add_tag', chat_id, tag)
+    else:
+        answer_date()
     return ENTER_TAG
 
 
@@ -279,6 +588,8 @@ def enter_comment(update, context):
 def enter_save(update, context):
     """Saves the entered data to the database
 
+    The confirmation is sent once the entry is stored.
+
     :param update: Update of the sent message
     :param context: Context of the sent message
     :return: Status for main menu
@@ -295,14 +606,76 @@ def enter_save(update, context):
     if comment:
         comment = message.strip()
 
-    # Eintrag in Datenbank schreiben
-    db.add_entry(chat_id, tag, value, date, comment)
+    # Zwischengespeicherte Daten löschen
+    data.pop(chat_id, None)
+
+    def saved(result):
+        update.message.reply_text('Erfolgreich eingetragen!')
+        main_menu(update, context)
+
+    # Eintrag in Datenbank schreiben, Antwort sobald er gespeichert ist
+    query(update, context, saved, 'add_entry', chat_id, tag, value, date,
+          comment)
+    return MAIN
+
+
+def enter_batch(update, context):
+    """Handling a message with several entries, one per line
+
+    Shows all parsed entries and asks for confirmation before saving them.
+    Invalid lines are listed and skipped.
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    :return: Status for batch entry
+    """
+    chat_id = update.effective_chat.id
+    message = update.message.text
+
+    tags = load_tags(update, chat_id)
+    if tags is None:
+        return None
+    rows, invalid_lines = parse_batch(message, tags)
+    if not rows:
+        return invalid(update, context)
+    data[chat_id] = {'batch': rows}
+
+    question = 'Sollen die Einträge gespeichert werden?'
+
+    # Nachrichten dürfen höchstens MESSAGE_LIMIT Zeichen lang sein
+    chunks = split_message(batch_summary(rows, invalid_lines) + [question])
+    for chunk in chunks[:-1]:
+        update.message.reply_text(chunk)
+    update.message.reply_text(
+        chunks[-1],
+        reply_markup=ReplyKeyboardMarkup([['Ja'], ['Nein']])
+    )
+    return ENTER_BATCH
+
+
+def enter_batch_save(update, context):
+    """Saves the confirmed entries of enter_batch
+
+    All entries and new tags are written in one transaction, the
+    confirmation is sent once they are stored.
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    :return: Status for main menu
+    """
+    chat_id = update.effective_chat.id
+    rows = data[chat_id]['batch']
 
     # Zwischengespeicherte Daten löschen
     data.pop(chat_id, None)
 
-    update.message.reply_text('Erfolgreich eingetragen!')
-    return main_menu(update, context)
+    def saved(result):
+        update.message.reply_text(
+            '{} Einträge erfolgreich eingetragen!'.format(len(rows)))
+        main_menu(update, context)
+
+    query(update, context, saved, 'add_entries', chat_id, rows)
+    return MAIN
 
 
 def analysis_menu(update, context):
@@ -341,6 +714,9 @@ def analysis_time(update, context):
     chat_id = update.effective_chat.id
     message = update.message.text
 
+    tags = load_tags(update, chat_id)
+    if tags is None:
+        return None
     data[chat_id] = {}
 
     # Zeitfenster anhand der gewählten Antwort auswählen
@@ -356,8 +732,7 @@ def analysis_time(update, context):
     elif message == 'Alle':
         data[chat_id]['period'] = 'all'
 
-    # Tags laden und als Keyboard anzeigen
-    tags = db.get_tags(chat_id)
+    # Tags als Keyboard anzeigen
     data[chat_id]['tags'] = tags
     keyboard = [['Alle']]
     for tag in tags:
@@ -382,86 +757,263 @@ def analysis_tag(update, context):
 
     tag = data[chat_id]['tag'] = message.strip()
     time_period = data[chat_id]['period']
-    show_total = False
 
     # Überprüfen, ob ausgewählter Tag existiert, oder 'Alle' ist
-    # Ergebnisse aus Datenbank laden
-    if tag == 'Alle':
-        result = db.get_entry_sum(chat_id, time_period=time_period)
-        show_total = True
-    elif tag in data[chat_id]['tags']:
-        result = db.get_entry_sum(chat_id, tag=tag, time_period=time_period)
-    else:
+    if tag != 'Alle' and tag not in data[chat_id]['tags']:
         return invalid(update, context)
+    show_total = tag == 'Alle'
 
-    # Antwort-Nachricht erstellen
-    answer = ''
-    total = 0
-    for tag in result:
-        answer += '{}: {:.2f}€\n'.format(tag[0], tag[1])
-        total += float(tag[1])
+    def answer_sum(result):
+        # Antwort-Nachricht erstellen
+        answer = ''
+        total = 0
+        for tag in result:
+            answer += '{}: {:.2f}€\n'.format(tag[0], tag[1])
+            total += float(tag[1])
 
-    if show_total:
-        answer += 'Gesamt: {:.2f}€\n'.format(total)
-    answer += '\nMöchtest du die Einträge anzeigen lassen?'
+        if show_total:
+            answer += 'Gesamt: {:.2f}€\n'.format(total)
+        answer += '\nMöchtest du die Einträge anzeigen lassen?'
 
-    keyboard = [['Einträge anzeigen'],
-                ['Zurück']]
+        keyboard = [['Einträge anzeigen'],
+                    ['Diagramm anzeigen'],
+                    ['Zurück']]
 
-    update.message.reply_text(
-        answer,
-        reply_markup=ReplyKeyboardMarkup(keyboard)
-    )
+        update.message.reply_text(
+            answer,
+            reply_markup=ReplyKeyboardMarkup(keyboard)
+        )
+
+    # Ergebnisse aus Datenbank laden
+    query(update, context, answer_sum, 'get_entry_sum', chat_id,
+          tag=None if show_total else tag, time_period=time_period)
+    return ANALYSIS_TAG
+
+
+def chart_view(chat_id, title, show_tags, time_period):
+    """Returns the view of a chart for charts.send_view
+
+    The view contains the data version of the chat, so a chart sent for it
+    stays valid until the entries of the chat change. Has to be called
+    before the query, like in DB.cached_query.
+
+    :param chat_id: Telegram chat_id of the user
+    :param title: Title of the chart
+    :param show_tags: Whether the chart includes a pie chart of the tags
+    :param time_period: Time period of the chart (see resolve_period)
+    :return: Tuple or None while the database is still being opened
+    """
+    # Nicht im Handler auf die im Hintergrund geöffnete Datenbank warten
+    if isinstance(db, Deferred) and not db.ready:
+        return None
+    return (chat_id, title, show_tags, resolve_period(time_period),
+            db.data_version(chat_id))
+
+
+def analysis_chart(update, context):
+    """Sending a chart of the selected spendings
+
+    For all tags a pie chart of the tags is shown next to the monthly sums.
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    :return: Status for tag selection
+    """
+    chat_id = update.effective_chat.id
+    tag = data[chat_id]['tag']
+    time_period = data[chat_id]['period']
+    show_tags = tag == 'Alle'
+    title = '{} - {}'.format(tag, PERIOD_NAMES[time_period])
+    keyboard = ReplyKeyboardMarkup([['Einträge anzeigen'],
+                                    ['Zurück']])
+    # Unveränderte Diagramme ohne Abfrage senden
+    view = chart_view(chat_id, title, show_tags, time_period)
+    if view and charts.send_view(update.message, view,
+                                 reply_markup=keyboard):
+        return ANALYSIS_TAG
+
+    def answer_chart(result):
+        if not result:
+            update.message.reply_text('Keine Einträge vorhanden.',
+                                      reply_markup=keyboard)
+            return
+        charts.send(update.message, title, result, show_tags, view=view,
+                    reply_markup=keyboard)
+
+    query(update, context, answer_chart, 'get_monthly_sums', chat_id,
+          tag=None if show_tags else tag, time_period=time_period)
     return ANALYSIS_TAG
 
 
 def analysis_show(update, context):
-    """Sending all selected entries
+    """Sending the first page of the selected entries
 
     :param update: Update of the sent message
     :param context: Context of the sent message
     :return: Status for shown entries
     """
     chat_id = update.effective_chat.id
-    time_period = data[chat_id]['period']
     tag = data[chat_id]['tag']
 
-    # Einträge je nach Auswahl aus der Datenbank laden
-    if tag == 'Alle':
-        result = db.get_entries(chat_id, time_period=time_period)
-    elif tag in data[chat_id]['tags']:
-        result = db.get_entries(chat_id, tag=tag, time_period=time_period)
-    else:
+    # Nur bekannte Tags oder 'Alle' anzeigen
+    if tag != 'Alle' and tag not in data[chat_id]['tags']:
         return invalid(update, context)
 
-    # Einträge zwischenspeichern
-    data[chat_id]['entries'] = result
-
-    answer = ''
-    for i in range(len(result)):
-        entry = result[i]
-        y, m, d = entry[3].split('-')
-        date = '{}.{}.{}'.format(int(d), int(m), int(y))
-        if entry[4]:
-            answer += '({}) {:.2f}€ - {}\n{}: {}\n\n'.format(
-                i + 1, entry[1], date, entry[2], entry[4])
-        else:
-            answer += '({}) {:.2f}€ - {}\n{}\n\n'.format(
-                i + 1, entry[1], date, entry[2])
+    # Position des letzten Eintrags jeder bisher angezeigten Seite
+    data[chat_id]['pages'] = [None]
+    return show_page(update, context)
 
-    answer += 'Möchtest du einen Eintrag bearbeiten?'
 
-    keyboard = [['Ja'],
-                ['Nein']]
+def show_page(update, context):
+    """Sending the current page of the selected entries
 
-    update.message.reply_text(
-        answer,
-        reply_markup=ReplyKeyboardMarkup(keyboard)
-    )
+    The entries are numbered over all pages, so the numbers stay the same
+    when going back and forth.
 
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    :return: Status for shown entries
+    """
+    chat_id = update.effective_chat.id
+    time_period = data[chat_id]['period']
+    tag = data[chat_id]['tag']
+    pages = data[chat_id]['pages']
+
+    def answer_page(result):
+        # Verwerfen, wenn der Nutzer die Seite inzwischen verlassen hat
+        state = data.get(chat_id)
+        if not state or len(state.get('pages', ())) != len(pages):
+            return
+
+        has_next = len(result) > PAGE_SIZE
+        result = result[:PAGE_SIZE]
+        offset = (len(pages) - 1) * PAGE_SIZE
+
+        # Einträge der aktuellen Seite zwischenspeichern
+        data[chat_id]['entries'] = result
+        data[chat_id]['offset'] = offset
+        data[chat_id]['has_next'] = has_next
+
+        lines = [format_entry(offset + i + 1, entry)
+                 for i, entry in enumerate(result)]
+
+        question = 'Möchtest du einen Eintrag bearbeiten?'
+        navigation = []
+        if len(pages) > 1:
+            navigation.append('« Zurück')
+        if has_next:
+            navigation.append('Weiter »')
+        keyboard = [['Ja'],
+                    ['Nein']]
+        if navigation:
+            keyboard.append(navigation)
+
+        # Nachrichten dürfen höchstens MESSAGE_LIMIT Zeichen lang sein
+        chunks = split_message(lines + [question])
+        for chunk in chunks[:-1]:
+            update.message.reply_text(chunk)
+        update.message.reply_text(
+            chunks[-1],
+            reply_markup=ReplyKeyboardMarkup(keyboard)
+        )
+
+    # Einen Eintrag mehr laden, um zu erkennen ob eine weitere Seite folgt
+    query(update, context, answer_page, 'get_entries_page', chat_id,
+          tag=None if tag == 'Alle' else tag, time_period=time_period,
+          after=pages[-1], limit=PAGE_SIZE + 1)
     return ANALYSIS_SHOW
 
 
+def analysis_next_page(update, context):
+    """Showing the next page of the selected entries
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    :return: Status for shown entries
+    """
+    chat_id = update.effective_chat.id
+    entries = data[chat_id]['entries']
+
+    if not data[chat_id]['has_next']:
+        return invalid(update, context)
+    data[chat_id]['pages'] = (data[chat_id]['pages']
+                              + [(entries[-1][3], entries[-1][0])])
+    return show_page(update, context)
+
+
+def analysis_previous_page(update, context):
+    """Showing the previous page of the selected entries
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    :return: Status for shown entries
+    """
+    chat_id = update.effective_chat.id
+
+    if len(data[chat_id]['pages']) < 2:
+        return invalid(update, context)
+    data[chat_id]['pages'] = data[chat_id]['pages'][:-1]
+    return show_page(update, context)
+
+
+def format_entry(number, entry, comment_length=None):
+    """Formats an entry for a list of entries
+
+    :param number: Number of the entry in the list
+    :param entry: Tuple (e_id, value, tag, date, comment)
+    :param comment_length: Maximum length of the comment, None for no limit
+    :return: String with the entry and an empty line
+    """
+    y, m, d = entry[3].split('-')
+    date = '{}.{}.{}'.format(int(d), int(m), int(y))
+    comment = entry[4]
+    if comment and comment_length and len(comment) > comment_length:
+        comment = comment[:comment_length - 1] + '…'
+    if comment:
+        return '({}) {:.2f}€ - {}\n{}: {}\n\n'.format(
+            number, entry[1], date, entry[2], comment)
+    return '({}) {:.2f}€ - {}\n{}\n\n'.format(
+        number, entry[1], date, entry[2])
+
+
+def describe_entry(entry):
+    """Describes the entry selected for editing
+
+    :param entry: Tuple (e_id, value, tag, date, comment)
+    :return: String with value, date and comment
+    """
+    y, m, d = entry[3].split('-')
+    date = '{}.{}.{}'.format(int(d), int(m), int(y))
+    if entry[4]:
+        return '{:.2f}€ - {} - "{}"'.format(entry[1], date, entry[4])
+    return '{:.2f}€ - {} - Kein Kommentar'.format(entry[1], date)
+
+
+def split_message(parts):
+    """Joins the parts to as few messages as possible
+
+    Parts are never split, unless a single part is longer than the limit.
+
+    :param parts: List of strings to be sent
+    :return: List of messages with at most MESSAGE_LIMIT characters
+    """
+    messages = []
+    current = []
+    length = 0
+    for part in parts:
+        if length + len(part) > MESSAGE_LIMIT and current:
+            messages.append(''.join(current))
+            current = []
+            length = 0
+        while len(part) > MESSAGE_LIMIT:
+            messages.append(part[:MESSAGE_LIMIT])
+            part = part[MESSAGE_LIMIT:]
+        current.append(part)
+        length += len(part)
+    messages.append(''.join(current))
+    return messages
+
+
 def analysis_select(update, context):
     """Prompt for user to select the entry that should be edited
 
@@ -490,22 +1042,14 @@ def analysis_edit(update, context):
 
     # Wenn Eingabe eine Zahl
     if message.isdecimal():
-        # Index wieder um 1 verringern um auf Index anzupassen
-        entry = int(message) - 1
-        if entry < len(data[chat_id]['entries']):
+        # Nummer auf Index der aktuellen Seite umrechnen
+        entry = int(message) - 1 - data[chat_id]['offset']
+        if 0 <= entry < len(entries):
             entry = entries[entry]
             data[chat_id]['entry'] = entry
             data[chat_id].pop('entries', None)
 
-            y, m, d = entry[3].split('-')
-            date = '{}.{}.{}'.format(int(d), int(m), int(y))
-            if entry[4]:
-                answer = '{:.2f}€ - {} - "{}"'.format(
-                    entry[1], date, entry[4])
-            else:
-                answer = '{:.2f}€ - {} - Kein Kommentar'.format(
-                    entry[1], date)
-
+            answer = describe_entry(entry)
             answer += '\nWie soll der Eintrag bearbeitet werden?'
 
             keyboard = [['Betrag bearbeiten', 'Datum bearbeiten'],
@@ -668,10 +1212,17 @@ def analysis_save(update, context):
     :return: Status for main menu
     """
     chat_id = update.effective_chat.id
+    entry = data[chat_id]['entry']
 
-    db.update_entry(data[chat_id]['entry'])
-    update.message.reply_text('Eintrag geändert!')
-    return back(update, context)
+    # Zwischengespeicherte Daten löschen
+    data.pop(chat_id, None)
+
+    def saved(result):
+        update.message.reply_text('Eintrag geändert!')
+        main_menu(update, context)
+
+    query(update, context, saved, 'update_entry', entry)
+    return MAIN
 
 
 def analysis_remove_entry(update, context):
@@ -679,13 +1230,20 @@ def analysis_remove_entry(update, context):
 
     :param update: Update of the sent message
     :param context: Context of the sent message
-    :return: Status for removing the entry
+    :return: Status for main menu
     """
     chat_id = update.effective_chat.id
+    entry = data[chat_id]['entry']
+
+    # Zwischengespeicherte Daten löschen
+    data.pop(chat_id, None)
 
-    db.remove_entry(data[chat_id]['entry'][0])
-    update.message.reply_text('Eintrag gelöscht!')
-    return back(update, context)
+    def removed(result):
+        update.message.reply_text('Eintrag gelöscht!')
+        main_menu(update, context)
+
+    query(update, context, removed, 'remove_entry', entry[0])
+    return MAIN
 
 
 def back(update, context):
@@ -713,6 +1271,759 @@ def invalid(update, context):
         'Ungültige Eingabe, bitte nochmal versuchen!')
 
 
+def register_inline_handlers(dispatcher):
+    """Register the handlers of the inline mode (Inline_UI=1)
+
+    The menus are inline keyboards of a single message, which is edited in
+    place when a button is pressed. Only typed inputs are answered with a
+    new message. The callback data of the buttons holds the selection (see
+    Buttons.callback_data), the data of a chat is only needed for typed
+    inputs, the entry being entered and the entries shown for editing.
+
+    :param dispatcher: The bots dispatcher
+    """
+    dispatcher.add_handler(CommandHandler('start', inline_start))
+    buttons = CallbackHandler({
+        'm': inline_menu,
+        'e': inline_enter,
+        'g': inline_enter_tag,
+        'd': inline_enter_save,
+        'B': inline_batch_save,
+        's': inline_sums,
+        'l': inline_page,
+        'b': inline_page,
+        'x': inline_entry,
+        'v': inline_edit_select,
+        'w': inline_edit_select,
+        'k': inline_edit_select,
+        'r': inline_edit_select,
+        'z': inline_edit_comment,
+        'u': inline_save,
+        'R': inline_remove_entry
+    })
+    # Getippte Eingaben werden anhand des gespeicherten Eingabefelds
+    # zugeordnet, ohne eines ist es ein Betrag oder mehrere Einträge
+    text = ButtonHandler(fallback=inline_text)
+    # Diagramme werden gerendert und hochgeladen, das soll andere Updates
+    # nicht aufhalten
+    chart_buttons = CallbackHandler({'c': inline_chart}, run_async=True)
+    for handler in (chart_buttons, buttons, text):
+        handler.replace_callbacks(handle_expired)
+        dispatcher.add_handler(handler)
+
+
+def inline_show(update, text, rows):
+    """Shows a menu of the inline mode
+
+    After pressing a button the message of the button is edited, typed
+    inputs are answered with a new message.
+
+    :param update: Update of the pressed button or the sent message
+    :param text: Text of the menu
+    :param rows: Buttons of the menu (see Buttons.inline_keyboard)
+    """
+    markup = inline_keyboard(rows)
+    if update.callback_query is None:
+        update.message.reply_text(text, reply_markup=markup)
+        return
+    try:
+        update.callback_query.edit_message_text(text, reply_markup=markup)
+    except BadRequest as e:
+        # Erneut gedrückter Button, die Nachricht ist bereits aktuell
+        if 'not modified' not in e.message:
+            raise e
+
+
+def tag_field(tag):
+    """Returns the field of a tag in the callback data of a button
+
+    Short tags are used as they are. Longer ones, and those that couldn't
+    be told apart from a hash, are replaced by a short hash of their name
+    (see inline_tag).
+
+    :param tag: Name of the tag, '' for all tags
+    :return: The tag or '#' followed by the hash
+    """
+    if (len(tag.encode()) <= INLINE_TAG_BYTES and '|' not in tag
+            and not tag.startswith('#')):
+        return tag
+    return '#' + hashlib.sha1(tag.encode()).hexdigest()[:10]
+
+
+def inline_tag(update, context, field):
+    """Returns the tag of a field created by tag_field
+
+    If no tag of the chat matches the hash (anymore), the main menu is
+    shown.
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    :param field: Field of the callback data
+    :return: Name of the tag or None
+    """
+    if not field.startswith('#'):
+        return field
+    tags = load_tags(update, update.effective_chat.id)
+    if tags is None:
+        return None
+    for tag in tags:
+        if tag_field(tag) == field:
+            return tag
+    inline_menu(update, context, INLINE_EXPIRED)
+    return None
+
+
+def inline_start(update, context):
+    """Handling the /start command in the inline mode
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    """
+    inline_menu(update, context, 'Willkommen beim SpendingCalc Bot!')
+
+
+def inline_menu(update, context, notice=None):
+    """Shows the main menu of the inline mode
+
+    :param update: Update of the pressed button or the sent message
+    :param context: Context of the update
+    :param notice: Text shown above the menu, e.g. a confirmation
+    """
+    chat_id = update.effective_chat.id
+
+    # Zwischengespeicherte Daten löschen
+    data.pop(chat_id, None)
+
+    text = ('Was möchtest du machen?\nZum Eintragen einfach den Betrag '
+            'senden, zur Analyse einen Zeitraum auswählen!')
+    if notice:
+        text = notice + '\n\n' + text
+
+    # Die Zeiträume der Analyse direkt im Hauptmenü anbieten
+    periods = [(name, callback_data('s', period, ''))
+               for period, name in PERIOD_NAMES.items()]
+    inline_show(update, text, [[('Eintragen', 'e')], periods[0:2],
+                               periods[2:4], periods[4:]])
+
+
+def inline_text(update, context):
+    """Handling a typed input in the inline mode
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    """
+    chat_id = update.effective_chat.id
+    message = update.message.text
+
+    field = (data.get(chat_id) or {}).get('input')
+    if field:
+        return INLINE_INPUTS[field](update, context)
+    if AMOUNT_PATTERN.match(message.strip()):
+        return inline_enter_value(update, context)
+    return inline_batch(update, context)
+
+
+def inline_enter(update, context):
+    """Asking for the amount in the inline mode
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    """
+    chat_id = update.effective_chat.id
+    data.pop(chat_id, None)
+
+    inline_show(update,
+                'Welchen Betrag möchtest du eintragen?\n\nMehrere Einträge '
+                'auf einmal: eine Zeile pro Eintrag mit Betrag, Kategorie, '
+                'optional Datum und Kommentar, z.B. "12,50 Essen 3.4. Pizza"',
+                [[('« Menü', 'm')]])
+
+
+def inline_enter_value(update, context):
+    """Handling the typed amount in the inline mode
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    """
+    chat_id = update.effective_chat.id
+    message = update.message.text
+
+    value = float(message.strip().replace(',', '.').replace('€', ''))
+    tags = load_tags(update, chat_id)
+    if tags is None:
+        return
+    data[chat_id] = {'input': 'tag', 'value': value}
+
+    # Zwei Kategorien pro Zeile
+    value = '{:.2f}'.format(value)
+    buttons = [(tag, callback_data('g', tag_field(tag))) for tag in tags]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.append([('Abbrechen', 'm')])
+
+    inline_show(update,
+                'Betrag: {}€\nUnter welcher Kategorie möchtest du den '
+                'Betrag abspeichern?\nFür eine neue Kategorie einfach den '
+                'Namen eingeben!'.format(value),
+                rows)
+
+
+def inline_enter_tag(update, context):
+    """Handling the selected or typed tag in the inline mode
+
+    :param update: Update of the pressed button or the sent message
+    :param context: Context of the update
+    """
+    chat_id = update.effective_chat.id
+    state = data.get(chat_id) or {}
+
+    if update.callback_query:
+        # Der Betrag steht nur in den Daten des Chats
+        if state.get('input') != 'tag':
+            return inline_menu(update, context, INLINE_EXPIRED)
+        tag = inline_tag(update, context, context.args[0])
+        if tag is None:
+            return
+    else:
+        tag = update.message.text.strip()
+        # Der Tag 'Alle' ist ungültig (und macht auch keinen Sinn)
+        if tag == 'Alle':
+            return invalid(update, context)
+    value = state['value']
+    data[chat_id] = {'input': 'date', 'value': value, 'tag': tag}
+
+    inline_show(update,
+                'Betrag: {:.2f}€\nKategorie: {}\n\nFür welches Datum? Für '
+                'ein anderes Datum oder einen Kommentar beides eingeben, '
+                'z.B. "3.4. Pizza" (oder nur "Pizza" für heute)'
+                .format(value, tag),
+                [[('Heute', callback_data('d', 0)),
+                  ('Gestern', callback_data('d', 1))],
+                 [('Abbrechen', 'm')]])
+
+
+def inline_enter_save(update, context):
+    """Saves the entry entered in the inline mode
+
+    The date is selected with a button, or typed in, optionally followed by
+    a comment. Amount and tag are taken from the data of the chat, so the
+    entry is only saved once, even if the button is pressed again.
+
+    :param update: Update of the pressed button or the sent message
+    :param context: Context of the update
+    """
+    chat_id = update.effective_chat.id
+
+    today = datetime.date.today()
+    if update.callback_query:
+        # Angeboten werden nur Heute (0) und Gestern (1)
+        days = min(max(int(context.args[0]), 0), 1)
+        date = (today - datetime.timedelta(days=days)).isoformat()
+        comment = None
+    else:
+        parts = update.message.text.split(None, 1)
+        date = today.isoformat()
+        if parts and DATE_PATTERN.match(parts[0]):
+            date = convert_date(parts[0])[0]
+            if date is None:
+                return invalid(update, context)
+            parts = parts[1:]
+        comment = parts[0].strip() if parts else None
+
+    # Zwischengespeicherte Daten entnehmen, ein erneuter Druck auf den Button
+    # findet sie nicht mehr
+    state = data.pop(chat_id, None) or {}
+    if state.get('input') != 'date':
+        return inline_menu(update, context, INLINE_EXPIRED)
+    value, tag = state['value'], state['tag']
+
+    def saved(result):
+        inline_menu(update, context, 'Erfolgreich eingetragen!')
+
+    # add_entries legt neue Kategorien im selben Schritt an
+    query(update, context, saved, 'add_entries', chat_id,
+          [(tag, value, date, comment)])
+
+
+def inline_batch(update, context):
+    """Handling a message with several entries in the inline mode
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    """
+    chat_id = update.effective_chat.id
+    message = update.message.text
+
+    tags = load_tags(update, chat_id)
+    if tags is None:
+        return None
+    rows, invalid_lines = parse_batch(message, tags)
+    if not rows:
+        return inline_menu(update, context,
+                           'Ungültige Eingabe, bitte nochmal versuchen!')
+    data[chat_id] = {'batch': rows}
+
+    # Nachrichten dürfen höchstens MESSAGE_LIMIT Zeichen lang sein
+    chunks = split_message(batch_summary(rows, invalid_lines)
+                           + ['Sollen die Einträge gespeichert werden?'])
+    for chunk in chunks[:-1]:
+        update.message.reply_text(chunk)
+    inline_show(update, chunks[-1], [[('Speichern', 'B'),
+                                      ('Abbrechen', 'm')]])
+
+
+def inline_batch_save(update, context):
+    """Saves the confirmed entries of inline_batch
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    """
+    chat_id = update.effective_chat.id
+    rows = (data.get(chat_id) or {}).get('batch')
+    if not rows:
+        return inline_menu(update, context, INLINE_EXPIRED)
+
+    # Zwischengespeicherte Daten löschen
+    data.pop(chat_id, None)
+
+    def saved(result):
+        inline_menu(update, context,
+                    '{} Einträge erfolgreich eingetragen!'.format(len(rows)))
+
+    query(update, context, saved, 'add_entries', chat_id, rows)
+
+
+def inline_sums(update, context):
+    """Shows the selected time period in the inline mode
+
+    The sums are shown above the first page of the entries. Without a tag
+    the sums of all tags are shown, together with buttons to select a
+    single tag. This replaces selecting the tag and the entries beforehand.
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    """
+    time_period, tag = context.args
+    chat_id = update.effective_chat.id
+    tag = inline_tag(update, context, tag)
+    if tag is None:
+        return
+
+    def answer_sum(result):
+        answer = '{} - {}\n\n'.format(PERIOD_NAMES[time_period],
+                                      tag or 'Alle')
+        total = 0
+        for row in result:
+            answer += '{}: {:.2f}€\n'.format(row[0], row[1])
+            total += float(row[1])
+        if not tag and result:
+            answer += 'Gesamt: {:.2f}€\n'.format(total)
+
+        if tag:
+            filters = [[('« Alle Kategorien',
+                         callback_data('s', time_period, ''))]]
+        else:
+            buttons = [(row[0],
+                        callback_data('s', time_period, tag_field(row[0])))
+                       for row in result]
+            filters = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+        inline_entries(update, context, time_period, tag,
+                       header=answer + '\n', filters=filters)
+
+    query(update, context, answer_sum, 'get_entry_sum', chat_id,
+          tag=tag or None, time_period=time_period)
+
+
+def inline_page(update, context):
+    """Shows another page of the selected entries in the inline mode
+
+    The buttons of the following page ('l') hold the position of the last
+    entry before it, those of the previous page ('b') the position of the
+    first entry after it.
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    """
+    time_period, page, date, e_id, tag = context.args
+    tag = inline_tag(update, context, tag)
+    if tag is None:
+        return
+    inline_entries(update, context, time_period, tag, int(page),
+                   (date, int(e_id)),
+                   update.callback_query.data.startswith('b'))
+
+
+def inline_entries(update, context, time_period, tag, page=0, position=None,
+                   backwards=False, header='', filters=()):
+    """Shows a page of the selected entries in the inline mode
+
+    The shown entries are kept, so they can be selected for editing.
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    :param time_period: Selected time period
+    :param tag: Selected tag or '' for all
+    :param page: Number of the page, starting at 0
+    :param position: Position (date, e_id) next to the page, None for the
+    first page
+    :param backwards: Whether the position is after the page
+    :param header: Text above the entries
+    :param filters: Further rows of buttons, e.g. to select a tag
+    """
+    chat_id = update.effective_chat.id
+    view = update.callback_query.data
+    field = tag_field(tag)
+
+    def answer_page(result):
+        # Beim Zurückblättern folgt immer noch die bisherige Seite
+        has_next = backwards or len(result) > PAGE_SIZE
+        result = result[:PAGE_SIZE]
+        offset = page * PAGE_SIZE
+
+        data[chat_id] = {'entries': {str(entry[0]): entry
+                                     for entry in result},
+                         'view': view}
+
+        # Kommentare kürzen, damit die Seite in eine Nachricht passt
+        lines = [header]
+        lines += [format_entry(offset + i + 1, entry, INLINE_COMMENT_LENGTH)
+                  for i, entry in enumerate(result)]
+        if result:
+            lines.append('Welcher Eintrag soll bearbeitet werden?')
+        else:
+            lines.append('Keine Einträge vorhanden.')
+
+        buttons = [(str(offset + i + 1), callback_data('x', entry[0]))
+                   for i, entry in enumerate(result)]
+        rows = [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+        navigation = []
+        if page == 1:
+            # Die erste Seite wieder mit den Summen anzeigen
+            navigation.append(('« Zurück',
+                               callback_data('s', time_period, field)))
+        elif page > 1 and result:
+            first = result[0]
+            navigation.append(('« Zurück', callback_data(
+                'b', time_period, page - 1, first[3], first[0], field)))
+        if has_next and result:
+            last = result[-1]
+            navigation.append(('Weiter »', callback_data(
+                'l', time_period, page + 1, last[3], last[0], field)))
+        rows.append(navigation)
+        rows += filters
+        rows.append([('Diagramm', callback_data('c', time_period, field)),
+                     ('« Menü', 'm')])
+        inline_show(update, ''.join(lines)[:MESSAGE_LIMIT], rows)
+
+    if backwards:
+        kwargs = {'before': position, 'limit': PAGE_SIZE}
+    else:
+        # Einen Eintrag mehr laden, um zu erkennen ob eine weitere Seite
+        # folgt
+        kwargs = {'after': position, 'limit': PAGE_SIZE + 1}
+    query(update, context, answer_page, 'get_entries_page', chat_id,
+          tag=tag or None, time_period=time_period, **kwargs)
+
+
+def inline_chart(update, context):
+    """Sends a chart of the selected spendings in the inline mode
+
+    The chart is sent as a new message, the menu stays usable.
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    """
+    chat_id = update.effective_chat.id
+    time_period, tag = context.args
+    tag = inline_tag(update, context, tag)
+    if tag is None:
+        return
+    title = '{} - {}'.format(tag or 'Alle', PERIOD_NAMES[time_period])
+    # Unveränderte Diagramme ohne Abfrage senden
+    view = chart_view(chat_id, title, not tag, time_period)
+    if view and charts.send_view(update.effective_message, view):
+        return
+
+    def answer_chart(result):
+        if not result:
+            update.effective_message.reply_text('Keine Einträge vorhanden.')
+            return
+        charts.send(update.effective_message, title, result, not tag,
+                    view=view)
+
+    query(update, context, answer_chart, 'get_monthly_sums', chat_id,
+          tag=tag or None, time_period=time_period)
+
+
+def inline_selected_entry(update, context):
+    """Returns the entry of the pressed button, if it was shown to the chat
+
+    Clients can send any callback data, so only entries listed by
+    inline_entries can be edited. Otherwise the main menu is shown.
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    :return: Tuple (e_id, value, tag, date, comment) or None
+    """
+    chat_id = update.effective_chat.id
+    state = data.get(chat_id) or {}
+    entry = state.get('entries', {}).get(context.args[0])
+    if entry is None:
+        inline_menu(update, context, INLINE_EXPIRED)
+        return None
+    return tuple(entry)
+
+
+def inline_entry(update, context):
+    """Asking how the selected entry should be edited in the inline mode
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    """
+    chat_id = update.effective_chat.id
+    entry = inline_selected_entry(update, context)
+    if entry is None:
+        return
+    data[chat_id]['entry'] = entry
+    data[chat_id]['input'] = None
+
+    e_id = entry[0]
+    inline_show(update,
+                describe_entry(entry)
+                + '\nWie soll der Eintrag bearbeitet werden?',
+                [[('Betrag', callback_data('v', e_id)),
+                  ('Datum', callback_data('w', e_id))],
+                 [('Kommentar', callback_data('k', e_id)),
+                  ('Löschen', callback_data('r', e_id))],
+                 [('« Zurück', data[chat_id]['view']), ('« Menü', 'm')]])
+
+
+def inline_edit_select(update, context):
+    """Asking for the new value of the selected entry in the inline mode
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    """
+    chat_id = update.effective_chat.id
+    entry = inline_selected_entry(update, context)
+    if entry is None:
+        return
+    action = update.callback_query.data[0]
+    cancel = ('Abbrechen', callback_data('x', entry[0]))
+
+    if action == 'r':
+        data[chat_id]['input'] = None
+        inline_show(update, 'Soll der Eintrag gelöscht werden?',
+                    [[('Ja', callback_data('R', entry[0])), cancel]])
+        return
+
+    field, answer = {
+        'v': ('value', 'Welcher Betrag soll eingetragen werden?'),
+        'w': ('date', 'Welches Datum soll eingetragen werden?'),
+        'k': ('comment', 'Welcher Kommentar soll eingetragen werden?')
+    }[action]
+    data[chat_id]['entry'] = entry
+    data[chat_id]['input'] = 'edit_' + field
+    rows = [[cancel]]
+    if action == 'k':
+        rows.insert(0, [('Kommentar löschen',
+                         callback_data('z', entry[0]))])
+    inline_show(update, answer, rows)
+
+
+def inline_edit_value(update, context):
+    """Handling the typed new value in the inline mode
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    """
+    chat_id = update.effective_chat.id
+    message = update.message.text
+    entry = data[chat_id]['entry']
+
+    if not AMOUNT_PATTERN.match(message.strip()):
+        return invalid(update, context)
+    value = float(message.strip().replace(',', '.').replace('€', ''))
+    inline_confirm_edit(update, (entry[0], value, entry[2], entry[3],
+                                 entry[4]),
+                        'Neuer Betrag: {:.2f}€'.format(value))
+
+
+def inline_edit_date(update, context):
+    """Handling the typed new date in the inline mode
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    """
+    chat_id = update.effective_chat.id
+    message = update.message.text
+    entry = data[chat_id]['entry']
+
+    # Eingabe überprüfen und in richtige Form umwandeln
+    date, date_values = convert_date(message)
+    if not DATE_PATTERN.match(message.strip()) or not date:
+        return invalid(update, context)
+    y, m, d = date_values
+    inline_confirm_edit(update, (entry[0], entry[1], entry[2], date,
+                                 entry[4]),
+                        'Neues Datum: {:02d}.{:02d}.{:04d}'.format(d, m, y))
+
+
+def inline_edit_comment(update, context):
+    """Handling the typed new comment or deleting it in the inline mode
+
+    :param update: Update of the pressed button or the sent message
+    :param context: Context of the update
+    """
+    chat_id = update.effective_chat.id
+    if update.callback_query:
+        entry = inline_selected_entry(update, context)
+        if entry is None:
+            return
+        comment = None
+        answer = 'Kein Kommentar eingetragen.'
+    else:
+        entry = data[chat_id]['entry']
+        comment = update.message.text.strip()
+        answer = 'Neuer Kommentar: "{}"'.format(comment)
+    inline_confirm_edit(update, (entry[0], entry[1], entry[2], entry[3],
+                                 comment),
+                        answer)
+
+
+def inline_confirm_edit(update, entry, answer):
+    """Asking whether the changed entry should be saved in the inline mode
+
+    :param update: Update of the pressed button or the sent message
+    :param entry: The changed entry
+    :param answer: Description of the change
+    """
+    chat_id = update.effective_chat.id
+    data[chat_id]['entry'] = entry
+    data[chat_id]['input'] = None
+
+    inline_show(update, answer + '\nSoll die Änderung gespeichert werden?',
+                [[('Ja', callback_data('u', entry[0])),
+                  ('Nein', callback_data('x', entry[0]))]])
+
+
+def inline_save(update, context):
+    """Saves the edited entry in the inline mode
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    """
+    chat_id = update.effective_chat.id
+    entry = (data.get(chat_id) or {}).get('entry')
+    # Nur den zuletzt bearbeiteten Eintrag speichern
+    if not entry or str(entry[0]) != context.args[0]:
+        return inline_menu(update, context, INLINE_EXPIRED)
+
+    # Zwischengespeicherte Daten löschen
+    data.pop(chat_id, None)
+
+    def saved(result):
+        inline_menu(update, context, 'Eintrag geändert!')
+
+    query(update, context, saved, 'update_entry', tuple(entry))
+
+
+def inline_remove_entry(update, context):
+    """Removes the selected entry in the inline mode
+
+    :param update: Update of the pressed button
+    :param context: Context of the pressed button
+    """
+    chat_id = update.effective_chat.id
+    entry = inline_selected_entry(update, context)
+    if entry is None:
+        return
+
+    # Zwischengespeicherte Daten löschen
+    data.pop(chat_id, None)
+
+    def removed(result):
+        inline_menu(update, context, 'Eintrag gelöscht!')
+
+    query(update, context, removed, 'remove_entry', entry[0])
+
+
+# Getippte Eingaben des Inline-Modus je erwartetem Eingabefeld
+INLINE_INPUTS = {'tag': inline_enter_tag,
+                 'date': inline_enter_save,
+                 'edit_value': inline_edit_value,
+                 'edit_date': inline_edit_date,
+                 'edit_comment': inline_edit_comment}
+
+
+def load_tags(update, chat_id):
+    """Loads the tags of a chat through db_async and waits for them
+
+    Unlike query, the handler gets the tags directly, as they decide its
+    answer and next state. The deadline of db_async still applies, so a
+    slow database doesn't block the dispatcher for long.
+
+    :param update: Update of the sent message or the pressed button
+    :param chat_id: Telegram chat_id of the user
+    :return: List of the tags or None if the call timed out, the user is
+    then asked to try again
+    """
+    try:
+        return db_async.call('get_tags', chat_id)
+    except TimeoutError:
+        update.effective_message.reply_text(
+            'Die Anfrage hat zu lange gedauert, bitte nochmal versuchen!')
+        return None
+
+
+def query(update, context, callback, method, *args, **kwargs):
+    """Runs a database method without blocking the dispatcher
+
+    The method is executed in the thread pool of db_async. Once its result
+    is available, the callback is run with the result in the dispatchers
+    worker pool and sends the answer. If the method fails or times out, the
+    user is asked to try again and can go back to the main menu. Writes
+    (see WRITE_METHODS) have no deadline, so they can't time out while
+    still being saved.
+
+    :param update: Update of the sent message
+    :param context: Context of the sent message
+    :param callback: Function getting the result of the method
+    :param method: Name of the DB method
+    :param args: Positional arguments for the method
+    :param kwargs: Keyword arguments for the method
+    """
+    def done(future):
+        if future.exception():
+            function, argument = query_failed, future.exception()
+        else:
+            function, argument = callback, future.result()
+        if db_async.inline:
+            function(argument)
+        else:
+            # Antworten nicht im Thread-Pool der Datenbank senden
+            context.dispatcher.run_async(function, argument, update=update)
+
+    def query_failed(error):
+        if isinstance(error, TimeoutError):
+            answer = 'Die Anfrage hat zu lange gedauert'
+        else:
+            answer = 'Es ist ein Fehler aufgetreten'
+        if inline_ui:
+            keyboard = inline_keyboard([[('Zurück', 'm')]])
+        else:
+            keyboard = ReplyKeyboardMarkup([['Zurück']])
+        update.effective_message.reply_text(
+            answer + ', bitte nochmal versuchen!',
+            reply_markup=keyboard
+        )
+        if not isinstance(error, TimeoutError):
+            raise error
+
+    if method in WRITE_METHODS:
+        kwargs.setdefault('timeout', 0)
+    db_async.submit(method, *args, **kwargs).add_done_callback(done)
+
+
 def convert_date(input_string):
     """Takes input and converts to correct date format.
     If an invalid or future date is entered, None will be returned
@@ -751,25 +2062,331 @@ def convert_date(input_string):
         return None, None
 
 
-def main():
-    # Daten aus Config-Datei laden
-    config = load_config()
+def parse_batch(text, tags=()):
+    """Parses a message with one entry per line
+
+    Every line holds the amount, the tag and optionally the date and a
+    comment, e.g. '12,50 Essen 3.4. Pizza'. Without a date the entry is
+    saved for today. Tags containing spaces are only recognized if they
+    already exist.
+
+    :param text: Text of the message
+    :param tags: Existing tags of the user
+    :return: List of tuples (tag, value, date, comment) for DB.add_entries
+    and list with the numbers of the invalid lines
+    """
+    rows = []
+    invalid_lines = []
+    today = datetime.date.today().isoformat()
+    # Längere Tags zuerst, damit z.B. 'Essen gehen' nicht als 'Essen' gilt
+    tags = sorted(tags, key=len, reverse=True)
+
+    for number, line in enumerate(text.splitlines(), 1):
+        parts = line.split(None, 1)
+        if not parts:
+            continue
+        if len(parts) < 2 or not AMOUNT_PATTERN.match(parts[0]):
+            invalid_lines.append(number)
+            continue
+        value = float(parts[0].replace(',', '.').replace('€', ''))
+
+        rest = parts[1].strip()
+        for tag in tags:
+            if rest == tag or rest.startswith(tag + ' '):
+                break
+        else:
+            tag = rest.split(None, 1)[0]
+        rest = rest[len(tag):].strip()
+
+        # Nur das erste Wort kann ein Datum sein, der Rest ist der Kommentar
+        date = today
+        words = rest.split(None, 1)
+        if words and DATE_PATTERN.match(words[0]):
+            date = convert_date(words[0])[0]
+            rest = words[1] if len(words) > 1 else ''
+        # Der Tag 'Alle' ist ungültig, ebenso Daten in der Zukunft
+        if tag == 'Alle' or date is None:
+            invalid_lines.append(number)
+            continue
+        rows.append((tag, value, date, rest or None))
+    return rows, invalid_lines
+
+
+def batch_summary(rows, invalid_lines):
+    """Lists the entries parsed by parse_batch
+
+    :param rows: List of tuples (tag, value, date, comment)
+    :param invalid_lines: List with the numbers of the invalid lines
+    :return: List of strings, the total and one per entry
+    """
+    lines = ['{} Einträge, Summe: {:.2f}€\n\n'.format(
+        len(rows), sum(row[1] for row in rows))]
+    for i, (tag, value, date, comment) in enumerate(rows):
+        lines.append(format_entry(i + 1, (None, value, tag, date, comment)))
+    if invalid_lines:
+        lines.append('Ungültige Zeilen (werden übersprungen): {}\n\n'.format(
+            ', '.join(map(str, invalid_lines))))
+    return lines
+
+
+def start_webhook(updater, config):
+    """Starts receiving updates through a webhook
+
+    The secret is appended to the path, so only Telegram knows the full URL.
+    If Webhook_URL is set, the webhook is registered at Telegram, otherwise
+    it has to be registered separately (e.g. behind a reverse proxy).
+
+    :param updater: The bots updater
+    :param config: dict of the config file
+    """
+    url_path = config['Webhook_Path'].strip('/')
+    if config['Webhook_Secret']:
+        url_path = '/'.join(filter(None, [url_path,
+                                          config['Webhook_Secret']]))
+
+    updater.start_webhook(listen=config['Webhook_Listen'],
+                          port=int(config['Webhook_Port']),
+                          url_path=url_path)
+    if config['Webhook_URL']:
+        updater.bot.set_webhook(
+            url='{}/{}'.format(config['Webhook_URL'].rstrip('/'), url_path),
+            max_connections=int(config['Webhook_Max_Connections']))
+
+
+def open_database(db_name, config, report=None):
+    """Opens the database and the thread pool for its queries
+
+    With DB_Shards above 1 the users are split over that many files named
+    like shard_names. With Lazy_Start the database is opened and migrated in
+    the background, until then the queries wait for it. Afterwards the
+    caches are warmed up in the background (see warm_up).
+
+    :param db_name: Name of the database file
+    :param config: dict of the config file
+    :param report: StartupReport the duration of opening is added to
+    """
+    global db, db_async
+    options = {'write_behind': config['Write_Behind'] == '1',
+               'readers': int(config['DB_Readers']),
+               'result_cache_size': int(config['Result_Cache_Size'])}
+    shards = int(config['DB_Shards'])
+
+    def create():
+        if shards > 1:
+            return ShardedDB(db_name, shards, **options)
+        return DB(db_name, **options)
+
+    def create_in_background():
+        try:
+            return create()
+        finally:
+            report.end('db_open')
+
+    if config['Lazy_Start'] == '1':
+        if report:
+            report.begin('db_open')
+            db = Deferred(create_in_background, 'DB-Open')
+        else:
+            db = Deferred(create, 'DB-Open')
+    else:
+        db = create()
+        if report:
+            report.mark('db_open')
+    db_async = AsyncDB(db, workers=int(config['DB_Workers']),
+                       timeout=float(config['DB_Timeout']) or None)
+
+    chats = int(config['Warm_Up_Chats'])
+    if chats:
+        if report:
+            report.begin('warm_up')
+        threading.Thread(target=warm_up, args=(chats, report),
+                         name='Warm-Up', daemon=True).start()
+
+
+def warm_up(chats, report=None):
+    """Fills the caches after the start
+
+    Loads the tags of the most recently active users and imports the
+    modules for statistics and charts, which are only loaded when needed.
+
+    :param chats: Number of users whose tags are loaded
+    :param report: StartupReport the duration is added to
+    """
+    try:
+        db.warm_up(chats)
+        for module in ('Statistics', 'matplotlib.figure'):
+            importlib.import_module(module)
+    except BaseException as e:
+        print('Warm-up failed: {!r}'.format(e))
+    finally:
+        if report:
+            report.end('warm_up')
+
+
+def close_database():
+    """Waits for running queries and closes the database"""
+    db_async.shutdown()
+    db.close()
+
+
+def start_metrics(dispatcher, config):
+    """Instruments handlers and database and starts exposing the metrics
+
+    :param dispatcher: The bots dispatcher with all handlers registered
+    :param config: dict of the config file
+    """
+    global metrics
+    metrics = Metrics(slow_threshold=float(config['Slow_Update_Threshold']),
+                      slow_log=config['Slow_Update_Log'] or None)
+    metrics.instrument_handlers(dispatcher, state_names())
+    # Eine im Hintergrund geöffnete Datenbank erst danach instrumentieren
+    if isinstance(db, Deferred):
+        db.add_done_callback(metrics.instrument_db)
+    else:
+        metrics.instrument_db(db)
+    metrics.add_collector('tag_cache', lambda: db.tag_cache.stats())
+    metrics.add_collector('result_cache', lambda: db.result_cache.stats())
+    metrics.add_collector('db_pool', lambda: db.pool_stats())
+    metrics.add_collector('db_async', db_async.stats)
+    metrics.add_collector('state_store', lambda: data.stats())
+    metrics.add_collector('charts', charts.stats)
+    if outbound:
+        metrics.add_collector('outbound', outbound.stats)
+        outbound.on_sent = lambda seconds, lane: metrics.observe(
+            'outbound_seconds', seconds, (('lane', lane),))
+
+    if config['Metrics_Port']:
+        metrics.serve(int(config['Metrics_Port']), config['Metrics_Listen'])
+    if config['Metrics_File']:
+        metrics.write_periodically(config['Metrics_File'],
+                                   float(config['Metrics_Interval']))
+
+
+def create_updater(config, bot=None, db_name='SpendingCalcData.db',
+                   report=None):
+    """Creates the updater with the database and all handlers
+
+    :param config: dict of the config file
+    :param bot: Bot to be used instead of one with the token of the config
+    :param db_name: Name of the database file
+    :param report: StartupReport the durations of the phases are added to
+    :return: The updater, not yet receiving updates
+    """
+    # Verbindung zur Datenbank herstellen
+    open_database(db_name, config, report)
+
+    # Zwischenspeicher für laufende Unterhaltungen anlegen
+    global data
+    data, persistence = create_state_store(config)
 
     # Bot erstellen und Token festlegen
-    updater = Updater(token=config['Telegram_Bot_Token'])
+    if bot:
+        updater = Updater(bot=bot, persistence=persistence)
+    else:
+        updater = Updater(token=config['Telegram_Bot_Token'],
+                          persistence=persistence)
     dispatcher = updater.dispatcher
 
-    # Verbindung zur Datenbank herstellen
-    global db
-    db = DB('SpendingCalcData.db')
+    # Nachrichten über die Warteschlange senden, wenn aktiviert
+    global outbound
+    outbound = None
+    if config['Outbound'] == '1':
+        outbound = Outbound(float(config['Outbound_Rate']),
+                            float(config['Outbound_Chat_Rate']),
+                            int(config['Outbound_Chat_Burst']),
+                            float(config['Outbound_Group_Rate']),
+                            int(config['Outbound_Workers']))
+        outbound.install(updater.bot)
+        outbound.start()
+
+    # Zwischenspeicher für Diagramme anlegen
+    global charts
+    charts = ChartCache(int(config['Chart_Cache_Size']),
+                        config['Chart_Cache_Dir'] or None,
+                        int(config['Chart_Cache_Files']))
 
     # Handler für Eingaben registrieren
+    global inline_ui
+    inline_ui = config['Inline_UI'] == '1'
     register_handlers(dispatcher)
 
-    # Bot starten
+    # Messwerte erfassen, wenn aktiviert
+    global admin_ids
+    admin_ids = {int(user_id) for user_id in config['Admin_IDs'].split(',')
+                 if user_id.strip()}
+    if config['Metrics'] == '1':
+        start_metrics(dispatcher, config)
+    if report:
+        report.mark('handlers')
+    return updater
+
+
+def start_polling(updater, report=None):
+    """Starts polling and completes the report after the first poll
+
+    The first getUpdates request doesn't wait for new updates (timeout 0),
+    so the phase measures until the pending updates arrived instead of
+    the long polling timeout.
+
+    :param updater: The bots updater
+    :param report: StartupReport, finished once the first getUpdates
+    request returned
+    """
+    if report:
+        get_updates = updater.bot.get_updates
+
+        def first_poll(*args, **kwargs):
+            # Sonst endet die Phase erst nach dem Long-Polling-Timeout
+            kwargs['timeout'] = 0
+            try:
+                return get_updates(*args, **kwargs)
+            finally:
+                # Nur die erste Abfrage messen
+                del updater.bot.get_updates
+                report.mark('first_poll')
+                report.finish()
+
+        updater.bot.get_updates = first_poll
     updater.start_polling()
+
+
+def shutdown():
+    """Stops the metrics and closes the database after the bot stopped"""
+    # Noch wartende Nachrichten senden
+    if outbound:
+        outbound.stop()
+    # Ausstehende Abfragen und Schreibzugriffe abschließen
+    if metrics:
+        metrics.stop()
+    close_database()
+
+
+def main():
+    report = StartupReport()
+    report.mark('imports')
+
+    # Daten aus Config-Datei laden
+    config = load_config()
+    report.mark('config')
+
+    # Updates auf mehrere Prozesse verteilen, wenn aktiviert
+    workers = int(config['Worker_Processes'])
+    if workers > 1:
+        Workers.run(config, workers, report)
+        return
+
+    updater = create_updater(config, report=report)
+
+    # Bot starten
+    if config['Mode'] == 'webhook':
+        start_webhook(updater, config)
+        report.mark('webhook')
+        report.finish()
+    else:
+        start_polling(updater, report)
     print('Bot started!')
     updater.idle()
+    shutdown()
 
 
 if __name__ == '__main__':
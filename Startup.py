@@ -0,0 +1,144 @@
+import threading
+import time
+
+# Zeitpunkt, zu dem dieses Modul geladen wurde; als erster Import des Bots
+# beginnt damit die Messung der Imports
+STARTED = time.perf_counter()
+
+
+class StartupReport:
+    """Durations of the phases of the start of the bot
+
+    Consecutive phases are ended with mark, each lasting since the end of the
+    previous one. Phases running in the background are measured with begin
+    and end. The report is printed once finish has been called and all
+    background phases have ended.
+    """
+
+    def __init__(self, started=STARTED, output=print):
+        """
+        :param started: perf_counter at the start of the first phase
+        :param output: Function the report is passed to
+        """
+        self.started = started
+        self.phases = []
+        self._output = output
+        self._last = started
+        self._running = {}
+        self._finished = False
+        self._reported = False
+        self._lock = threading.Lock()
+
+    def mark(self, name):
+        """Ends a consecutive phase
+
+        :param name: Name of the phase
+        """
+        with self._lock:
+            now = time.perf_counter()
+            self.phases.append((name, now - self._last, False))
+            self._last = now
+
+    def begin(self, name):
+        """Starts a phase running in the background
+
+        :param name: Name of the phase
+        """
+        with self._lock:
+            self._running[name] = time.perf_counter()
+
+    def end(self, name):
+        """Ends a phase running in the background
+
+        :param name: Name of the phase
+        """
+        with self._lock:
+            now = time.perf_counter()
+            self.phases.append((name, now - self._running.pop(name), True))
+            self._last = max(self._last, now)
+        self._report()
+
+    def finish(self):
+        """Reports the phases as soon as the background phases ended"""
+        with self._lock:
+            self._finished = True
+        self._report()
+
+    def _report(self):
+        with self._lock:
+            if not self._finished or self._running or self._reported:
+                return
+            self._reported = True
+            total = self._last - self.started
+            phases = ', '.join('{} {:.3f}s{}'.format(
+                name, duration, ' (Hintergrund)' if background else '')
+                for name, duration, background in self.phases)
+        self._output('Start in {:.3f}s: {}'.format(total, phases))
+
+
+class Deferred:
+    """Object created in a background thread, usable right away
+
+    Accessing an attribute waits until the object has been created. If
+    creating it failed, every access raises the error again.
+    """
+
+    def __init__(self, factory, name='Deferred'):
+        """
+        :param factory: Function without arguments creating the object
+        :param name: Name of the background thread
+        """
+        self._object = None
+        self._error = None
+        self._callbacks = []
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._create, args=(factory,), name=name,
+                         daemon=True).start()
+
+    def _create(self, factory):
+        try:
+            self._object = factory()
+        except BaseException as e:
+            self._error = e
+            print('{} failed: {!r}'.format(threading.current_thread().name,
+                                           e))
+        with self._lock:
+            self._ready.set()
+            callbacks, self._callbacks = self._callbacks, []
+        if self._error is None:
+            for callback in callbacks:
+                callback(self._object)
+
+    @property
+    def ready(self):
+        """Whether creating the object has finished"""
+        return self._ready.is_set()
+
+    def wait(self, timeout=None):
+        """Waits until the object has been created
+
+        :param timeout: Maximum time to wait in seconds
+        :return: The object
+        """
+        if not self._ready.wait(timeout):
+            raise TimeoutError('Object is not ready yet')
+        if self._error is not None:
+            raise self._error
+        return self._object
+
+    def add_done_callback(self, callback):
+        """Calls a function with the object once it has been created
+
+        :param callback: Function getting the object, it is not called if
+        creating the object failed
+        """
+        with self._lock:
+            if not self._ready.is_set():
+                self._callbacks.append(callback)
+                return
+        if self._error is None:
+            callback(self._object)
+
+    def __getattr__(self, name):
+        return getattr(self.wait(), name)
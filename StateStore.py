@@ -0,0 +1,350 @@
+from telegram.ext import BasePersistence
+from collections import OrderedDict, defaultdict
+from collections.abc import MutableMapping
+import json
+import sqlite3
+import threading
+import time
+
+
+class ChatState(dict):
+    """Conversation data of one chat
+
+    Every change is reported to the store, so persistent stores can save it.
+    Nested lists and dicts have to be assigned again after changing them.
+    """
+
+    def __init__(self, store, chat_id, values):
+        super().__init__(values)
+        self._store = store
+        self._chat_id = chat_id
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._store.changed(self._chat_id, self)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._store.changed(self._chat_id, self)
+
+    def pop(self, key, *default):
+        value = super().pop(key, *default)
+        self._store.changed(self._chat_id, self)
+        return value
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._store.changed(self._chat_id, self)
+
+
+class StateStore(MutableMapping):
+    """Conversation data of all chats, kept in memory
+
+    The data of a chat expires ttl seconds after it was last used. If more
+    than max_chats chats have data, the least recently used one is evicted.
+    Iterating only covers the chats currently held in memory.
+    """
+
+    def __init__(self, ttl=3600, max_chats=10000):
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self.expired = 0
+        self.evicted = 0
+        # chat_id -> (Zeitpunkt der letzten Nutzung, ChatState)
+        self._chats = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, chat_id):
+        now = time.time()
+        with self._lock:
+            item = self._chats.get(chat_id)
+            if item and item[0] + self.ttl < now:
+                self._drop(chat_id)
+                self.expired += 1
+                item = None
+            if item:
+                self._chats[chat_id] = (now, item[1])
+                self._chats.move_to_end(chat_id)
+                return item[1]
+
+            # Nicht im Speicher, eventuell gespeicherte Daten laden
+            values = self._load(chat_id)
+            if values is None:
+                raise KeyError(chat_id)
+            state = ChatState(self, chat_id, values)
+            self._remember(chat_id, state, now)
+            return state
+
+    def __setitem__(self, chat_id, values):
+        with self._lock:
+            state = ChatState(self, chat_id, values)
+            self._remember(chat_id, state, time.time())
+            self._save(chat_id, state)
+
+    def __delitem__(self, chat_id):
+        with self._lock:
+            if chat_id not in self._chats and self._load(chat_id) is None:
+                raise KeyError(chat_id)
+            self._drop(chat_id)
+            self._delete(chat_id)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._chats))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._chats)
+
+    def changed(self, chat_id, state):
+        """Marks the data of a chat as used and saves it
+
+        :param chat_id: Telegram chat_id of the user
+        :param state: Changed data of the chat
+        """
+        with self._lock:
+            self._remember(chat_id, state, time.time())
+            self._save(chat_id, state)
+
+    def stats(self):
+        """Returns the counters of the store
+
+        :return: dict with the number of chats in memory and the number of
+        expired and evicted chats
+        """
+        with self._lock:
+            return {'size': len(self._chats),
+                    'expired': self.expired,
+                    'evicted': self.evicted}
+
+    def _remember(self, chat_id, state, now):
+        """Keeps the data of a chat in memory and applies the limits
+
+        :param chat_id: Telegram chat_id of the user
+        :param state: Data of the chat
+        :param now: Time of the access
+        """
+        self._chats[chat_id] = (now, state)
+        self._chats.move_to_end(chat_id)
+        # Die ältesten Einträge stehen vorne
+        while self._chats:
+            oldest_id, (used, _) = next(iter(self._chats.items()))
+            if used + self.ttl < now:
+                self._drop(oldest_id)
+                self.expired += 1
+            elif len(self._chats) > self.max_chats:
+                self._evict(oldest_id)
+                self.evicted += 1
+            else:
+                break
+
+    def _drop(self, chat_id):
+        """Removes the data of a chat from memory and storage
+
+        :param chat_id: Telegram chat_id of the user
+        """
+        self._chats.pop(chat_id, None)
+        self._delete(chat_id)
+
+    def _evict(self, chat_id):
+        """Removes the data of a chat to respect max_chats
+
+        :param chat_id: Telegram chat_id of the user
+        """
+        self._drop(chat_id)
+
+    def _load(self, chat_id):
+        """Loads stored data of a chat, nothing is stored in memory mode
+
+        :param chat_id: Telegram chat_id of the user
+        :return: dict with the data or None
+        """
+        return None
+
+    def _save(self, chat_id, state):
+        """Stores the data of a chat, nothing is stored in memory mode
+
+        :param chat_id: Telegram chat_id of the user
+        :param state: Data of the chat
+        """
+
+    def _delete(self, chat_id):
+        """Deletes stored data of a chat, nothing is stored in memory mode
+
+        :param chat_id: Telegram chat_id of the user
+        """
+
+
+class SQLiteStateStore(StateStore):
+    """Conversation data of all chats, stored in a SQLite database
+
+    Only recently used chats are kept in memory, all others are loaded from
+    the database when they are used again, so nothing has to be loaded at
+    startup. Evicting a chat from memory keeps its stored data.
+    The database also holds the states of the ConversationHandler (see
+    ConversationPersistence).
+    """
+
+    def __init__(self, db_name, ttl=3600, max_chats=10000):
+        super().__init__(ttl, max_chats)
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # Verlust der letzten Änderungen bei Stromausfall ist vertretbar
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        command = '''
+            CREATE TABLE IF NOT EXISTS "ChatState" (
+                "ChatID" INTEGER NOT NULL,
+                "Data" TEXT NOT NULL,
+                "Updated" REAL NOT NULL,
+                PRIMARY KEY("ChatID")
+            )
+            '''
+        self.conn.execute(command)
+        command = '''
+            CREATE TABLE IF NOT EXISTS "Conversation" (
+                "Name" TEXT NOT NULL,
+                "Key" TEXT NOT NULL,
+                "State" INTEGER NOT NULL,
+                "Updated" REAL NOT NULL,
+                PRIMARY KEY("Name", "Key")
+            )
+            '''
+        self.conn.execute(command)
+        # Abgelaufene Daten direkt entfernen
+        expired = time.time() - self.ttl
+        self.conn.execute('DELETE FROM ChatState WHERE Updated < ?',
+                          (expired,))
+        self.conn.execute('DELETE FROM Conversation WHERE Updated < ?',
+                          (expired,))
+        self.conn.commit()
+
+    def _evict(self, chat_id):
+        # Nur aus dem Speicher entfernen, die Daten bleiben gespeichert
+        self._chats.pop(chat_id, None)
+
+    def _load(self, chat_id):
+        command = '''
+            SELECT Data, Updated
+            FROM ChatState
+            WHERE ChatID = ?
+            '''
+        row = self.conn.execute(command, (chat_id,)).fetchone()
+        if not row:
+            return None
+        if row[1] + self.ttl < time.time():
+            self._delete(chat_id)
+            self.expired += 1
+            return None
+        return json.loads(row[0])
+
+    def _save(self, chat_id, state):
+        command = '''
+            INSERT OR REPLACE INTO ChatState (ChatID, Data, Updated)
+            VALUES (?, ?, ?)
+            '''
+        self.conn.execute(command, (chat_id, json.dumps(state, default=str),
+                                    time.time()))
+        self.conn.commit()
+
+    def _delete(self, chat_id):
+        self.conn.execute('DELETE FROM ChatState WHERE ChatID = ?',
+                          (chat_id,))
+        self.conn.commit()
+
+    def load_conversations(self, name):
+        """Loads the states of a ConversationHandler
+
+        :param name: Name of the ConversationHandler
+        :return: dict with the conversation keys and their states
+        """
+        with self._lock:
+            command = '''
+                SELECT Key, State
+                FROM Conversation
+                WHERE Name = ? AND Updated >= ?
+                '''
+            rows = self.conn.execute(
+                command, (name, time.time() - self.ttl)).fetchall()
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    def save_conversation(self, name, key, state):
+        """Stores the state of a conversation
+
+        :param name: Name of the ConversationHandler
+        :param key: Key of the conversation
+        :param state: New state or None if the conversation ended
+        """
+        with self._lock:
+            if state is None:
+                command = '''
+                    DELETE FROM Conversation
+                    WHERE Name = ? AND Key = ?
+                    '''
+                self.conn.execute(command, (name, json.dumps(key)))
+            else:
+                command = '''
+                    INSERT OR REPLACE INTO Conversation
+                    (Name, Key, State, Updated)
+                    VALUES (?, ?, ?, ?)
+                    '''
+                self.conn.execute(command, (name, json.dumps(key), state,
+                                            time.time()))
+            self.conn.commit()
+
+    def close(self):
+        """Closes the database connection"""
+        with self._lock:
+            self.conn.close()
+
+
+class ConversationPersistence(BasePersistence):
+    """Persistence storing only the states of ConversationHandlers
+
+    The states are kept in a SQLiteStateStore, so a restarted bot continues
+    the conversations. user_data, chat_data and bot_data are not used by the
+    bot and therefore not stored.
+    """
+
+    def __init__(self, store):
+        super().__init__(store_user_data=False, store_chat_data=False,
+                         store_bot_data=False)
+        self.store = store
+
+    def get_user_data(self):
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return self.store.load_conversations(name)
+
+    def update_conversation(self, name, key, new_state):
+        self.store.save_conversation(name, key, new_state)
+
+    def update_user_data(self, user_id, data):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+
+def create_state_store(config):
+    """Creates the state store selected in the config
+
+    :param config: dict of the config file
+    :return: Tuple of the store and the persistence for the Updater (None if
+    the conversations are not stored)
+    """
+    ttl = int(config['State_TTL'])
+    max_chats = int(config['State_Max_Chats'])
+    if config['State_Store'] == 'sqlite':
+        store = SQLiteStateStore(config['State_DB'], ttl, max_chats)
+        return store, ConversationPersistence(store)
+    return StateStore(ttl, max_chats), None
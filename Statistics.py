@@ -0,0 +1,159 @@
+from operator import itemgetter
+import numpy as np
+
+# Wochentage in der Reihenfolge von Montag bis Sonntag
+WEEKDAYS = ('Mo', 'Di', 'Mi', 'Do', 'Fr', 'Sa', 'So')
+
+# Anzahl der zuletzt angezeigten Monate, aus denen auch der Trend berechnet
+# wird
+TREND_MONTHS = 12
+
+
+class Statistics:
+    """Statistics of the entries of a user
+
+    The dates, tags and values are converted once to NumPy arrays, all
+    statistics are computed from them with vectorized operations.
+    """
+
+    def __init__(self, rows):
+        """
+        :param rows: List of tuples (date, tag, value) like returned by
+        DB.get_columns
+        """
+        # Spaltenweise auslesen, zip(*rows) ist bei vielen Zeilen langsam
+        self.dates = np.array(list(map(itemgetter(0), rows)),
+                              dtype='datetime64[D]')
+        self.values = np.array(list(map(itemgetter(2), rows)),
+                               dtype=np.float64)
+        # Kategorien als Indizes in die sortierte Liste ihrer Namen
+        names, index = np.unique(
+            np.array(list(map(itemgetter(1), rows)), dtype=np.str_),
+            return_inverse=True)
+        self.tag_index = index.astype(np.int64).ravel()
+        self.tags = names.tolist()
+
+    def __len__(self):
+        return len(self.values)
+
+    def monthly(self):
+        """Returns the sum of every month between the first and last entry
+
+        Months without entries are included with a sum of 0.
+
+        :return: Tuple of the months (datetime64[M]) and their sums
+        """
+        if not len(self):
+            return np.array([], dtype='datetime64[M]'), np.array([])
+        months = self.dates.astype('datetime64[M]')
+        first = months.min()
+        index = (months - first).astype(np.int64)
+        sums = np.bincount(index, weights=self.values)
+        return first + np.arange(len(sums)), sums
+
+    def month_deltas(self):
+        """Returns the change of every month compared to the previous one
+
+        :return: Array with one value less than the months of monthly()
+        """
+        return np.diff(self.monthly()[1])
+
+    def trend(self, today=None):
+        """Returns the average change of the monthly sums
+
+        The slope of a linear fit through the last TREND_MONTHS complete
+        months, so the running month doesn't distort the trend.
+
+        :param today: Date of the running month, defaults to today
+        :return: Change per month or None if there are less than two months
+        """
+        months, sums = self.monthly()
+        running = np.datetime64(today or 'today', 'M')
+        complete = sums[months < running][-TREND_MONTHS:]
+        if len(complete) < 2:
+            return None
+        return np.polyfit(np.arange(len(complete)), complete, 1)[0]
+
+    def per_tag(self):
+        """Returns count, sum, mean, median and 90th percentile per tag
+
+        The values are sorted by tag and value once, the percentiles of all
+        tags are then interpolated at once from the group boundaries.
+
+        :return: List of tuples (tag, count, sum, mean, median, p90) ordered
+        by the sum
+        """
+        if not len(self):
+            return []
+        values = self.values[np.lexsort((self.values, self.tag_index))]
+        counts = np.bincount(self.tag_index, minlength=len(self.tags))
+        starts = np.cumsum(counts) - counts
+        sums = np.bincount(self.tag_index, weights=self.values,
+                           minlength=len(self.tags))
+
+        def quantile(q):
+            position = starts + q * (counts - 1)
+            lower = np.floor(position).astype(np.int64)
+            upper = np.ceil(position).astype(np.int64)
+            return values[lower] + ((values[upper] - values[lower])
+                                    * (position - lower))
+
+        result = zip(self.tags, counts, sums, sums / counts, quantile(0.5),
+                     quantile(0.9))
+        return sorted(result, key=lambda tag: tag[2], reverse=True)
+
+    def weekdays(self):
+        """Returns the spendings per weekday
+
+        The average divides the sum by how often the weekday occurs between
+        the first and last entry, so days without entries count as well.
+
+        :return: Tuple of the sums and the average per day, Monday first
+        """
+        if not len(self):
+            return np.zeros(7), np.zeros(7)
+        # Der 01.01.1970 war ein Donnerstag
+        weekday = (self.dates.astype(np.int64) + 3) % 7
+        sums = np.bincount(weekday, weights=self.values, minlength=7)
+        days = np.arange(self.dates.min(), self.dates.max() + 1)
+        occurrences = np.bincount((days.astype(np.int64) + 3) % 7,
+                                  minlength=7)
+        return sums, sums / np.maximum(occurrences, 1)
+
+    def summary(self, today=None):
+        """Returns the statistics as a message for the user
+
+        :param today: Date of the running month, defaults to today
+        :return: String with trend, tags and weekdays
+        """
+        if not len(self):
+            return 'Keine Einträge vorhanden.'
+        lines = ['{} Einträge, Gesamt: {:.2f}€'.format(len(self),
+                                                       self.values.sum())]
+
+        months, sums = self.monthly()
+        deltas = np.concatenate(([np.nan], np.diff(sums)))
+        lines.append('\nMonate (Summe, Änderung):')
+        for month, total, delta in zip(months[-TREND_MONTHS:],
+                                       sums[-TREND_MONTHS:],
+                                       deltas[-TREND_MONTHS:]):
+            year, number = str(month).split('-')
+            if np.isnan(delta):
+                lines.append('{}.{}: {:.2f}€'.format(number, year, total))
+            else:
+                lines.append('{}.{}: {:.2f}€ ({:+.2f}€)'.format(
+                    number, year, total, delta))
+        trend = self.trend(today)
+        if trend is not None:
+            lines.append('Trend: {:+.2f}€ pro Monat'.format(trend))
+
+        lines.append('\nKategorien (Summe - Anzahl, Mittel, Median, 90%):')
+        for tag, count, total, mean, median, p90 in self.per_tag():
+            lines.append('{}: {:.2f}€ - {}x, {:.2f}€, {:.2f}€, {:.2f}€'.format(
+                tag, total, count, mean, median, p90))
+
+        sums, averages = self.weekdays()
+        lines.append('\nWochentage (Summe, Mittel pro Tag):')
+        for name, total, average in zip(WEEKDAYS, sums, averages):
+            lines.append('{}: {:.2f}€, {:.2f}€'.format(name, total, average))
+        return '\n'.join(lines)
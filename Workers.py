@@ -0,0 +1,257 @@
+from telegram import Update
+from telegram.ext import Updater, TypeHandler
+from ShardedDB import shard_of
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import signal
+import threading
+import time
+
+# Wartezeit vor dem Neustart eines abgestürzten Workers in Sekunden, sie
+# verdoppelt sich bei jedem Absturz kurz nach dem Start bis zum Höchstwert
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+
+# Worker, die mindestens so viele Sekunden liefen, gelten als stabil
+MIN_UPTIME = 60
+
+
+def worker_of(update, workers):
+    """Returns the worker an update is routed to
+
+    The same hash as for the shards of the database is used, so with as many
+    workers as shards every worker only accesses its own shard.
+
+    :param update: Update received from Telegram
+    :param workers: Number of workers
+    :return: Index of the worker
+    """
+    if update.effective_chat:
+        return shard_of(update.effective_chat.id, workers)
+    if update.effective_user:
+        return shard_of(update.effective_user.id, workers)
+    return 0
+
+
+def worker_config(config, index):
+    """Returns the config of a worker
+
+    Ports and files of the metrics would collide between the workers, so the
+    index of the worker is added to them.
+
+    :param config: dict of the config file
+    :param index: Index of the worker
+    :return: dict of the config for the worker
+    """
+    config = dict(config)
+    if config['Metrics_Port']:
+        config['Metrics_Port'] = str(int(config['Metrics_Port']) + index)
+    if config['Metrics_File']:
+        root, extension = os.path.splitext(config['Metrics_File'])
+        config['Metrics_File'] = '{}.{}{}'.format(root, index, extension)
+    return config
+
+
+def run_worker(index, config, updates, bot_factory=None,
+               db_name='SpendingCalcData.db'):
+    """Runs the handlers of the bot for the updates of one worker
+
+    Entry point of a worker process. The updates arrive as dicts from the
+    front process, None stops the worker after all received updates have
+    been handled.
+
+    :param index: Index of the worker
+    :param config: dict of the config file
+    :param updates: Receiving end of the pipe with the updates of this
+    worker
+    :param bot_factory: Function without arguments returning the Bot to be
+    used instead of one with the token of the config
+    :param db_name: Name of the database file
+    """
+    # Strg+C erreicht alle Prozesse, gestoppt wird aber über den Front-Prozess
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import SpendingCalc
+
+    bot = bot_factory() if bot_factory else None
+    updater = SpendingCalc.create_updater(worker_config(config, index), bot,
+                                          db_name)
+    dispatcher = updater.dispatcher
+    updater.job_queue.start()
+    thread = threading.Thread(target=dispatcher.start,
+                              name='Dispatcher-{}'.format(index))
+    thread.start()
+
+    while True:
+        update = updates.recv()
+        if update is None:
+            break
+        dispatcher.update_queue.put(Update.de_json(update, updater.bot))
+
+    # Der Dispatcher arbeitet vor dem Beenden alle Updates ab
+    updater.stop()
+    thread.join()
+    SpendingCalc.shutdown()
+
+
+class WorkerPool:
+    """Worker processes handling the updates of their share of the chats
+
+    Every chat is always routed to the same worker, so the updates of a chat
+    are handled in order and its conversation, cached tags and results stay
+    in one process. A supervisor thread restarts workers that exited
+    unexpectedly, the updates still waiting in their pipe are kept. Updates
+    a crashed worker already received, i.e. in the queue of its dispatcher
+    or being handled, are lost.
+    The updates are sent through a pipe per worker by a sender thread.
+    Unlike a multiprocessing.Queue, a pipe has no lock a crashed worker could
+    keep locked, so its successor can continue reading from it.
+    """
+
+    def __init__(self, config, workers, bot_factory=None,
+                 db_name='SpendingCalcData.db'):
+        """
+        :param config: dict of the config file
+        :param workers: Number of worker processes
+        :param bot_factory: Function without arguments returning the Bot of
+        a worker (see run_worker), has to be picklable
+        :param db_name: Name of the database file
+        """
+        # Die Chats bleiben bei ihrem Worker, nur das globale Limit der
+        # gesendeten Nachrichten wird auf die Worker aufgeteilt
+        self.config = dict(config, Outbound_Rate=str(
+            float(config['Outbound_Rate']) / workers))
+        self.bot_factory = bot_factory
+        self.db_name = db_name
+        # spawn startet die Worker ohne geerbte Threads und Verbindungen
+        self._context = multiprocessing.get_context('spawn')
+        self.pipes = [self._context.Pipe(duplex=False)
+                      for _ in range(workers)]
+        # Ein blockierter Worker hält die Updates der anderen nicht auf
+        self.pending = [queue.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+        self._started = [0.0] * workers
+        self._delays = [RESTART_DELAY] * workers
+        self._stopping = threading.Event()
+        self._supervisor = None
+
+    def start(self):
+        """Starts all workers and the supervisor"""
+        import SpendingCalc
+
+        # Datenbank einmal anlegen bzw. migrieren, bevor mehrere Prozesse
+        # gleichzeitig darauf zugreifen
+        SpendingCalc.open_database(self.db_name, dict(
+            self.config, Lazy_Start='0', Warm_Up_Chats='0'))
+        SpendingCalc.close_database()
+        for index in range(len(self.pipes)):
+            self._start(index)
+            threading.Thread(target=self._send, args=(index,),
+                             name='Worker-Sender-{}'.format(index),
+                             daemon=True).start()
+        self._supervisor = threading.Thread(target=self._supervise,
+                                            name='Worker-Supervisor',
+                                            daemon=True)
+        self._supervisor.start()
+
+    def _start(self, index):
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self.config, self.pipes[index][0], self.bot_factory,
+                  self.db_name),
+            name='SpendingCalc-Worker-{}'.format(index))
+        process.start()
+        self.processes[index] = process
+        self._started[index] = time.monotonic()
+
+    def _send(self, index):
+        """Sends the pending updates of a worker into its pipe"""
+        while True:
+            update = self.pending[index].get()
+            self.pipes[index][1].send(update)
+            if update is None:
+                return
+
+    def _supervise(self):
+        """Restarts workers that exited before the pool was stopped"""
+        while not self._stopping.is_set():
+            sentinels = {process.sentinel: index
+                         for index, process in enumerate(self.processes)}
+            for sentinel in multiprocessing.connection.wait(list(sentinels),
+                                                            timeout=1):
+                index = sentinels[sentinel]
+                self.processes[index].join()
+                if self._stopping.is_set():
+                    return
+                # Bei wiederholten Abstürzen direkt nach dem Start länger
+                # warten, statt ständig neu zu starten
+                if time.monotonic() - self._started[index] < MIN_UPTIME:
+                    delay = self._delays[index]
+                    self._delays[index] = min(delay * 2, MAX_RESTART_DELAY)
+                else:
+                    delay = self._delays[index] = RESTART_DELAY
+                print('Worker {} exited with code {}, restarting in {}s'
+                      .format(index, self.processes[index].exitcode, delay))
+                if self._stopping.wait(delay):
+                    return
+                self._start(index)
+
+    def put(self, update):
+        """Routes an update to the worker of its chat
+
+        :param update: Update received from Telegram
+        """
+        index = worker_of(update, len(self.pipes))
+        self.pending[index].put(update.to_dict())
+
+    def stop(self, timeout=30):
+        """Stops the workers after they answered all routed updates
+
+        :param timeout: Seconds to wait for each worker before it is
+        terminated
+        """
+        self._stopping.set()
+        if self._supervisor:
+            self._supervisor.join()
+        for pending in self.pending:
+            pending.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+
+def run(config, workers, report=None):
+    """Runs the bot with the updates handled by worker processes
+
+    This process only receives the updates, by polling or webhook, and
+    routes them to the workers.
+
+    :param config: dict of the config file
+    :param workers: Number of worker processes
+    :param report: StartupReport the durations of the phases are added to
+    """
+    import SpendingCalc
+
+    pool = WorkerPool(config, workers)
+    pool.start()
+    if report:
+        report.mark('workers')
+
+    updater = Updater(token=config['Telegram_Bot_Token'], workers=1)
+    # Ein einziger Handler, damit die Updates in Reihenfolge weitergeleitet
+    # werden
+    updater.dispatcher.add_handler(
+        TypeHandler(Update, lambda update, context: pool.put(update)))
+    if config['Mode'] == 'webhook':
+        SpendingCalc.start_webhook(updater, config)
+        if report:
+            report.mark('webhook')
+            report.finish()
+    else:
+        SpendingCalc.start_polling(updater, report)
+    print('Bot started with {} workers!'.format(workers))
+    updater.idle()
+    pool.stop()
@@ -0,0 +1 @@
+"""Benchmarks and load tests running the bot against a stubbed Telegram API"""
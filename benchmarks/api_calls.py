@@ -0,0 +1,151 @@
+"""Counts the Bot API calls per completed flow of both user interfaces
+
+Every flow starts and ends in the main menu and is run for several chats,
+first with the reply keyboards and then with the inline mode (Inline_UI=1).
+The calls are counted by the stubbed Bot API and split into sent messages
+(these stay in the chat history), edited messages and answered callback
+queries.
+
+    $ python -m benchmarks.api_calls --chats 20
+"""
+from telegram import Update
+from benchmarks.harness import callback_update, make_bot, message_update
+from collections import Counter
+import SpendingCalc
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+# Schritte der Abläufe: ('text', Nachricht) oder ('press', Beschriftung)
+FLOWS = {
+    'reply': {
+        'Eintragen': [('text', 'Eintragen'), ('text', '12,50'),
+                      ('text', 'Essen'), ('text', 'Heute'),
+                      ('text', 'Nein & Speichern')],
+        'Mit Kommentar': [('text', 'Eintragen'), ('text', '12,50'),
+                          ('text', 'Essen'), ('text', 'Heute'),
+                          ('text', 'Ja'), ('text', 'Pizza')],
+        'Analyse': [('text', 'Analyse'), ('text', '30 Tage'),
+                    ('text', 'Alle'), ('text', 'Einträge anzeigen'),
+                    ('text', 'Nein')],
+        'Betrag ändern': [('text', 'Analyse'), ('text', '30 Tage'),
+                          ('text', 'Alle'), ('text', 'Einträge anzeigen'),
+                          ('text', 'Ja'), ('text', '1'),
+                          ('text', 'Betrag bearbeiten'), ('text', '5'),
+                          ('text', 'Ja')],
+        'Löschen': [('text', 'Analyse'), ('text', '30 Tage'),
+                    ('text', 'Alle'), ('text', 'Einträge anzeigen'),
+                    ('text', 'Ja'), ('text', '1'),
+                    ('text', 'Eintrag löschen'), ('text', 'Ja')]
+    },
+    'inline': {
+        'Eintragen': [('text', '12,50'), ('press', 'Essen'),
+                      ('press', 'Heute')],
+        'Mit Kommentar': [('text', '12,50'), ('press', 'Essen'),
+                          ('text', 'Pizza')],
+        'Analyse': [('press', '30 Tage'), ('press', '« Menü')],
+        'Betrag ändern': [('press', '30 Tage'), ('press', '1'),
+                          ('press', 'Betrag'), ('text', '5'),
+                          ('press', 'Ja')],
+        'Löschen': [('press', '30 Tage'), ('press', '1'),
+                    ('press', 'Löschen'), ('press', 'Ja')]
+    }
+}
+
+# Zum Anlegen der Kategorie vor den gemessenen Abläufen
+SETUP = {'reply': [('text', '/start'), ('text', 'Eintragen'),
+                   ('text', '12,50'), ('text', 'Essen'), ('text', 'Heute'),
+                   ('text', 'Nein & Speichern')],
+         'inline': [('text', '/start'), ('text', '12,50'),
+                    ('text', 'Essen'), ('text', 'Heute')]}
+
+# Gesendete Nachrichten bleiben im Verlauf, bearbeitete ersetzen sich
+SENDS = ('sendMessage', 'sendPhoto', 'sendDocument')
+EDITS = ('editMessageText', 'editMessageReplyMarkup')
+ANSWERS = ('answerCallbackQuery',)
+
+
+def run(mode, chats, directory, timeout):
+    """Runs all flows of a user interface for several chats
+
+    :param mode: 'reply' or 'inline'
+    :param chats: Number of chats running every flow
+    :param directory: Directory for the database
+    :param timeout: Maximum time to wait for an answer
+    :return: dict with the flows and the Counter of calls per method
+    """
+    config = dict(SpendingCalc.DEFAULT_CONFIG,
+                  Slow_Update_Log='',
+                  Warm_Up_Chats='0',
+                  Inline_UI='1' if mode == 'inline' else '0')
+    bot, request = make_bot()
+    updater = SpendingCalc.create_updater(
+        config, bot, os.path.join(directory, mode + '.db'))
+    dispatcher = updater.dispatcher
+    thread = threading.Thread(target=dispatcher.start, name='Dispatcher')
+    thread.start()
+    while not dispatcher.running:
+        time.sleep(0.01)
+
+    def step(chat_id, kind, value):
+        if kind == 'text':
+            update = message_update(chat_id, value)
+        else:
+            update = callback_update(request, chat_id, value)
+        count = request.reply_count(chat_id, complete=True)
+        dispatcher.update_queue.put(Update.de_json(update, bot))
+        if not request.wait_for_reply(chat_id, count, timeout,
+                                      complete=True):
+            raise TimeoutError('No answer to {!r} in {}'.format(value, mode))
+
+    results = {}
+    for chat_id in range(1000, 1000 + chats):
+        for kind, value in SETUP[mode]:
+            step(chat_id, kind, value)
+    for name, flow in FLOWS[mode].items():
+        request.wait_idle()
+        before = Counter(request.calls)
+        for chat_id in range(1000, 1000 + chats):
+            for kind, value in flow:
+                step(chat_id, kind, value)
+        request.wait_idle()
+        results[name] = Counter(request.calls) - before
+
+    dispatcher.stop()
+    thread.join()
+    SpendingCalc.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Bot-API-Aufrufe pro Ablauf beider Oberflächen zählen')
+    parser.add_argument('--chats', type=int, default=20,
+                        help='Anzahl Chats, die jeden Ablauf durchlaufen')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='Maximale Wartezeit auf eine Antwort')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = {mode: run(mode, args.chats, directory, args.timeout)
+                   for mode in FLOWS}
+
+    print('{:14} {:7} {:>7} {:>7} {:>7} {:>7}'.format(
+        'Ablauf', 'Modus', 'Senden', 'Ändern', 'Antwort', 'Gesamt'))
+    for name in FLOWS['reply']:
+        totals = {}
+        for mode in FLOWS:
+            calls = results[mode][name]
+            counts = [sum(calls[method] for method in methods) / args.chats
+                      for methods in (SENDS, EDITS, ANSWERS)]
+            totals[mode] = sum(counts)
+            print('{:14} {:7} {:7.1f} {:7.1f} {:7.1f} {:7.1f}'.format(
+                name, mode, *counts, totals[mode]))
+        print('{:14} {:7} {:>31}'.format('', '', '{:+.0%}'.format(
+            totals['inline'] / totals['reply'] - 1)))
+
+
+if __name__ == '__main__':
+    main()
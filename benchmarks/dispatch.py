@@ -0,0 +1,155 @@
+"""Measures the cost of selecting the handler of a message per state
+
+For every state of the conversation the handlers are checked like the
+ConversationHandler does, until the first one accepts the update. Compared
+are:
+
+    regex      chained MessageHandlers with Filters.regex per button label
+               (as before the ButtonHandler)
+    buttons    the handlers of register_handlers
+
+The messages of a state are its button labels and typical free inputs
+(amount, date, text), each equally often.
+
+    $ python -m benchmarks.dispatch --rounds 20000
+"""
+from telegram import Update
+from telegram.ext import ConversationHandler, Dispatcher, Filters
+from telegram.ext import MessageHandler
+from benchmarks.harness import make_bot, message_update
+from Buttons import ButtonHandler
+import SpendingCalc
+import argparse
+import queue
+import time
+
+# Freie Eingaben, die in jedem Zustand mitgemessen werden
+INPUTS = ('12,50', '1.2.2021', 'Essen')
+
+
+def regex_states():
+    """Returns the handlers of the states with one regex per button
+
+    :return: dict with the states and their handlers
+    """
+    def callback(update, context):
+        pass
+
+    def regex(pattern):
+        return MessageHandler(Filters.regex(pattern), callback)
+
+    text = MessageHandler(Filters.text, callback)
+    amount = regex(r'^-?\d+((\.|,)\d{1,2})?€?$')
+    date = regex(
+        r'^\d{1,2}(\.|-| )\d{1,2}((\.|-| )?|((\.|-| )(\d{2}|\d{4})))?$')
+    return {
+        SpendingCalc.MAIN: [regex('^(Eintragen)$'), regex('^(Analyse)$'),
+                            regex('^(Zurück)$')],
+        SpendingCalc.ENTER: [amount, text],
+        SpendingCalc.ENTER_VALUE: [text],
+        SpendingCalc.ENTER_TAG: [text],
+        SpendingCalc.ENTER_DATE: [regex('^(Nein & Speichern)$'),
+                                  regex('^(Ja)$'), text],
+        SpendingCalc.ENTER_COMMENT: [text],
+        SpendingCalc.ENTER_BATCH: [regex('^(Nein)$'), regex('^(Ja)$'), text],
+        SpendingCalc.ANALYSIS: [
+            regex('^(Zurück)$'),
+            regex('^(7 Tage|30 Tage|Diesen Monat|Dieses Jahr|Alle)$'), text],
+        SpendingCalc.ANALYSIS_TIME: [text],
+        SpendingCalc.ANALYSIS_TAG: [regex('^(Zurück)$'),
+                                    regex('^(Einträge anzeigen)$'),
+                                    regex('^(Diagramm anzeigen)$'), text],
+        SpendingCalc.ANALYSIS_SHOW: [regex('^(Nein|Zurück)$'),
+                                     regex('^(Ja)$'), regex('^(Weiter »)$'),
+                                     regex('^(« Zurück)$')],
+        SpendingCalc.ANALYSIS_SELECT: [text],
+        SpendingCalc.ANALYSIS_EDIT: [
+            regex('^(Zurück)$'),
+            regex('^(Betrag bearbeiten|Datum bearbeiten|'
+                  'Kommentar bearbeiten|Eintrag löschen)$'), text],
+        SpendingCalc.EDIT_VALUE: [amount, text],
+        SpendingCalc.EDIT_DATE: [date, text],
+        SpendingCalc.EDIT_COMMENT: [text],
+        SpendingCalc.EDIT_SAVE: [regex('^(Nein)$'), regex('^(Ja)$')],
+        SpendingCalc.EDIT_REMOVE: [regex('^(Nein)$'), regex('^(Ja)$'), text]
+    }
+
+
+def button_states(bot):
+    """Returns the handlers of the states of register_handlers
+
+    :param bot: Bot for the dispatcher
+    :return: dict with the states and their handlers
+    """
+    dispatcher = Dispatcher(bot, queue.Queue())
+    SpendingCalc.register_handlers(dispatcher)
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                return handler.states
+
+
+def select(handlers, update):
+    """Returns the first handler accepting the update
+
+    :param handlers: Handlers of a state
+    :param update: Update of a message
+    :return: Handler or None
+    """
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return handler
+    return None
+
+
+def measure(handlers, updates, rounds):
+    """Selects the handlers of all updates repeatedly
+
+    :param handlers: Handlers of a state
+    :param updates: Updates of the messages of the state
+    :param rounds: Number of passes over the updates
+    :return: Microseconds per update
+    """
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for update in updates:
+            select(handlers, update)
+    return (time.perf_counter() - start) / (rounds * len(updates)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Kosten der Auswahl des Handlers pro Zustand messen')
+    parser.add_argument('--rounds', type=int, default=10000,
+                        help='Durchläufe über die Nachrichten jedes '
+                             'Zustands')
+    args = parser.parse_args()
+
+    bot = make_bot()[0]
+    old = regex_states()
+    new = button_states(bot)
+    names = SpendingCalc.state_names()
+
+    print('{:16} {:>9} {:>9}'.format('Zustand', 'regex', 'buttons'))
+    total_old = total_new = 0.0
+    for state in sorted(new):
+        labels = set()
+        for handler in new[state]:
+            if isinstance(handler, ButtonHandler):
+                labels.update(handler.buttons)
+        texts = sorted(labels) + list(INPUTS)
+        updates = [Update.de_json(message_update(1, text), bot)
+                   for text in texts]
+        old_time = measure(old[state], updates, args.rounds)
+        new_time = measure(new[state], updates, args.rounds)
+        total_old += old_time
+        total_new += new_time
+        print('{:16} {:7.2f}µs {:7.2f}µs'.format(names[state], old_time,
+                                                 new_time))
+    print('{:16} {:7.2f}µs {:7.2f}µs'.format('Mittel', total_old / len(new),
+                                             total_new / len(new)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+from telegram import Bot
+from telegram.utils.request import Request
+from collections import Counter, defaultdict
+import itertools
+import json
+import queue
+import threading
+import time
+
+# Gültig aufgebautes Token, es wird nie an Telegram gesendet
+TOKEN = '123456:ABCdefGhIJKlmnOPQRstUVwxyz'
+
+# Typische Abläufe der Unterhaltung
+ENTER_FLOW = ['/start', 'Eintragen', '12,50', 'Essen', 'Heute',
+              'Nein & Speichern']
+ANALYSIS_FLOW = ['Analyse', '30 Tage', 'Alle', 'Einträge anzeigen', 'Nein']
+
+
+class StubRequest(Request):
+    """Request answering all Bot API calls locally
+
+    Sent messages are counted per chat, so callers can wait for the answer
+    to an update. An answer is complete with the message carrying a keyboard,
+    as every handler sends its keyboard with the last message. getUpdates is
+    served from the updates queue, so the bot can also be run with polling.
+    Files the bot downloads are served from files (file_id -> bytes). The
+    last inline keyboard of every chat is kept, so its buttons can be
+    pressed (see callback_update).
+    """
+
+    def __init__(self, rtt=0.0, con_pool_size=12):
+        super().__init__(con_pool_size=con_pool_size)
+        # Simulierte Antwortzeit der Bot API in Sekunden
+        self.rtt = rtt
+        self.updates = queue.Queue()
+        self.calls = Counter()
+        self.replies = defaultdict(int)
+        self.answers = defaultdict(int)
+        self.messages = defaultdict(list)
+        self.keyboards = {}
+        self.files = {}
+        self._message_ids = itertools.count(1)
+        self._condition = threading.Condition()
+        self._last_call = time.monotonic()
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        with self._condition:
+            self.calls[method] += 1
+            if method != 'getUpdates':
+                self._last_call = time.monotonic()
+
+        if method == 'getUpdates':
+            return self._get_updates(data.get('timeout', 0))
+        if self.rtt:
+            time.sleep(self.rtt)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'SpendingCalc',
+                    'username': 'SpendingCalcBot'}
+        if method == 'getMyCommands':
+            return []
+        if method in ('setWebhook', 'deleteWebhook', 'answerCallbackQuery'):
+            return True
+        if method == 'getFile':
+            return {'file_id': data['file_id'],
+                    'file_unique_id': data['file_id'],
+                    'file_path': data['file_id']}
+
+        # Alle übrigen Methoden senden oder bearbeiten eine Nachricht
+        chat_id = int(data.get('chat_id', 0))
+        message = {'message_id': data.get('message_id')
+                   or next(self._message_ids),
+                   'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if 'text' in data:
+            message['text'] = data['text']
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': 'photo{}'.format(chat_id),
+                                 'file_unique_id': 'p{}'.format(chat_id),
+                                 'width': 1, 'height': 1}]
+        if method == 'sendDocument':
+            message['document'] = {'file_id': 'doc{}'.format(chat_id),
+                                   'file_unique_id': 'd{}'.format(chat_id)}
+        markup = data.get('reply_markup')
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        with self._condition:
+            self.replies[chat_id] += 1
+            if 'reply_markup' in data:
+                self.answers[chat_id] += 1
+            if markup and 'inline_keyboard' in markup:
+                self.keyboards[chat_id] = (message['message_id'],
+                                           markup['inline_keyboard'])
+            self.messages[chat_id].append((method, data.get('text')))
+            self._condition.notify_all()
+        return message
+
+    def retrieve(self, url, timeout=None):
+        return self.files[url.rsplit('/', 1)[-1]]
+
+    def _get_updates(self, timeout):
+        """Returns the waiting updates like a long polling request
+
+        :param timeout: Maximum time to wait for an update in seconds
+        :return: List of update dicts
+        """
+        try:
+            updates = [self.updates.get(timeout=timeout or 0.01)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                updates.append(self.updates.get_nowait())
+            except queue.Empty:
+                break
+        if self.rtt:
+            time.sleep(self.rtt)
+        return updates
+
+    def reply_count(self, chat_id, complete=False):
+        """Returns the number of messages sent to a chat
+
+        :param chat_id: Telegram chat_id of the user
+        :param complete: Only count messages completing an answer
+        :return: Number of sent messages
+        """
+        with self._condition:
+            if complete:
+                return self.answers[chat_id]
+            return self.replies[chat_id]
+
+    def wait_for_reply(self, chat_id, count, timeout=10.0, complete=False):
+        """Waits until more than count messages were sent to a chat
+
+        :param chat_id: Telegram chat_id of the user
+        :param count: Number of messages sent before the update
+        :param timeout: Maximum time to wait in seconds
+        :param complete: Only count messages completing an answer
+        :return: True if a reply was sent in time
+        """
+        replies = self.answers if complete else self.replies
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: replies[chat_id] > count, timeout)
+
+    def wait_idle(self, quiet=0.2):
+        """Waits until the bot didn't call the Bot API for some time
+
+        Used before stopping the bot, so no handler is still running.
+
+        :param quiet: Time without calls in seconds
+        """
+        while True:
+            with self._condition:
+                remaining = self._last_call + quiet - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+
+def make_bot(rtt=0.0, con_pool_size=12):
+    """Creates a bot using the StubRequest
+
+    :param rtt: Simulated response time of the Bot API in seconds
+    :param con_pool_size: Size of the (unused) connection pool
+    :return: Tuple of the bot and its request
+    """
+    request = StubRequest(rtt, con_pool_size)
+    return Bot(TOKEN, request=request), request
+
+
+_update_ids = itertools.count(1)
+
+
+def message_update(chat_id, text=None, document=None):
+    """Creates the dict of an update with a text message or a document
+
+    :param chat_id: Telegram chat_id of the user
+    :param text: Text of the message
+    :param document: Tuple (file_id, file_name) of a sent document
+    :return: Update dict like sent by Telegram
+    """
+    update_id = next(_update_ids)
+    message = {'message_id': update_id,
+               'date': int(time.time()),
+               'chat': {'id': chat_id, 'type': 'private'},
+               'from': {'id': chat_id, 'is_bot': False,
+                        'first_name': 'Nutzer'}}
+    if document:
+        message['document'] = {'file_id': document[0],
+                               'file_unique_id': document[0],
+                               'file_name': document[1]}
+        return {'update_id': update_id, 'message': message}
+    message['text'] = text
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(request, chat_id, label):
+    """Creates the dict of an update pressing an inline button
+
+    :param request: StubRequest that received the inline keyboard
+    :param chat_id: Telegram chat_id of the user
+    :param label: Label of the button in the last inline keyboard
+    :return: Update dict like sent by Telegram
+    """
+    message_id, keyboard = request.keyboards[chat_id]
+    data = next(button['callback_data'] for row in keyboard
+                for button in row if button['text'] == label)
+    update_id = next(_update_ids)
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Nutzer'}
+    return {'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': user,
+                'chat_instance': str(chat_id),
+                'data': data,
+                'message': {'message_id': message_id,
+                            'date': int(time.time()),
+                            'chat': {'id': chat_id, 'type': 'private'}}}}
+
+
+def percentiles(values):
+    """Computes the usual statistics of latencies
+
+    :param values: List of latencies in seconds
+    :return: dict with count, mean, p50, p95, p99 and max in milliseconds
+    """
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+    return {'count': len(values),
+            'mean': round(sum(values) / len(values) * 1000, 3),
+            'p50': round(rank(0.50) * 1000, 3),
+            'p95': round(rank(0.95) * 1000, 3),
+            'p99': round(rank(0.99) * 1000, 3),
+            'max': round(values[-1] * 1000, 3)}
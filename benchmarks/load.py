@@ -0,0 +1,257 @@
+"""Load test of the conversation handlers
+
+The handlers of register_handlers run in-process with a stubbed Bot API and
+a temporary database. Every simulated chat goes through the Eintragen flow
+(optionally several times) and the Analyse flow, many chats at once. The
+updates are put directly into the update queue of the dispatcher.
+
+For every state of the conversation the time spent in the handler and the
+time until the complete answer are reported, together with the throughput.
+
+    $ python -m benchmarks.load --chats 2000 --concurrency 100
+    $ python -m benchmarks.load --output new.json --compare old.json
+
+With --compare the exit code is 1 if the p95 of any state got worse by more
+than --tolerance compared to the given results.
+"""
+from telegram import Update
+from telegram.ext import ConversationHandler, Updater
+from benchmarks.harness import (make_bot, message_update, percentiles,
+                                ENTER_FLOW, ANALYSIS_FLOW)
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from StateStore import StateStore
+from Buttons import ButtonHandler
+import SpendingCalc
+import argparse
+import functools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+def instrument(dispatcher, timings, update_states):
+    """Wraps the callbacks of the ConversationHandler to measure them
+
+    :param dispatcher: Dispatcher with the registered handlers
+    :param timings: dict collecting the handler times per state name
+    :param update_states: dict collecting the state name per update_id
+    """
+    names = SpendingCalc.state_names()
+    lock = threading.Lock()
+
+    def measure(callback, name):
+        @functools.wraps(callback)
+        def measured(update, context):
+            start = time.perf_counter()
+            try:
+                return callback(update, context)
+            finally:
+                elapsed = time.perf_counter() - start
+                with lock:
+                    timings[name].append(elapsed)
+                    update_states[update.update_id] = name
+        return measured
+
+    def wrap(handler, name):
+        if isinstance(handler, ButtonHandler):
+            handler.replace_callbacks(functools.partial(measure, name=name))
+        else:
+            handler.callback = measure(handler.callback, name)
+
+    for group in dispatcher.handlers.values():
+        for conversation in group:
+            if not isinstance(conversation, ConversationHandler):
+                continue
+            for handler in conversation.entry_points:
+                wrap(handler, 'START')
+            for state, handlers in conversation.states.items():
+                for handler in handlers:
+                    wrap(handler, names.get(state, str(state)))
+
+
+def chat_flow(entries):
+    """Returns the messages one simulated chat sends
+
+    :param entries: Number of entries made before the analysis
+    :return: List of message texts
+    """
+    return (ENTER_FLOW + ENTER_FLOW[1:] * (entries - 1) + ANALYSIS_FLOW)
+
+
+def run(args, db_name):
+    """Runs all simulated chats against the handlers
+
+    :param args: Parsed command line arguments
+    :param db_name: Name of the temporary database file
+    :return: dict with the results
+    """
+    config = dict(SpendingCalc.DEFAULT_CONFIG,
+                  Slow_Update_Log='',
+                  Warm_Up_Chats='0',
+                  DB_Workers=str(args.db_workers),
+                  DB_Readers=str(args.readers),
+                  Write_Behind='1' if args.write_behind else '0')
+    SpendingCalc.open_database(db_name, config)
+    SpendingCalc.data = StateStore(max_chats=max(10000, args.chats))
+
+    bot, request = make_bot(args.rtt, con_pool_size=args.workers + 4)
+    updater = Updater(bot=bot, workers=args.workers)
+    dispatcher = updater.dispatcher
+    SpendingCalc.register_handlers(dispatcher)
+
+    if args.metrics:
+        SpendingCalc.start_metrics(dispatcher, config)
+    timings = defaultdict(list)
+    update_states = {}
+    instrument(dispatcher, timings, update_states)
+
+    updater.job_queue.start()
+    thread = threading.Thread(target=dispatcher.start, name='Dispatcher')
+    thread.start()
+    while not dispatcher.running:
+        time.sleep(0.01)
+
+    replies = {}
+    missing = []
+    lock = threading.Lock()
+    flow = chat_flow(args.entries)
+
+    def client(chat_id):
+        for text in flow:
+            update = message_update(chat_id, text)
+            count = request.reply_count(chat_id, complete=True)
+            start = time.perf_counter()
+            dispatcher.update_queue.put(Update.de_json(update, bot))
+            replied = request.wait_for_reply(chat_id, count, args.timeout,
+                                             complete=True)
+            elapsed = time.perf_counter() - start
+            with lock:
+                if replied:
+                    replies[update['update_id']] = elapsed
+                else:
+                    missing.append(update['update_id'])
+            if not replied:
+                return
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for i in range(args.chats):
+            executor.submit(client, 1000 + i)
+    duration = time.perf_counter() - start
+
+    request.wait_idle(quiet=0.2 + args.rtt)
+    dispatcher.stop()
+    updater.job_queue.stop()
+    thread.join()
+    if args.metrics:
+        print(SpendingCalc.metrics.summary())
+        SpendingCalc.metrics = None
+    SpendingCalc.close_database()
+
+    reply_times = defaultdict(list)
+    for update_id, elapsed in replies.items():
+        reply_times[update_states.get(update_id, 'UNKNOWN')].append(elapsed)
+
+    return {'settings': {'chats': args.chats,
+                         'entries': args.entries,
+                         'concurrency': args.concurrency,
+                         'workers': args.workers,
+                         'db_workers': args.db_workers,
+                         'readers': args.readers,
+                         'write_behind': args.write_behind,
+                         'metrics': args.metrics,
+                         'rtt': args.rtt},
+            'updates': len(replies),
+            'missing': len(missing),
+            'duration': round(duration, 3),
+            'throughput': round(len(replies) / duration, 1),
+            'states': {name: {'handler': percentiles(timings[name]),
+                              'reply': percentiles(reply_times[name])}
+                       for name in sorted(timings)}}
+
+
+def compare(old, new, tolerance):
+    """Prints the change of the p95 latencies per state
+
+    :param old: dict with the previous results
+    :param new: dict with the current results
+    :param tolerance: Allowed relative increase of the p95
+    :return: List of the states that got slower than allowed
+    """
+    regressions = []
+    print('{:16} {:>12} {:>12} {:>8}'.format('Zustand', 'p95 alt', 'p95 neu',
+                                             'Änderung'))
+    for name, timing in sorted(new['states'].items()):
+        if name not in old['states']:
+            continue
+        before = old['states'][name]['reply'].get('p95')
+        after = timing['reply'].get('p95')
+        if not before or after is None:
+            continue
+        change = after / before - 1
+        print('{:16} {:>10.3f}ms {:>10.3f}ms {:>+7.1%}'.format(
+            name, before, after, change))
+        if change > tolerance:
+            regressions.append(name)
+    print('Durchsatz: {} -> {} Updates/s'.format(old['throughput'],
+                                                 new['throughput']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Lasttest der Unterhaltungen mit simulierten Chats')
+    parser.add_argument('--chats', type=int, default=1000,
+                        help='Anzahl simulierter Chats')
+    parser.add_argument('--entries', type=int, default=1,
+                        help='Einträge pro Chat vor der Analyse')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='Anzahl gleichzeitig aktiver Chats')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Worker-Threads des Dispatchers')
+    parser.add_argument('--db-workers', type=int, default=4,
+                        help='Threads für Datenbankabfragen (0 = keine)')
+    parser.add_argument('--readers', type=int, default=0,
+                        help='Zusätzliche lesende Verbindungen')
+    parser.add_argument('--write-behind', action='store_true')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Handler und Datenbank instrumentieren')
+    parser.add_argument('--rtt', type=float, default=0.0,
+                        help='Simulierte Antwortzeit der Bot API in Sekunden')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='Maximale Wartezeit auf eine Antwort')
+    parser.add_argument('--output', help='Ergebnisse als JSON speichern')
+    parser.add_argument('--compare', help='Mit gespeicherten Ergebnissen '
+                                          'vergleichen')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Erlaubte Verschlechterung des p95 (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = run(args, os.path.join(directory, 'load.db'))
+
+    print('{} Updates in {}s, {} Updates/s, {} ohne Antwort'.format(
+        results['updates'], results['duration'], results['throughput'],
+        results['missing']))
+    for name, timing in results['states'].items():
+        print('{:16} Handler {}'.format(name, timing['handler']))
+        print('{:16} Antwort {}'.format('', timing['reply']))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), results, args.tolerance)
+        if regressions:
+            print('Langsamer geworden: ' + ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
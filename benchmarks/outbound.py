@@ -0,0 +1,200 @@
+"""Sends interactive replies and a broadcast against simulated flood limits
+
+The stubbed Bot API enforces limits like Telegram: a global rate and a rate
+per chat with a small burst, exceeding them is answered with
+"429 Too Many Requests" (RetryAfter). Some requests additionally fail
+randomly with it. Meanwhile a broadcast is sent to other chats. Compared
+are:
+
+    direct     the handlers call the Bot API themselves, a message answered
+               with 429 is lost
+    outbound   all messages go through Outbound, the broadcast in its bulk
+               lane
+
+Every round of a chat sends a text without keyboard and a menu with
+keyboard, like most handlers do.
+
+    $ python -m benchmarks.outbound --chats 30 --broadcast 200
+"""
+from telegram import Bot, ReplyKeyboardMarkup
+from telegram.error import RetryAfter
+from benchmarks.harness import StubRequest, TOKEN
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from collections import Counter
+from Outbound import Outbound, TokenBucket
+import argparse
+import math
+import random
+import threading
+import time
+
+# Methoden, für die die simulierten Limits gelten
+LIMITED = ('sendMessage', 'editMessageText', 'sendPhoto', 'sendDocument')
+
+
+class FloodRequest(StubRequest):
+    """StubRequest answering too many messages with RetryAfter"""
+
+    def __init__(self, rate, chat_rate, chat_burst, error_rate, seed=1):
+        super().__init__()
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.error_rate = error_rate
+        self.floods = 0
+        self._bucket = TokenBucket(rate, rate)
+        self._chats = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def post(self, url, data, timeout=None):
+        if url.rsplit('/', 1)[-1] in LIMITED:
+            self._check(int(data['chat_id']))
+        return super().post(url, data, timeout)
+
+    def _check(self, chat_id):
+        now = time.monotonic()
+        with self._lock:
+            chat = self._chats.setdefault(
+                chat_id, TokenBucket(self.chat_rate, self.chat_burst, now))
+            delay = max(self._bucket.delay(now), chat.delay(now))
+            if not delay and self._random.random() < self.error_rate:
+                delay = 1
+            if delay:
+                self.floods += 1
+                raise RetryAfter(math.ceil(delay))
+            self._bucket.take(now)
+            chat.take(now)
+
+
+def percentile(values, q):
+    """Returns a percentile of the values, None without values"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(args, queued):
+    """Runs the interactive chats and the broadcast
+
+    :param args: Parsed command line arguments
+    :param queued: Whether the messages are sent through Outbound
+    :return: dict with the results
+    """
+    request = FloodRequest(args.rate, args.chat_rate, args.chat_burst,
+                           args.error_rate)
+    bot = Bot(TOKEN, request=request)
+    outbound = None
+    if queued:
+        outbound = Outbound(args.rate, args.chat_rate, args.chat_burst,
+                            workers=args.workers)
+        outbound.install(bot)
+        outbound.start()
+
+    latencies = []
+    results = Counter()
+    lock = threading.Lock()
+    markup = ReplyKeyboardMarkup([['Eintragen'], ['Analyse']])
+
+    def send(chat_id, text, reply_markup=None, interactive=True):
+        start = time.perf_counter()
+
+        def done(error=None):
+            with lock:
+                if error:
+                    results['lost'] += 1
+                    return
+                results['delivered'] += 1
+                if interactive:
+                    latencies.append(time.perf_counter() - start)
+
+        try:
+            sent = bot.send_message(chat_id, text, reply_markup=reply_markup)
+        except RetryAfter as e:
+            done(e)
+            return None
+        if isinstance(sent, Future):
+            sent.add_done_callback(lambda future: done(future.exception()))
+        else:
+            done()
+        return sent
+
+    def chat(chat_id):
+        for _ in range(args.rounds):
+            send(chat_id, 'Erfolgreich eingetragen!')
+            send(chat_id, 'Was möchtest du machen?', markup)
+            time.sleep(args.think)
+
+    def broadcast():
+        for chat_id in range(100000, 100000 + args.broadcast):
+            if outbound:
+                with outbound.bulk():
+                    send(chat_id, 'Neue Funktion!', interactive=False)
+            else:
+                send(chat_id, 'Neue Funktion!', interactive=False)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.handlers) as executor:
+        futures = [executor.submit(broadcast)]
+        futures += [executor.submit(chat, chat_id)
+                    for chat_id in range(1000, 1000 + args.chats)]
+        wait(futures)
+    stats = {}
+    if outbound:
+        outbound.stop()
+        stats = outbound.stats()
+    duration = time.perf_counter() - start
+    return {'duration': duration,
+            'delivered': results['delivered'],
+            'lost': results['lost'],
+            'floods': request.floods,
+            'retries': stats.get('retries', 0),
+            'coalesced': stats.get('coalesced', 0),
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95)}
+
+
+def _ms(seconds):
+    return '-' if seconds is None else '{:.0f}ms'.format(seconds * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Senden mit simulierten Flood-Limits messen')
+    parser.add_argument('--chats', type=int, default=30,
+                        help='Anzahl interaktiver Chats')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='Antworten pro interaktivem Chat')
+    parser.add_argument('--think', type=float, default=0.5,
+                        help='Sekunden zwischen den Eingaben eines Chats')
+    parser.add_argument('--broadcast', type=int, default=200,
+                        help='Anzahl Chats, die eine Massennachricht erhalten')
+    parser.add_argument('--handlers', type=int, default=8,
+                        help='Anzahl gleichzeitig laufender Handler')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Anzahl der Sender-Threads von Outbound')
+    parser.add_argument('--rate', type=float, default=30,
+                        help='Nachrichten pro Sekunde insgesamt')
+    parser.add_argument('--chat-rate', type=float, default=1,
+                        help='Nachrichten pro Sekunde und Chat')
+    parser.add_argument('--chat-burst', type=int, default=3,
+                        help='Nachrichten, die ein Chat direkt hintereinander '
+                             'erhalten darf')
+    parser.add_argument('--error-rate', type=float, default=0.02,
+                        help='Anteil zufällig mit 429 beantworteter Anfragen')
+    args = parser.parse_args()
+
+    print('{:9} {:>7} {:>10} {:>8} {:>5} {:>8} {:>9} {:>7} {:>7}'.format(
+        'Modus', 'Dauer', 'Zugestellt', 'Verloren', '429', 'Wiederh.',
+        'Zusammen.', 'p50', 'p95'))
+    for mode in ('direct', 'outbound'):
+        result = run(args, mode == 'outbound')
+        print('{:9} {:6.1f}s {:>10} {:>8} {:>5} {:>8} {:>9} {:>7} {:>7}'
+              .format(mode, result['duration'], result['delivered'],
+                      result['lost'], result['floods'], result['retries'],
+                      result['coalesced'], _ms(result['p50']),
+                      _ms(result['p95'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Measures the cost of building and preparing the analysis queries
+
+The analysis queries are called round-robin with every combination of tag
+and time period on a small database, so building and preparing the
+statements is a noticeable part of each call. Compared are:
+
+    format     SQL formatted on every call (as before the query catalog)
+    catalog    prebuilt SQL from DB.QUERIES
+    uncached   prebuilt SQL, but every statement is prepared again
+
+each with the given size of the statement cache of the connection.
+
+    $ python -m benchmarks.statements --calls 50000
+    $ python -m benchmarks.statements --cache-size 16
+"""
+from DB import DB, QUERY_TEMPLATES, STATEMENT_CACHE_SIZE, resolve_period
+import argparse
+import datetime
+import itertools
+import os
+import sqlite3
+import tempfile
+import time
+
+# Zeiträume, die zusammen alle Kombinationen von Start und Ende abdecken
+PERIODS = (None, 'year', '2020-01-01..', '..2030-12-31')
+
+
+class FormattingDB(DB):
+    """DB that formats the SQL of the analysis queries on every call"""
+
+    def _query(self, name, chat_id, tag=None, time_period=None,
+               bounds=None):
+        table, column, command = QUERY_TEMPLATES[name]
+        where = 'WHERE {}.ChatID = ?'.format(table)
+        param = (chat_id,)
+        if tag:
+            where += ' AND Tags.Tag = ?'
+            param = param + (tag,)
+        start, end = bounds or resolve_period(time_period)
+        if start:
+            where += ' AND {}.{} >= ?'.format(table, column)
+            param = param + (start,)
+        if end:
+            where += ' AND {}.{} < ?'.format(table, column)
+            param = param + (end,)
+        return command.format(where=where), param
+
+
+def fill(db, chats, entries):
+    """Adds entries with two tags for every chat
+
+    :param db: DB the entries are added to
+    :param chats: Number of chats
+    :param entries: Number of entries per chat
+    """
+    today = datetime.date.today()
+    for chat_id in range(chats):
+        rows = (('Essen' if i % 2 else 'Freizeit', i + 0.5,
+                 (today - datetime.timedelta(days=i)).isoformat(), None)
+                for i in range(entries))
+        db.add_entries(chat_id, rows).result()
+
+
+def calls(db, chats):
+    """Returns one call of every query for every combination of filters
+
+    :param db: DB the queries are called on
+    :param chats: Number of chats with entries
+    :return: List of functions without arguments
+    """
+    after = (datetime.date.today().isoformat(), 1 << 62)
+    result = []
+    for chat_id, tag, period in itertools.product(
+            range(chats), (None, 'Essen'), PERIODS):
+        result += [
+            lambda c=chat_id, t=tag, p=period: db.get_entry_sum(c, t, p),
+            lambda c=chat_id, t=tag, p=period: db.get_entries(c, t, p),
+            lambda c=chat_id, t=tag, p=period: db.get_entries_page(
+                c, t, p, limit=5),
+            lambda c=chat_id, t=tag, p=period: db.get_entries_page(
+                c, t, p, after, limit=5),
+            lambda c=chat_id, t=tag, p=period: list(db.iter_entries(
+                c, t, p, chunk_size=5)),
+        ]
+    return result
+
+
+def measure(db_class, db_name, cache_size, args):
+    """Calls the queries round-robin and measures the time per call
+
+    :param db_class: DB or FormattingDB
+    :param db_name: Name of the filled database file
+    :param cache_size: Size of the statement cache of the connection
+    :param args: Parsed command line arguments
+    :return: Microseconds per call
+    """
+    # Ohne Ergebnis-Cache, sonst würden die Abfragen gar nicht ausgeführt
+    db = db_class(db_name, result_cache_size=0)
+    db.conn.close()
+    db.conn = sqlite3.connect(db_name, check_same_thread=False,
+                              cached_statements=cache_size)
+    queries = calls(db, args.chats)
+    for query in queries:
+        query()
+    start = time.perf_counter()
+    for query in itertools.islice(itertools.cycle(queries), args.calls):
+        query()
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed / args.calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Kosten für Aufbau und Vorbereitung der Abfragen messen')
+    parser.add_argument('--calls', type=int, default=20000,
+                        help='Anzahl Abfragen pro Variante')
+    parser.add_argument('--chats', type=int, default=4)
+    parser.add_argument('--entries', type=int, default=10,
+                        help='Einträge pro Chat')
+    parser.add_argument('--cache-size', type=int, default=None,
+                        help='Größe des Statement-Caches, standardmäßig '
+                             'die der Verbindungen des Bots')
+    args = parser.parse_args()
+    cache_size = args.cache_size
+    if cache_size is None:
+        cache_size = STATEMENT_CACHE_SIZE
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_name = os.path.join(directory, 'statements.db')
+        db = DB(db_name)
+        fill(db, args.chats, args.entries)
+        db.close()
+
+        results = [('format', measure(FormattingDB, db_name, cache_size,
+                                      args)),
+                   ('catalog', measure(DB, db_name, cache_size, args)),
+                   ('uncached', measure(DB, db_name, 0, args))]
+
+    print('{} Abfragen pro Variante, Statement-Cache {}'.format(args.calls,
+                                                                cache_size))
+    for name, per_call in results:
+        print('{:10} {:8.2f}µs pro Abfrage'.format(name, per_call))
+    print('Vorbereiten pro Abfrage: {:.2f}µs'.format(
+        results[2][1] - results[1][1]))
+    print('Formatieren pro Abfrage: {:.2f}µs'.format(
+        results[0][1] - results[1][1]))
+
+
+if __name__ == '__main__':
+    main()
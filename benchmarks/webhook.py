@@ -0,0 +1,156 @@
+"""Compares the response latency of webhook and polling mode
+
+The bot runs with a stubbed Bot API, so nothing is sent to Telegram. In
+webhook mode the updates are POSTed to the local webhook, in polling mode
+they are returned by the stubbed getUpdates. The latency of an update is the
+time until the bot sent its complete answer.
+
+    $ python -m benchmarks.webhook --chats 50 --rtt 0.05
+    $ python -m benchmarks.webhook --updates recorded.jsonl --mode webhook
+
+Recorded updates are read as one JSON update per line.
+"""
+from telegram.ext import Updater
+from benchmarks.harness import (make_bot, message_update, percentiles,
+                                ENTER_FLOW, ANALYSIS_FLOW)
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from StateStore import StateStore
+import SpendingCalc
+import argparse
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def load_updates(path, chats):
+    """Returns the updates to be sent per chat
+
+    :param path: File with recorded updates or None for synthetic updates
+    :param chats: Number of synthetic chats
+    :return: dict with chat_id and list of update dicts
+    """
+    if not path:
+        return {1000 + i: [message_update(1000 + i, text)
+                           for text in ENTER_FLOW + ANALYSIS_FLOW]
+                for i in range(chats)}
+    updates = defaultdict(list)
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                update = json.loads(line)
+                updates[update['message']['chat']['id']].append(update)
+    return updates
+
+
+def run(mode, updates, args):
+    """Runs the bot in one mode and sends all updates
+
+    :param mode: 'webhook' or 'polling'
+    :param updates: dict with chat_id and list of update dicts
+    :param args: Parsed command line arguments
+    :return: dict with the results
+    """
+    bot, request = make_bot(args.rtt, con_pool_size=args.workers + 4)
+    updater = Updater(bot=bot, workers=args.workers)
+    SpendingCalc.register_handlers(updater.dispatcher)
+    local = threading.local()
+
+    if mode == 'webhook':
+        updater.start_webhook(listen='127.0.0.1', port=args.port,
+                              url_path='benchmark')
+
+        def send(update):
+            # Eine Verbindung pro Thread offen halten
+            if not hasattr(local, 'connection'):
+                local.connection = http.client.HTTPConnection(
+                    '127.0.0.1', args.port)
+            local.connection.request(
+                'POST', '/benchmark', json.dumps(update),
+                {'Content-Type': 'application/json'})
+            local.connection.getresponse().read()
+    else:
+        updater.start_polling(poll_interval=0, timeout=1)
+        send = request.updates.put
+
+    # Erst senden, wenn die JobQueue für die Timeouts der Unterhaltungen läuft
+    while not updater.job_queue.scheduler.running:
+        time.sleep(0.01)
+
+    latencies = []
+    missing = []
+    lock = threading.Lock()
+
+    def client(chat_id, chat_updates):
+        for update in chat_updates:
+            count = request.reply_count(chat_id, complete=True)
+            start = time.perf_counter()
+            send(update)
+            replied = request.wait_for_reply(chat_id, count, args.timeout,
+                                             complete=True)
+            with lock:
+                if replied:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    missing.append(update['update_id'])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for chat_id, chat_updates in updates.items():
+            executor.submit(client, chat_id, chat_updates)
+    duration = time.perf_counter() - start
+    request.wait_idle(quiet=0.2 + args.rtt)
+    updater.stop()
+
+    result = percentiles(latencies)
+    result['missing'] = len(missing)
+    result['throughput'] = round(len(latencies) / duration, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Latenz von Webhook und Polling vergleichen')
+    parser.add_argument('--mode', choices=['webhook', 'polling', 'both'],
+                        default='both')
+    parser.add_argument('--updates', help='Datei mit aufgezeichneten Updates')
+    parser.add_argument('--chats', type=int, default=50,
+                        help='Anzahl simulierter Chats')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='Anzahl gleichzeitig aktiver Chats')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--db-workers', type=int, default=4,
+                        help='Threads für Datenbankabfragen (0 = keine)')
+    parser.add_argument('--rtt', type=float, default=0.0,
+                        help='Simulierte Antwortzeit der Bot API in Sekunden')
+    parser.add_argument('--port', type=int, default=8444)
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='Maximale Wartezeit auf eine Antwort')
+    parser.add_argument('--output', help='Ergebnisse als JSON speichern')
+    args = parser.parse_args()
+
+    modes = ['webhook', 'polling'] if args.mode == 'both' else [args.mode]
+    results = {}
+    config = dict(SpendingCalc.DEFAULT_CONFIG,
+                  DB_Workers=str(args.db_workers))
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in modes:
+            # Jeder Modus beginnt mit leerer Datenbank
+            SpendingCalc.open_database(os.path.join(directory, mode + '.db'),
+                                       config)
+            SpendingCalc.data = StateStore()
+            results[mode] = run(mode, load_updates(args.updates, args.chats),
+                                args)
+            SpendingCalc.close_database()
+            print('{:8} {}'.format(mode, results[mode]))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Throughput of the bot with the updates distributed to worker processes
+
+The simulated chats of benchmarks.load are routed through a WorkerPool with
+a stubbed Bot API in every worker. The workers report their complete answers
+to this process, so every chat waits for the answer before sending its next
+message. Each number of workers runs on its own temporary database with as
+many shards as workers.
+
+    $ python -m benchmarks.workers --processes 1,2,4 --chats 400
+
+The throughput can only grow with the number of workers as long as there
+are free CPU cores.
+"""
+from telegram import Bot, Update
+from benchmarks.harness import StubRequest, make_bot, message_update, TOKEN
+from benchmarks.load import chat_flow
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from Workers import WorkerPool
+import SpendingCalc
+import argparse
+import functools
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+
+class ReportingRequest(StubRequest):
+    """StubRequest that reports complete answers to another process"""
+
+    def __init__(self, answers):
+        super().__init__()
+        self._answers = answers
+
+    def post(self, url, data, timeout=None):
+        result = super().post(url, data, timeout)
+        if 'reply_markup' in data:
+            self._answers.put(int(data['chat_id']))
+        return result
+
+
+def reporting_bot(answers):
+    """Creates the bot of a worker (see WorkerPool)
+
+    :param answers: Queue receiving the chat_id of every complete answer
+    :return: Bot using a ReportingRequest
+    """
+    return Bot(TOKEN, request=ReportingRequest(answers))
+
+
+class Answers:
+    """Counts the complete answers reported by the workers per chat"""
+
+    def __init__(self, answers):
+        self.counts = defaultdict(int)
+        self._answers = answers
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._collect, daemon=True)
+        self._thread.start()
+
+    def _collect(self):
+        while True:
+            chat_id = self._answers.get()
+            if chat_id is None:
+                return
+            with self._condition:
+                self.counts[chat_id] += 1
+                self._condition.notify_all()
+
+    def wait(self, chat_id, count, timeout):
+        """Waits until more than count answers were sent to a chat
+
+        :return: True if an answer was sent in time
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.counts[chat_id] > count, timeout)
+
+    def stop(self):
+        self._answers.put(None)
+        self._thread.join()
+
+
+def run(args, processes, directory):
+    """Runs all simulated chats against the given number of workers
+
+    :param args: Parsed command line arguments
+    :param processes: Number of worker processes
+    :param directory: Directory for the database
+    :return: Tuple of answered updates, updates without answer and duration
+    """
+    config = dict(SpendingCalc.DEFAULT_CONFIG,
+                  Slow_Update_Log='',
+                  Warm_Up_Chats='0',
+                  DB_Shards=str(processes),
+                  Write_Behind='1' if args.write_behind else '0')
+    db_name = os.path.join(directory, 'workers{}.db'.format(processes))
+    answers = multiprocessing.get_context('spawn').Queue()
+    pool = WorkerPool(config, processes,
+                      functools.partial(reporting_bot, answers), db_name)
+    collector = Answers(answers)
+    bot = make_bot()[0]
+
+    # Den Start der Worker nicht mitmessen
+    pool.start()
+    first_chat = 1000
+    for chat_id in range(first_chat, first_chat + args.chats):
+        pool.put(Update.de_json(message_update(chat_id, '/start'), bot))
+    for chat_id in range(first_chat, first_chat + args.chats):
+        collector.wait(chat_id, 0, args.timeout)
+
+    flow = chat_flow(args.entries)[1:]
+    updates = []
+    missing = []
+
+    def client(chat_id):
+        for text in flow:
+            count = collector.counts[chat_id]
+            pool.put(Update.de_json(message_update(chat_id, text), bot))
+            if not collector.wait(chat_id, count, args.timeout):
+                missing.append(chat_id)
+                return
+            updates.append(chat_id)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for chat_id in range(first_chat, first_chat + args.chats):
+            executor.submit(client, chat_id)
+    duration = time.perf_counter() - start
+
+    pool.stop()
+    collector.stop()
+    return len(updates), len(missing), duration
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Durchsatz mit mehreren Worker-Prozessen messen')
+    parser.add_argument('--processes', default='1,2,4',
+                        help='Kommagetrennte Anzahlen der Worker-Prozesse')
+    parser.add_argument('--chats', type=int, default=200,
+                        help='Anzahl simulierter Chats')
+    parser.add_argument('--entries', type=int, default=1,
+                        help='Einträge pro Chat vor der Analyse')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='Anzahl gleichzeitig aktiver Chats')
+    parser.add_argument('--write-behind', action='store_true')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='Maximale Wartezeit auf eine Antwort')
+    args = parser.parse_args()
+
+    print('{} CPU-Kerne'.format(os.cpu_count()))
+    with tempfile.TemporaryDirectory() as directory:
+        for processes in map(int, args.processes.split(',')):
+            answered, missing, duration = run(args, processes, directory)
+            print('{} Worker: {} Updates in {:.2f}s, {:.1f} Updates/s, '
+                  '{} ohne Antwort'.format(processes, answered, duration,
+                                           answered / duration, missing))
+
+
+if __name__ == '__main__':
+    main()
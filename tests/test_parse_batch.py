@@ -0,0 +1,50 @@
+from SpendingCalc import parse_batch
+import datetime
+import unittest
+
+
+class ParseBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.today = datetime.date.today().isoformat()
+
+    def test_comment_without_date(self):
+        rows, invalid = parse_batch('12 Essen Pizza mit Freunden')
+        self.assertEqual(rows, [('Essen', 12.0, self.today,
+                                 'Pizza mit Freunden')])
+        self.assertEqual(invalid, [])
+
+    def test_number_in_comment_is_no_date(self):
+        rows, _ = parse_batch('8 Essen 3 Kugeln Eis')
+        self.assertEqual(rows, [('Essen', 8.0, self.today, '3 Kugeln Eis')])
+
+    def test_date_and_comment(self):
+        rows, _ = parse_batch('12,50 Essen 3.4.2021 Pizza mit Freunden')
+        self.assertEqual(rows, [('Essen', 12.5, '2021-04-03',
+                                 'Pizza mit Freunden')])
+
+    def test_date_without_comment(self):
+        rows, _ = parse_batch('5€ Bahn 1.2.2021')
+        self.assertEqual(rows, [('Bahn', 5.0, '2021-02-01', None)])
+
+    def test_without_comment(self):
+        rows, _ = parse_batch('5 Bahn')
+        self.assertEqual(rows, [('Bahn', 5.0, self.today, None)])
+
+    def test_existing_tag_with_spaces(self):
+        rows, _ = parse_batch('20 Essen gehen Pizza',
+                              tags=['Essen', 'Essen gehen'])
+        self.assertEqual(rows, [('Essen gehen', 20.0, self.today, 'Pizza')])
+
+    def test_invalid_lines(self):
+        future = datetime.date.today() + datetime.timedelta(days=400)
+        text = '\n'.join(['abc Essen', '12', '3 Alle',
+                          '4 Essen {:%d.%m.%Y}'.format(future), '',
+                          '5 Bahn'])
+        rows, invalid = parse_batch(text)
+        self.assertEqual(rows, [('Bahn', 5.0, self.today, None)])
+        self.assertEqual(invalid, [1, 2, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+from benchmarks.harness import make_bot, message_update
+from telegram import Update
+import SpendingCalc
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+
+class StateEvictionTest(unittest.TestCase):
+    """A chat whose data was evicted mid-conversation returns to the menu"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        config = dict(SpendingCalc.DEFAULT_CONFIG, Slow_Update_Log='',
+                      Warm_Up_Chats='0', State_Max_Chats='1')
+        self.bot, self.request = make_bot()
+        updater = SpendingCalc.create_updater(
+            config, self.bot, os.path.join(self.directory.name, 'test.db'))
+        self.dispatcher = updater.dispatcher
+        self.thread = threading.Thread(target=self.dispatcher.start,
+                                       daemon=True)
+        self.thread.start()
+        while not self.dispatcher.running:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.dispatcher.stop()
+        self.thread.join()
+        SpendingCalc.shutdown()
+        self.directory.cleanup()
+
+    def send(self, chat_id, text):
+        """Sends a message and returns the texts of the answer"""
+        count = len(self.request.messages[chat_id])
+        answers = self.request.reply_count(chat_id, complete=True)
+        self.dispatcher.update_queue.put(
+            Update.de_json(message_update(chat_id, text), self.bot))
+        self.assertTrue(self.request.wait_for_reply(chat_id, answers, 5,
+                                                    complete=True))
+        return [text for _, text in self.request.messages[chat_id][count:]]
+
+    def test_evicted_chat_returns_to_main_menu(self):
+        for text in ('/start', 'Eintragen', '5'):
+            self.send(1, text)
+        # Mit State_Max_Chats=1 verdrängt der zweite Chat die Daten des ersten
+        for text in ('/start', 'Eintragen', '7'):
+            self.send(2, text)
+        self.assertNotIn(1, SpendingCalc.data)
+
+        answer = self.send(1, 'Essen')
+        self.assertEqual(answer, [SpendingCalc.SESSION_EXPIRED,
+                                  'Was möchtest du machen?'])
+        # Die Unterhaltung ist wieder im Hauptmenü
+        self.assertIn('Welchen Betrag', self.send(1, 'Eintragen')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()